@@ -0,0 +1,42 @@
+"""Async version of the file view, served instead of the sync one under ASGI.
+
+Django 4.0 has no async ORM, so the view only awaits the database, the storage
+and the file system in threads. The file is then read one part at a time by
+edu_catalog.handlers.ASGIHandler and sent by the event loop, so a slow download
+only takes a thread while a part is read. The page views stay sync, Django runs
+them in a thread under ASGI by itself.
+"""
+
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.storage import default_storage as storage
+from django.http import Http404, HttpRequest, HttpResponse
+from django.shortcuts import get_object_or_404
+
+from . import files, views
+from .models import EduMaterial
+
+logger = logging.getLogger(__name__)
+
+
+async def material_file(request: HttpRequest, pk: int) -> HttpResponse:
+    """Check if the user has permissions to access the file and stream it."""
+    logger.info("request for file: " + str(pk))
+    material = await sync_to_async(get_object_or_404)(EduMaterial, pk=pk)
+    # the user is loaded lazily from the session
+    await sync_to_async(views.check_file_access)(request.user, material)
+
+    if settings.PDF_DELIVERY == "signed" and hasattr(storage, "signed_url"):
+        return views.signed_file_redirect(material)
+
+    try:
+        # copying from the storage needs no database connection, so it may use any thread
+        fh = await sync_to_async(files.pdf_cache.open, thread_sensitive=False)(material.pdf_file.name, storage)
+    except FileNotFoundError:
+        logger.error("there is no such file on the server")
+        raise Http404()
+
+    return await sync_to_async(files.serve_file, thread_sensitive=False)(request, fh, material.pdf_file.name,
+                                                                         "application/pdf", storage)
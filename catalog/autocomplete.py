@@ -0,0 +1,152 @@
+"""Typeahead suggestions from an in-process prefix index.
+
+Every material title, author name and category name is indexed under the
+normalized text starting at each of its words, in one sorted list, so the
+suggestions for a prefix are a binary search and a short scan. The index is
+built from the database on first use. Every change of a label is appended to
+a catalog.changelog log, which the index of every process replays before a
+lookup.
+"""
+
+import bisect
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.urls import reverse
+
+from .changelog import ChangeLog
+from .models import Author, Category, EduMaterial
+from .search import tokenize
+
+# how many entries past the prefix are looked at to pick the best suggestions
+SCAN_LIMIT = 200
+
+URL_NAMES = {
+    "material": "edumaterial-detail",
+    "author": "author-detail",
+    "category": "category-detail",
+}
+
+changes = ChangeLog("autocomplete")
+
+Item = Tuple[str, int]
+
+
+def normalize(text: str) -> str:
+    """Get the text as lowercase words separated by single spaces."""
+    return " ".join(tokenize(text))
+
+
+def index_keys(label: str) -> List[Tuple[str, int]]:
+    """Get the keys the label is found under with the position of their first word."""
+    words = tokenize(label)
+    return [(" ".join(words[position:]), position) for position in range(len(words))]
+
+
+class PrefixIndex:
+    """Sorted keys of all labels with the items they belong to."""
+
+    def __init__(self):
+        """Create an empty, not yet built index."""
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Forget the index, it is rebuilt on the next lookup."""
+        with self._lock:
+            self._keys: List[str] = []
+            self._entries: List[Tuple[int, Item]] = []
+            self._labels: Dict[Item, str] = {}
+            self._sequence: Optional[int] = None
+
+    def _build(self, sequence: int):
+        labels = {}
+        for pk, title in EduMaterial.objects.values_list("pk", "title"):
+            labels["material", pk] = title
+        for pk, first_name, last_name in Author.objects.values_list("pk", "first_name", "last_name"):
+            labels["author", pk] = first_name + " " + last_name
+        for pk, name in Category.objects.values_list("pk", "name"):
+            labels["category", pk] = name
+
+        entries = sorted((key, position, item) for item, label in labels.items()
+                         for key, position in index_keys(label))
+        self._keys = [key for key, _, _ in entries]
+        self._entries = [(position, item) for _, position, item in entries]
+        self._labels = labels
+        # the changes made while loading are replayed on the next lookup, replaying a change twice does nothing
+        self._sequence = sequence
+
+    def _ensure_current(self):
+        sequence = changes.current()
+        if sequence == self._sequence:
+            return
+        missed = changes.since(self._sequence, sequence)
+        if missed is None:
+            self._build(sequence)
+            return
+        for item, label in missed:
+            self._replace(item, label)
+        self._sequence = sequence
+
+    def _add(self, item: Item, label: str):
+        self._labels[item] = label
+        for key, position in index_keys(label):
+            index = bisect.bisect_left(self._keys, key)
+            self._keys.insert(index, key)
+            self._entries.insert(index, (position, item))
+
+    def _discard(self, item: Item):
+        label = self._labels.pop(item, None)
+        if label is None:
+            return
+        for key, position in index_keys(label):
+            index = bisect.bisect_left(self._keys, key)
+            while self._keys[index] == key and self._entries[index] != (position, item):
+                index += 1
+            del self._keys[index]
+            del self._entries[index]
+
+    def _replace(self, item: Item, label: Optional[str]):
+        if self._labels.get(item) == label:
+            return
+        self._discard(item)
+        if label is not None:
+            self._add(item, label)
+
+    def update(self, item: Item, label: Optional[str]):
+        """Replace the label of the item, None removes it. Called by the signal handlers."""
+        self.update_many([(item, label)])
+
+    def update_many(self, labels: Iterable[Tuple[Item, Optional[str]]]):
+        """Replace the labels of the items in every process, None removes an item."""
+        labels = list(labels)
+        changes.publish(labels)
+        with self._lock:
+            # this process sees its own changes at once, the log replays them in order with the others
+            if self._sequence is not None:
+                for item, label in labels:
+                    self._replace(item, label)
+
+    def suggest(self, prefix: str, limit: int) -> List[dict]:
+        """Get at most limit items with a word starting with the prefix, whole label matches first."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        with self._lock:
+            self._ensure_current()
+            start = bisect.bisect_left(self._keys, prefix)
+            found = {}
+            for index in range(start, min(start + SCAN_LIMIT, len(self._keys))):
+                if not self._keys[index].startswith(prefix):
+                    break
+                position, item = self._entries[index]
+                found[item] = min(position, found.get(item, position))
+            labels = {item: self._labels[item] for item in found}
+
+        best = sorted(found, key=lambda item: (found[item] > 0, len(labels[item]), labels[item].casefold()))
+        return [{"kind": kind, "label": labels[(kind, pk)], "url": reverse(URL_NAMES[kind], args=[pk])}
+                for kind, pk in best[:limit]]
+
+
+prefix_index = PrefixIndex()
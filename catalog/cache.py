@@ -0,0 +1,213 @@
+"""Two-tier cache backend: a small in-process LRU in front of a shared cache.
+
+Reads are served from the local tier for up to L1_TIMEOUT seconds. Writes go
+to the shared tier and to the local tier of this process. Deletes and
+increments, which is how the catalog's version counters change, also bump a
+generation counter in the shared tier; every process compares it at most every
+GENERATION_CHECK_INTERVAL seconds and drops its local tier when it moved. Keys
+that embed a version counter never change their value, so they can stay in the
+local tier until they fall out of it.
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+MISSING = object()
+
+# the local tiers of this process by cache name, shared by the per-thread backend instances
+_tiers: Dict[str, "LocalTier"] = {}
+_tiers_lock = threading.Lock()
+
+
+class LocalTier:
+    """Bounded LRU of pickled values with a per-entry expiry time."""
+
+    def __init__(self, max_entries: int):
+        """Create an empty tier."""
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.generation = MISSING
+        self.checked_at = float("-inf")
+
+    def get(self, key: str) -> Any:
+        """Get the value or MISSING."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, pickled = entry
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+        return pickle.loads(pickled)
+
+    def set(self, key: str, value: Any, timeout: float):
+        """Store the value for timeout seconds, evicting the least recently used values over max_entries."""
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + timeout, pickled)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key: str):
+        """Forget the value."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Forget all values."""
+        with self.lock:
+            self.entries.clear()
+
+
+class TwoTierCache(BaseCache):
+    """Cache backend with a local LRU tier in front of the cache named by the L2 option.
+
+    OPTIONS: L2 (alias of the shared cache), L1_MAX_ENTRIES, L1_TIMEOUT and
+    GENERATION_CHECK_INTERVAL in seconds.
+    """
+
+    def __init__(self, name: str, params: dict):
+        """Attach to the local tier of this process."""
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self.l2_alias = options.get("L2", "shared")
+        self.l1_timeout = options.get("L1_TIMEOUT", 5)
+        self.check_interval = options.get("GENERATION_CHECK_INTERVAL", 0.5)
+        self.generation_key = "two-tier-generation:" + name
+        with _tiers_lock:
+            self.tier = _tiers.setdefault(name, LocalTier(options.get("L1_MAX_ENTRIES", 1000)))
+
+    @property
+    def l2(self) -> BaseCache:
+        """The shared tier. Cache instances are per thread, so it is looked up every time."""
+        return caches[self.l2_alias]
+
+    def _local_timeout(self, timeout) -> Optional[float]:
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return self.l1_timeout
+        return min(timeout, self.l1_timeout) if timeout > 0 else None
+
+    def _sync_generation(self):
+        now = time.monotonic()
+        if now - self.tier.checked_at < self.check_interval:
+            return
+        generation = self.l2.get(self.generation_key)
+        if generation != self.tier.generation:
+            self.tier.clear()
+            self.tier.generation = generation
+        self.tier.checked_at = now
+
+    def _broadcast(self):
+        # the other processes drop their local tier at their next generation check
+        try:
+            self.l2.incr(self.generation_key)
+        except ValueError:
+            self.l2.add(self.generation_key, 1, timeout=None)
+
+    def _remember(self, key: str, value: Any, timeout, version: Optional[int]):
+        local_timeout = self._local_timeout(timeout)
+        if local_timeout is None:
+            self.tier.delete(self.make_key(key, version))
+        else:
+            self.tier.set(self.make_key(key, version), value, local_timeout)
+
+    def get(self, key: str, default: Any = None, version: Optional[int] = None) -> Any:
+        """Get the value from the local tier, or from the shared one."""
+        self._sync_generation()
+        value = self.tier.get(self.make_key(key, version))
+        if value is not MISSING:
+            return value
+        value = self.l2.get(key, MISSING, version=version)
+        if value is MISSING:
+            return default
+        self.tier.set(self.make_key(key, version), value, self.l1_timeout)
+        return value
+
+    def get_many(self, keys: Iterable[str], version: Optional[int] = None) -> dict:
+        """Get the values found in the local tier, and the others in one round trip to the shared one."""
+        self._sync_generation()
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.tier.get(self.make_key(key, version))
+            if value is MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            fetched = self.l2.get_many(missing, version=version)
+            for key, value in fetched.items():
+                self.tier.set(self.make_key(key, version), value, self.l1_timeout)
+            found.update(fetched)
+        return found
+
+    def set(self, key: str, value: Any, timeout=DEFAULT_TIMEOUT, version: Optional[int] = None):
+        """Store the value in both tiers."""
+        self.l2.set(key, value, timeout=timeout, version=version)
+        self._remember(key, value, timeout, version)
+
+    def add(self, key: str, value: Any, timeout=DEFAULT_TIMEOUT, version: Optional[int] = None) -> bool:
+        """Store the value in both tiers unless the shared tier has the key already."""
+        added = self.l2.add(key, value, timeout=timeout, version=version)
+        if added:
+            self._remember(key, value, timeout, version)
+        else:
+            self.tier.delete(self.make_key(key, version))
+        return added
+
+    def set_many(self, data: dict, timeout=DEFAULT_TIMEOUT, version: Optional[int] = None) -> list:
+        """Store the values in both tiers."""
+        failed = self.l2.set_many(data, timeout=timeout, version=version)
+        for key, value in data.items():
+            if key not in failed:
+                self._remember(key, value, timeout, version)
+        return failed
+
+    def touch(self, key: str, timeout=DEFAULT_TIMEOUT, version: Optional[int] = None) -> bool:
+        """Change the expiry of the shared value, the local copy expires on its own soon."""
+        return self.l2.touch(key, timeout=timeout, version=version)
+
+    def delete(self, key: str, version: Optional[int] = None) -> bool:
+        """Delete the value in the shared tier and all local tiers."""
+        deleted = self.l2.delete(key, version=version)
+        self.tier.delete(self.make_key(key, version))
+        self._broadcast()
+        return deleted
+
+    def delete_many(self, keys: Iterable[str], version: Optional[int] = None):
+        """Delete the values in the shared tier and all local tiers."""
+        keys = list(keys)
+        self.l2.delete_many(keys, version=version)
+        for key in keys:
+            self.tier.delete(self.make_key(key, version))
+        self._broadcast()
+
+    def incr(self, key: str, delta: int = 1, version: Optional[int] = None) -> int:
+        """Increment the shared value, the local copies of all processes are dropped."""
+        value = self.l2.incr(key, delta, version=version)
+        self.tier.delete(self.make_key(key, version))
+        self._broadcast()
+        return value
+
+    def has_key(self, key: str, version: Optional[int] = None) -> bool:
+        """Check the key in the local tier, or in the shared one."""
+        return self.get(key, MISSING, version=version) is not MISSING
+
+    def clear(self):
+        """Clear the shared tier, the other processes notice the missing generation and drop theirs."""
+        self.l2.clear()
+        self.tier.clear()
+        self.tier.generation = MISSING
+        self.tier.checked_at = float("-inf")
@@ -0,0 +1,63 @@
+"""Logs of numbered changes in the shared cache, replayed by the in-process indexes of every process.
+
+A process that changes what an index holds appends the change to the log, and
+every index replays the changes numbered after the last one it has seen before
+a lookup. An index only has to be built again when the changes it missed are no
+longer in the log.
+"""
+
+from typing import Any, List, Optional
+
+from django.core.cache import cache
+
+from . import fragments
+
+# seconds the changes are kept in the log, and how many may be replayed before building the index again is cheaper
+CHANGE_TIMEOUT = 3600
+MAX_REPLAYED_CHANGES = 1000
+
+
+class ChangeLog:
+    """Numbered changes of one index, kept for CHANGE_TIMEOUT seconds."""
+
+    def __init__(self, name: str):
+        """Use the cache keys of the log with the name."""
+        self.sequence_key = "catalog:" + name + ":sequence"
+        self.change_key_prefix = "catalog:" + name + ":change:"
+
+    def change_key(self, sequence: int) -> str:
+        """Get the cache key of the change with the sequence number."""
+        return self.change_key_prefix + str(sequence)
+
+    def current(self) -> int:
+        """Get the sequence number of the last change in the log."""
+        sequence = cache.get(self.sequence_key)
+        if sequence is None:
+            cache.add(self.sequence_key, fragments.initial_version(), timeout=None)
+            sequence = cache.get(self.sequence_key)
+        return sequence
+
+    def publish(self, changes: List[Any]):
+        """Append the changes to the log."""
+        if not changes:
+            return
+        try:
+            last = cache.incr(self.sequence_key, len(changes))
+        except ValueError:
+            # a counter lost from the cache restarts above every value it had, like the versions of catalog.fragments
+            cache.add(self.sequence_key, fragments.initial_version(), timeout=None)
+            last = cache.incr(self.sequence_key, len(changes))
+        first = last - len(changes) + 1
+        cache.set_many({self.change_key(first + offset): change for offset, change in enumerate(changes)},
+                       CHANGE_TIMEOUT)
+
+    def since(self, seen: Optional[int], sequence: int) -> Optional[List[Any]]:
+        """Get the changes after the seen one up to the sequence number, in order, or None if some are missing."""
+        if seen is None or not 0 <= sequence - seen <= MAX_REPLAYED_CHANGES:
+            return None
+        keys = [self.change_key(number) for number in range(seen + 1, sequence + 1)]
+        changes = cache.get_many(keys)
+        if len(changes) < len(keys):
+            # expired, or still being written by another process
+            return None
+        return [changes[key] for key in keys]
@@ -0,0 +1,68 @@
+"""Incremental updates of the denormalized counters of the categories and authors.
+
+The counters are changed by relative UPDATE ... SET count = count + n queries,
+so concurrent changes do not overwrite each other. A category's subtree counter
+counts a material once even if it is in several categories of the subtree.
+Changes that skip the signals, like bulk_create, call these functions
+themselves, and `manage.py recount` rebuilds the counters from scratch.
+"""
+
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, Set, Tuple
+
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from .models import Author, Category, CategoryClosure, EduMaterial
+
+
+def _apply(model, field: str, deltas: Counter):
+    by_delta = defaultdict(list)
+    for pk, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(pk)
+    for delta, pks in by_delta.items():
+        model.objects.filter(pk__in=pks).update(**{field: Greatest(F(field) + delta, 0)})
+
+
+def material_categories(material_ids: Iterable[int]) -> Dict[int, Set[int]]:
+    """Get the ids of the categories of every material."""
+    categories = {pk: set() for pk in material_ids}
+    for material_id, category_id in EduMaterial.category.through.objects \
+                                               .filter(edumaterial_id__in=categories) \
+                                               .values_list("edumaterial_id", "category_id"):
+        categories[material_id].add(category_id)
+    return categories
+
+
+def categories_changed(changes: Dict[int, Tuple[Set[int], Set[int]]]):
+    """Count the materials moved from the first set of category ids to the second."""
+    category_ids = {pk for before, after in changes.values() for pk in before | after}
+    if not category_ids:
+        return
+    ancestors = defaultdict(set)
+    for descendant_id, ancestor_id in CategoryClosure.objects.filter(descendant_id__in=category_ids) \
+                                                             .values_list("descendant_id", "ancestor_id"):
+        ancestors[descendant_id].add(ancestor_id)
+
+    direct = Counter()
+    subtree = Counter()
+    for before, after in changes.values():
+        direct.update(after - before)
+        direct.subtract(before - after)
+        subtrees_before = set().union(*(ancestors[pk] for pk in before))
+        subtrees_after = set().union(*(ancestors[pk] for pk in after))
+        subtree.update(subtrees_after - subtrees_before)
+        subtree.subtract(subtrees_before - subtrees_after)
+    _apply(Category, "material_count", direct)
+    _apply(Category, "subtree_material_count", subtree)
+
+
+def authors_changed(deltas: Counter):
+    """Add the deltas to the material counters of the authors."""
+    _apply(Author, "material_count", deltas)
+
+
+def subscribers_changed(deltas: Counter):
+    """Add the deltas to the subscriber counters of the categories."""
+    _apply(Category, "subscriber_count", deltas)
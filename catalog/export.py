@@ -0,0 +1,145 @@
+"""Export of the catalog as JSON lines or CSV, streamed in constant memory.
+
+The materials are read in short keyset chunks ordered by primary key, each one
+a query of its own, so no transaction or server-side cursor stays open on the
+database while the output is being written, however slow the reader is.
+"""
+
+import csv
+import json
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from django.conf import settings
+
+from .models import CategoryClosure, EduMaterial
+
+FORMATS = {
+    "jsonl": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+# The author and categories columns hold ids, so an exported CSV can be imported with `manage.py import_materials`
+COLUMNS = ["id", "title", "summary", "access_type", "author", "author_name", "categories", "category_paths", "file"]
+
+PATH_SEPARATOR = " / "
+
+
+class CategoryPaths:
+    """Paths from the root to the categories, loaded from the closure table as they are needed."""
+
+    def __init__(self, using: str):
+        """Start with no paths loaded."""
+        self.using = using
+        self._paths: Dict[int, str] = {}
+
+    def get(self, category_ids: Iterable[int]) -> Dict[int, str]:
+        """Get the paths of the categories."""
+        missing = set(category_ids) - self._paths.keys()
+        if missing:
+            names: Dict[int, List[str]] = {pk: [] for pk in missing}
+            for descendant_id, name in CategoryClosure.objects.using(self.using) \
+                                                              .filter(descendant_id__in=missing) \
+                                                              .order_by("descendant_id", "-depth") \
+                                                              .values_list("descendant_id", "ancestor__name"):
+                names[descendant_id].append(name)
+            self._paths.update((pk, PATH_SEPARATOR.join(path)) for pk, path in names.items())
+        return self._paths
+
+
+def iter_materials(chunk_size: int, using: str = "default") -> Iterator[dict]:
+    """Get every material with its author and category paths, chunk_size materials per query."""
+    through = EduMaterial.category.through
+    paths = CategoryPaths(using)
+    last_pk = 0
+    while True:
+        chunk = list(EduMaterial.objects.using(using)
+                                        .filter(pk__gt=last_pk)
+                                        .order_by("pk")
+                                        .values_list("pk", "title", "summary", "access_type", "author_id",
+                                                     "author__first_name", "author__last_name", "pdf_file")
+                                        [:chunk_size])
+        if not chunk:
+            return
+        last_pk = chunk[-1][0]
+
+        categories: Dict[int, List[int]] = {row[0]: [] for row in chunk}
+        for material_id, category_id in through.objects.using(using) \
+                                                       .filter(edumaterial_id__in=categories) \
+                                                       .order_by("edumaterial_id", "category_id") \
+                                                       .values_list("edumaterial_id", "category_id"):
+            categories[material_id].append(category_id)
+        category_paths = paths.get(pk for ids in categories.values() for pk in ids)
+
+        for pk, title, summary, access_type, author_id, first_name, last_name, pdf_file in chunk:
+            yield {
+                "id": pk,
+                "title": title,
+                "summary": summary,
+                "access_type": access_type,
+                "author": author_id,
+                "author_name": first_name + " " + last_name if author_id is not None else None,
+                "categories": categories[pk],
+                "category_paths": [category_paths[category_id] for category_id in categories[pk]],
+                "file": pdf_file,
+            }
+
+
+def jsonl_lines(materials: Iterable[dict]) -> Iterator[str]:
+    """Write every material as a line of JSON."""
+    for material in materials:
+        yield json.dumps(material, ensure_ascii=False) + "\n"
+
+
+class _Line:
+    """A file-like object that gives back what csv.writer writes to it."""
+
+    def write(self, value: str) -> str:
+        """Give back the written line."""
+        return value
+
+
+def csv_lines(materials: Iterable[dict]) -> Iterator[str]:
+    """Write a header and every material as a CSV row, the lists separated by ';'."""
+    writer = csv.writer(_Line())
+    yield writer.writerow(COLUMNS)
+    for material in materials:
+        material["categories"] = ";".join(str(pk) for pk in material["categories"])
+        material["category_paths"] = ";".join(material["category_paths"])
+        yield writer.writerow([material[column] for column in COLUMNS])
+
+
+def encode(lines: Iterable[str], buffer_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Encode the lines to UTF-8, in pieces of about buffer_size bytes."""
+    buffer = []
+    size = 0
+    for line in lines:
+        data = line.encode()
+        buffer.append(data)
+        size += len(data)
+        if size >= buffer_size:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Compress the chunks into a gzip stream on the fly."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_catalog(fmt: str, compress: bool = False, chunk_size: Optional[int] = None,
+                   using: str = "default") -> Iterator[bytes]:
+    """Get the whole catalog in the format as a stream of bytes."""
+    if fmt not in FORMATS:
+        raise ValueError("Unknown export format: " + fmt)
+    materials = iter_materials(chunk_size or settings.EXPORT_CHUNK_SIZE, using)
+    chunks = encode(jsonl_lines(materials) if fmt == "jsonl" else csv_lines(materials))
+    return gzip_chunks(chunks) if compress else chunks
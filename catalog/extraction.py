@@ -0,0 +1,72 @@
+"""Background extraction of the terms of the material PDF files into MaterialText."""
+
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.core.files.storage import default_storage as storage
+
+from . import files, fragments, jobs, pdftext, search
+from .models import EduMaterial, Job, MaterialText
+
+logger = logging.getLogger(__name__)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def extraction_pool() -> ProcessPoolExecutor:
+    """Get the process pool parsing the PDF files, the parsing is CPU bound and would block the worker threads."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # the worker runs jobs on many threads, a child forked from it could inherit a lock held by one of them
+            _pool = ProcessPoolExecutor(max_workers=settings.TEXT_EXTRACTION_PROCESSES,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+@jobs.task("extract_material_text")
+def extract_material_text(material_id: int):
+    """Extract the terms of the material file and index them, unless the file has not changed."""
+    material = EduMaterial.objects.filter(pk=material_id).first()
+    if material is None or not material.pdf_file:
+        return
+
+    # the parser reads the file from the local cache, the remote storages download it there first
+    with files.pdf_cache.local_copy(material.pdf_file.name, storage) as path:
+        content_hash = pdftext.file_sha256(path)
+        if MaterialText.objects.filter(material=material, content_hash=content_hash).exists():
+            logger.info("text of material " + str(material_id) + " is up to date")
+            return
+
+        terms, page_count = extraction_pool().submit(pdftext.extract_terms, path, settings.TEXT_MAX_TERMS).result()
+    MaterialText.objects.update_or_create(material=material, defaults={
+        "content_hash": content_hash,
+        "page_count": page_count,
+        "terms": terms,
+    })
+    search.get_backend().index_materials([material_id])
+    # the cached results and the indexes of the other processes are keyed on the version
+    fragments.bump_version(EduMaterial)
+    logger.info("extracted " + str(page_count) + " pages of material " + str(material_id))
+
+
+def idempotency_key(material: EduMaterial) -> str:
+    """Get the key that makes the extraction of a stored file queued only once."""
+    return "extract-text-" + str(material.pk) + "-" + material.pdf_file.name
+
+
+def schedule_extraction(material: EduMaterial):
+    """Queue the extraction of the material file, once per stored file."""
+    jobs.enqueue("extract_material_text", {"material_id": material.pk}, idempotency_key=idempotency_key(material))
+
+
+def schedule_extractions(materials: Iterable[EduMaterial]):
+    """Queue the extraction of the files of many materials in one insert."""
+    Job.objects.bulk_create((Job(task="extract_material_text", payload={"material_id": material.pk},
+                                 idempotency_key=idempotency_key(material)) for material in materials),
+                            batch_size=1000, ignore_conflicts=True)
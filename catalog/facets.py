@@ -0,0 +1,156 @@
+"""Facets of the search results: category subtree, author and access type.
+
+The results are narrowed and counted by author and access type from one query
+over the ranked ids, and by category in one aggregated query over the closure
+table, whatever the number of facet values. Results longer than a batch of ids
+take one more query of each kind per batch. The counts are cached next to the
+results they belong to.
+"""
+
+from array import array
+from collections import Counter
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.http import QueryDict
+from django.utils.http import urlencode
+
+from . import fragments
+from .models import Category, CategoryClosure, EduMaterial
+from .search import RankedIdSource
+
+FACET_LIMIT = 20
+
+# ids bound in one query, below the 999 parameters of older SQLite versions
+ID_BATCH_SIZE = 500
+
+ACCESS_TYPES = dict(EduMaterial.ACCESS_TYPE)
+
+
+def parse_filters(params: QueryDict) -> dict:
+    """Get the valid facet filters of the query string."""
+    filters = {}
+    for name in ("category", "author"):
+        value = params.get(name, "")
+        if value.isdigit():
+            filters[name] = int(value)
+    if params.get("access") in ACCESS_TYPES:
+        filters["access"] = params["access"]
+    return filters
+
+
+def toggle_query_string(params: QueryDict, name: str, value) -> str:
+    """Get the query string with the filter set to the value, or removed if it is set already. Starts on page one."""
+    params = params.copy()
+    params.pop("after", None)
+    if params.get(name) == str(value):
+        params.pop(name)
+    else:
+        params[name] = value
+    return params.urlencode()
+
+
+def facet_values(params: QueryDict, name: str, counts: List[Tuple[object, str, int]]) -> List[dict]:
+    """Describe the (value, label, count) of the facet for the template, largest counts first."""
+    counts = sorted(counts, key=lambda count: (-count[2], count[1]))[:FACET_LIMIT]
+    return [{"label": label, "count": count, "selected": params.get(name) == str(value),
+             "query_string": toggle_query_string(params, name, value)}
+            for value, label, count in counts]
+
+
+def id_batches(ids: Iterable[int]) -> Iterator[List[int]]:
+    """Split the ids in lists short enough for the bound parameters of every database."""
+    ids = iter(ids)
+    while True:
+        batch = list(islice(ids, ID_BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def facet_cache_key(source: RankedIdSource, filters: dict) -> Optional[str]:
+    """Get the cache key of the facet counts, next to the cached results and as fresh as the category names."""
+    if source.cache_key is None:
+        return None
+    return source.cache_key + ":facets:" + fragments.get_version((Category,)) + ":" + \
+        urlencode(sorted(filters.items()))
+
+
+def count_facets(ids: Sequence[int], filters: dict) -> tuple:
+    """Get the packed ids matching the filters and the (value, label, count) of every facet."""
+    matched = set()
+    authors = Counter()
+    author_names = {}
+    access_types = Counter()
+    categories = Counter()
+    category_names = {}
+    for batch in id_batches(ids):
+        materials = EduMaterial.objects.filter(pk__in=batch)
+        if "category" in filters:
+            materials = materials.filter(category__ancestor_links__ancestor=filters["category"]).distinct()
+        if "author" in filters:
+            materials = materials.filter(author_id=filters["author"])
+        if "access" in filters:
+            materials = materials.filter(access_type=filters["access"])
+
+        for pk, author_id, first_name, last_name, access_type in \
+                materials.values_list("pk", "author_id", "author__first_name", "author__last_name", "access_type"):
+            matched.add(pk)
+            if author_id is not None:
+                authors[author_id] += 1
+                author_names[author_id] = first_name + " " + last_name
+            access_types[access_type] += 1
+
+    # every material is in one batch, so the distinct counts of the batches add up
+    for batch in id_batches(sorted(matched)):
+        for pk, name, count in CategoryClosure.objects.filter(descendant__edumaterial__in=batch) \
+                                                      .values_list("ancestor_id", "ancestor__name") \
+                                                      .annotate(count=Count("descendant__edumaterial", distinct=True)) \
+                                                      .order_by():
+            categories[pk] += count
+            category_names[pk] = name
+
+    return (
+        array("q", (pk for pk in ids if pk in matched)).tobytes() if filters else None,
+        [(pk, category_names[pk], count) for pk, count in categories.items()],
+        [(pk, author_names[pk], count) for pk, count in authors.items()],
+        [(code, ACCESS_TYPES[code], count) for code, count in access_types.items()],
+    )
+
+
+def facet_search(source: RankedIdSource, params: QueryDict) -> Tuple[RankedIdSource, Dict[str, List[dict]]]:
+    """Narrow the results to the filters of the query string and count them by every facet.
+
+    The counts are cached with the results, so the next pages and the repeated
+    searches only read them from the cache.
+    """
+    if not len(source.ids):
+        return source, {}
+
+    filters = parse_filters(params)
+    key = facet_cache_key(source, filters)
+    counted = cache.get(key) if key is not None else None
+    if counted is None:
+        counted = count_facets(source.ids, filters)
+        if key is not None:
+            cache.set(key, counted, settings.SEARCH_CACHE_TIMEOUT)
+    matched, categories, authors, access_types = counted
+
+    if matched is not None:
+        matched_ids = array("q")
+        matched_ids.frombytes(matched)
+        matched_ids = set(matched_ids)
+        kept = [index for index, pk in enumerate(source.ids) if pk in matched_ids]
+        source = RankedIdSource(array("q", (source.ids[index] for index in kept)),
+                                array("d", (source.ranks[index] for index in kept)))
+    if not access_types:
+        return source, {}
+
+    return source, {
+        "category": facet_values(params, "category", categories),
+        "author": facet_values(params, "author", authors),
+        "access": facet_values(params, "access", access_types),
+    }
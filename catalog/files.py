@@ -0,0 +1,233 @@
+"""Delivery of material files.
+
+Files are copied once from the storage into a local, size-bounded disk cache
+and served from there: as a whole through the server's sendfile support, as
+byte ranges, or handed over to the front web server with X-Accel-Redirect.
+The ETag is made of the storage name and the size, and Last-Modified is the
+modified time in the storage, so both are the same whichever worker serves the
+file and however often its local copy is made again.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import Storage
+from django.http import (FileResponse, HttpRequest, HttpResponse,
+                         StreamingHttpResponse)
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from . import metrics
+
+CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class PdfCache:
+    """Local copies of stored files, evicting the least recently used ones above max_bytes."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        """Remember where the cache lives and how large it may grow."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._evict_lock = threading.Lock()
+        # paths being opened by this process, which evict leaves alone
+        self._pinned = Counter()
+
+    def path(self, name: str) -> str:
+        """Get the local path of the stored file."""
+        digest = hashlib.sha1(name.encode()).hexdigest()
+        return os.path.join(self.directory, digest + os.path.splitext(name)[1])
+
+    @contextmanager
+    def local_copy(self, name: str, storage: Storage) -> Iterator[str]:
+        """Get the local path of the stored file, copying it from the storage if it is not cached.
+
+        The file is not evicted by this process until the block ends.
+        """
+        path = self.path(name)
+        with self._evict_lock:
+            self._pinned[path] += 1
+        try:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self._fetch(name, storage, path)
+            else:
+                # the access time orders the eviction, the modification time stays the time of the copy
+                os.utime(path, (time.time(), stat.st_mtime))
+            yield path
+        finally:
+            with self._evict_lock:
+                self._pinned[path] -= 1
+                if not self._pinned[path]:
+                    del self._pinned[path]
+
+    def open(self, name: str, storage: Storage) -> BinaryIO:
+        """Open the local copy of the stored file. Once open, it can be read to the end even if it is evicted."""
+        with self.local_copy(name, storage) as path:
+            return open(path, "rb")
+
+    def _fetch(self, name: str, storage: Storage, path: str):
+        os.makedirs(self.directory, exist_ok=True)
+        with storage.open(name, "rb") as source:
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".part", delete=False) as copy:
+                try:
+                    shutil.copyfileobj(source, copy, CHUNK_SIZE)
+                except BaseException:
+                    os.unlink(copy.name)
+                    raise
+        os.replace(copy.name, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits into max_bytes."""
+        with self._evict_lock:
+            entries = []
+            with os.scandir(self.directory) as scan:
+                for entry in scan:
+                    if entry.is_file() and not entry.name.endswith(".part"):
+                        stat = entry.stat()
+                        entries.append((stat.st_atime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path in self._pinned:
+                    continue
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+pdf_cache = PdfCache(settings.PDF_CACHE_DIR, settings.PDF_CACHE_MAX_BYTES)
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Get the (first, last) byte positions of a single byte range header.
+
+    Returns None when the whole file should be sent and raises ValueError when
+    the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header or "")
+    if match is None:
+        # missing, malformed and multiple ranges are answered with the whole file
+        return None
+
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        raise ValueError(header)
+    return first, last
+
+
+def iter_range(fh: BinaryIO, first: int, last: int) -> Iterator[bytes]:
+    """Read the byte range of the open file in chunks."""
+    with fh:
+        fh.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = fh.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_etag(name: str, size: int) -> str:
+    """Get the ETag of the stored file. A new upload gets a new storage name, so the name and size identify it."""
+    return quote_etag(hashlib.sha1(name.encode()).hexdigest()[:16] + "-%x" % size)
+
+
+def modified_time(name: str, storage: Storage) -> Optional[int]:
+    """Get the modified time of the stored file as a timestamp, None if the storage does not tell it.
+
+    A stored file never changes, so its time is cached instead of asking a remote storage on every request.
+    """
+    key = "catalog:file-modified:" + hashlib.sha1(name.encode()).hexdigest()
+    timestamp = cache.get(key)
+    if timestamp is None:
+        try:
+            timestamp = int(storage.get_modified_time(name).timestamp())
+        except (NotImplementedError, OSError):
+            timestamp = 0
+        cache.set(key, timestamp, None)
+    return timestamp or None
+
+
+def serve_file(request: HttpRequest, fh: BinaryIO, name: str, content_type: str, storage: Storage) -> HttpResponse:
+    """Serve the open file stored under the name, with validators and byte range support. The file is closed."""
+    size = os.fstat(fh.fileno()).st_size
+    etag = file_etag(name, size)
+    last_modified = modified_time(name, storage)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = _file_response(request, fh, content_type, size, etag, last_modified)
+    if not getattr(response, "streaming", False):
+        fh.close()
+
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    response["Accept-Ranges"] = "bytes"
+    response["Cache-Control"] = "private, max-age=0, must-revalidate"
+    return response
+
+
+def _file_response(request: HttpRequest, fh: BinaryIO, content_type: str, size: int, etag: str,
+                   last_modified: Optional[int]) -> HttpResponse:
+    if settings.PDF_ACCEL_REDIRECT_PREFIX:
+        # the front server reads the file and handles the ranges itself
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = settings.PDF_ACCEL_REDIRECT_PREFIX + os.path.basename(fh.name)
+        metrics.PDF_BYTES_SERVED.inc(size, sender="front_server")
+        return response
+
+    # If-Range holds either validator, the range is only sent if the file still matches it
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if_range_matches = if_range in (None, etag) or last_modified is not None and if_range == http_date(last_modified)
+    header = request.META.get("HTTP_RANGE") if if_range_matches else None
+    try:
+        byte_range = parse_range(header, size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = "bytes */%d" % size
+        return response
+
+    if byte_range is None:
+        # FileResponse goes through wsgi.file_wrapper, which uses sendfile where available
+        metrics.PDF_BYTES_SERVED.inc(size, sender="app")
+        return FileResponse(fh, content_type=content_type)
+
+    first, last = byte_range
+    metrics.PDF_BYTES_SERVED.inc(last - first + 1, sender="app")
+    response = StreamingHttpResponse(iter_range(fh, first, last), status=206, content_type=content_type)
+    # the file is closed by the response even if the range is never read
+    response._resource_closers.append(fh.close)
+    response["Content-Range"] = "bytes %d-%d/%d" % (first, last, size)
+    response["Content-Length"] = str(last - first + 1)
+    return response
@@ -0,0 +1,81 @@
+"""Cached template fragments of the catalog pages.
+
+Every model has a version counter in the cache, bumped by the signal handlers
+when the transaction changing an object of the model commits. The versions of
+the models a fragment shows are part of its cache key, so a change makes the
+old fragments unreachable instead of deleting them one by one.
+"""
+
+import time
+from typing import Iterable, Type
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Model
+from django.http import QueryDict
+
+VERSION_KEY_PREFIX = "catalog:version:"
+
+
+def version_key(model: Type[Model]) -> str:
+    """Get the cache key of the version counter of the model."""
+    return VERSION_KEY_PREFIX + model._meta.label_lower
+
+
+def initial_version() -> int:
+    # a counter lost from the cache restarts above every value it had, so old fragments stay unreachable
+    return time.time_ns() // 1000
+
+
+def get_version(models: Iterable[Type[Model]]) -> str:
+    """Get the combined version of the models, in one cache round trip."""
+    keys = [version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, initial_version(), timeout=None)
+            versions[key] = cache.get(key)
+    return ".".join(str(versions[key]) for key in keys)
+
+
+def _bump(model: Type[Model]):
+    try:
+        cache.incr(version_key(model))
+    except ValueError:
+        cache.add(version_key(model), initial_version(), timeout=None)
+
+
+def bump_version(model: Type[Model]):
+    """Make the cached fragments showing objects of the model stale once the current transaction commits.
+
+    A bump before the commit would let a concurrent request cache the old objects under the new version.
+    """
+    transaction.on_commit(lambda: _bump(model))
+
+
+class FragmentCacheMixin:
+    """Add the version of fragment_models, the fragment timeout and query to the context, for the {% cache %} tags.
+
+    Only the fragment_query_params of the query string are part of the fragment and of its cache key,
+    so other parameters can neither fill the cache nor end up in the links of the cached fragment.
+    """
+
+    fragment_models: tuple = ()
+    fragment_query_params: tuple = ("after",)
+
+    def page_query(self) -> QueryDict:
+        """Get the query parameters the fragment depends on."""
+        query = QueryDict(mutable=True)
+        for name in self.fragment_query_params:
+            if name in self.request.GET:
+                query.setlist(name, self.request.GET.getlist(name))
+        return query
+
+    def get_context_data(self, **kwargs) -> dict:
+        """Add fragment_version, fragment_timeout and fragment_query."""
+        context = super().get_context_data(**kwargs)
+        context["fragment_version"] = get_version(self.fragment_models)
+        context["fragment_timeout"] = settings.FRAGMENT_CACHE_TIMEOUT
+        context["fragment_query"] = self.page_query().urlencode()
+        return context
@@ -0,0 +1,150 @@
+"""Database-backed background job queue.
+
+Jobs are rows of the Job model. A request only inserts a row; the run_worker
+management command claims due jobs and runs them on a bounded thread pool.
+A failed job is retried with exponential backoff until it runs out of attempts.
+The worker refreshes the lock of the jobs it is running, so only the jobs of a
+dead worker are claimed again. Finished jobs are kept for JOB_RETENTION
+seconds and then deleted by the worker.
+"""
+
+import logging
+import traceback
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+TASKS: Dict[str, Callable] = {}
+
+_current_job: ContextVar = ContextVar("current_job", default=None)
+
+
+def task(name: str) -> Callable:
+    """Register the decorated function as the task with the given name."""
+    def register(func: Callable) -> Callable:
+        TASKS[name] = func
+        return func
+    return register
+
+
+def enqueue(task_name: str, payload: dict, idempotency_key: Optional[str] = None,
+            run_at: Optional[datetime] = None) -> Job:
+    """Queue a task. A job with the same idempotency key is only queued once."""
+    fields = {"task": task_name, "payload": payload, "run_at": run_at or timezone.now()}
+    if idempotency_key is None:
+        return Job.objects.create(**fields)
+
+    job, _ = Job.objects.get_or_create(idempotency_key=idempotency_key, defaults=fields)
+    return job
+
+
+def backoff(attempts: int) -> timedelta:
+    """Get the delay before the next attempt of a job that failed attempts times."""
+    delay = settings.JOB_RETRY_BACKOFF * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.JOB_RETRY_BACKOFF_MAX))
+
+
+def claim(limit: int) -> List[Job]:
+    """Mark at most limit due jobs as running and return them.
+
+    Jobs whose lock was not refreshed for JOB_LOCK_TIMEOUT belong to a dead
+    worker and are claimed again, unless they have run out of attempts.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.JOB_LOCK_TIMEOUT)
+
+    with transaction.atomic():
+        abandoned = Job.objects.filter(status="r", locked_at__lt=stale, attempts__gte=F("max_attempts")) \
+                               .update(status="f", locked_at=None, last_error="The worker running the job was lost")
+        if abandoned:
+            logger.error(str(abandoned) + " jobs abandoned by a lost worker failed for good")
+
+        jobs = Job.objects.filter(Q(status="q", run_at__lte=now) | Q(status="r", locked_at__lt=stale)) \
+                          .order_by("run_at")
+        if connection.features.has_select_for_update_skip_locked:
+            jobs = jobs.select_for_update(skip_locked=True)
+        jobs = list(jobs[:limit])
+
+        Job.objects.filter(pk__in=[job.pk for job in jobs]) \
+                   .update(status="r", locked_at=now, attempts=F("attempts") + 1)
+
+    for job in jobs:
+        job.status, job.locked_at, job.attempts = "r", now, job.attempts + 1
+    return jobs
+
+
+def heartbeat(jobs: Iterable[Job]):
+    """Refresh the lock of the running jobs, so they are not claimed again while they run."""
+    Job.objects.filter(pk__in=[job.pk for job in jobs], status="r").update(locked_at=timezone.now())
+
+
+def save_progress(**progress):
+    """Record the progress of the running job in its payload, so a retry gets it as arguments of the task.
+
+    Does nothing when the task is called directly, outside of a job.
+    """
+    job = _current_job.get()
+    if job is None:
+        return
+    job.payload.update(progress)
+    Job.objects.filter(pk=job.pk).update(payload=job.payload)
+
+
+def purge_finished(older_than: timedelta, batch_size: int = 1000) -> int:
+    """Delete the done and failed jobs that were due longer ago than older_than and return how many were deleted."""
+    finished = Job.objects.filter(status__in=("d", "f"), run_at__lt=timezone.now() - older_than)
+    deleted = 0
+    # in batches, so a large backlog does not lock the table for long
+    while True:
+        pks = list(finished.values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += Job.objects.filter(pk__in=pks).delete()[0]
+
+
+def run(job: Job):
+    """Run a claimed job and record the outcome."""
+    token = _current_job.set(job)
+    try:
+        TASKS[job.task](**job.payload)
+    except Exception as e:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            logger.error("job " + str(job) + " failed for good: " + str(e))
+            job.status = "f"
+        else:
+            logger.warning("job " + str(job) + " failed, will retry: " + str(e))
+            job.status = "q"
+            job.run_at = timezone.now() + backoff(job.attempts)
+    else:
+        job.status = "d"
+        job.last_error = ""
+    finally:
+        _current_job.reset(token)
+        job.locked_at = None
+        job.save(update_fields=["status", "run_at", "locked_at", "last_error"])
+
+
+def run_in_worker(job: Job):
+    """Run a claimed job on a worker thread, which owns its database connection."""
+    try:
+        run(job)
+    finally:
+        close_old_connections()
+
+
+def run_pending(limit: int = 100) -> int:
+    """Run the jobs that are due now in this thread and return how many were run."""
+    jobs = claim(limit)
+    for job in jobs:
+        run(job)
+    return len(jobs)
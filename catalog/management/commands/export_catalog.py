@@ -0,0 +1,39 @@
+"""Command that exports the catalog."""
+
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from catalog import export
+
+
+class Command(BaseCommand):
+    """Write every material with its author and category paths, reading them in short chunks."""
+
+    help = "Export the catalog as JSON lines or CSV, optionally gzip-compressed."
+
+    def add_arguments(self, parser):
+        """Add the command options."""
+        parser.add_argument("--format", choices=sorted(export.FORMATS), default="jsonl", help="Output format.")
+        parser.add_argument("--gzip", action="store_true", help="Compress the output with gzip.")
+        parser.add_argument("--output", "-o", default="-", help="File to write to, the standard output by default.")
+        parser.add_argument("--chunk-size", type=int, default=settings.EXPORT_CHUNK_SIZE,
+                            help="Materials read per query.")
+        parser.add_argument("--database", default="default", help="Database to read from, e.g. a replica.")
+
+    def handle(self, *args, **options):
+        """Export the catalog."""
+        chunks = export.export_catalog(options["format"], options["gzip"], options["chunk_size"], options["database"])
+        if options["output"] == "-":
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+
+        size = 0
+        with open(options["output"], "wb") as fh:
+            for chunk in chunks:
+                fh.write(chunk)
+                size += len(chunk)
+        self.stderr.write("Wrote " + str(size) + " bytes to " + options["output"])
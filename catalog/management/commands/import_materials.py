@@ -0,0 +1,192 @@
+"""Command that imports materials in bulk from a manifest."""
+
+import csv
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Iterator, List, Union
+
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from catalog import (autocomplete, counters, extraction, fragments,
+                     notifications, signals)
+from catalog.models import Author, Category, EduMaterial
+
+ACCESS_TYPES = dict(EduMaterial.ACCESS_TYPE)
+
+TITLE_MAX_LENGTH = EduMaterial._meta.get_field("title").max_length
+
+
+class InvalidLine(ValueError):
+    """A line of a JSON lines manifest that is not a JSON object, skipped like an invalid row."""
+
+
+def read_manifest(path: str) -> Iterator[Union[dict, InvalidLine]]:
+    """Read the rows of a CSV file with a header or of a JSON lines file, one at a time.
+
+    A line that is not a JSON object is read as an InvalidLine, so a single bad
+    line does not stop the import.
+    """
+    with open(path, newline="", encoding="utf-8") as fh:
+        if path.endswith(".jsonl"):
+            for number, line in enumerate(fh, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield InvalidLine("line " + str(number) + ": invalid JSON " + str(e))
+                    continue
+                yield row if isinstance(row, dict) else InvalidLine("line " + str(number) + ": not a JSON object")
+        else:
+            yield from csv.DictReader(fh)
+
+
+def parse_ids(value) -> List[int]:
+    """Get the ids of a JSON list or of a ';' separated string."""
+    if isinstance(value, list):
+        return [int(item) for item in value]
+    return [int(item) for item in str(value or "").split(";") if item.strip()]
+
+
+class Command(BaseCommand):
+    """Insert materials in batches, uploading their files in parallel.
+
+    The manifest has the columns title, summary, access_type, author (id),
+    categories (ids separated by ';', or a list in JSON lines) and file (path
+    relative to the files directory). bulk_create skips the model signals, so
+    the counters, the search index, the suggestions, the cache versions, the
+    text extraction and the notifications are taken care of here, once per
+    batch or once at the end.
+    """
+
+    help = "Import materials from a CSV or JSON lines manifest and a directory of PDF files."
+
+    def add_arguments(self, parser):
+        """Add the command arguments."""
+        parser.add_argument("manifest", help="CSV file with a header row, or a .jsonl file.")
+        parser.add_argument("--files-dir", help="Directory of the PDF files, the manifest directory by default.")
+        parser.add_argument("--batch-size", type=int, default=500, help="Materials inserted per transaction.")
+        parser.add_argument("--upload-workers", type=int, default=8, help="Files uploaded at the same time.")
+        parser.add_argument("--no-notify", action="store_true", help="Do not notify the category subscribers.")
+
+    def handle(self, *args, **options):
+        """Import the materials."""
+        if not os.path.isfile(options["manifest"]):
+            raise CommandError("No such manifest: " + options["manifest"])
+        files_dir = options["files_dir"] or os.path.dirname(os.path.abspath(options["manifest"]))
+        started = time.monotonic()
+
+        imported = skipped = 0
+        category_materials: Dict[int, List[int]] = defaultdict(list)
+        rows = read_manifest(options["manifest"])
+        try:
+            with ThreadPoolExecutor(max_workers=options["upload_workers"]) as uploader:
+                while True:
+                    batch = list(islice(rows, options["batch_size"]))
+                    if not batch:
+                        break
+                    materials = self.import_batch(batch, files_dir, uploader)
+                    skipped += len(batch) - len(materials)
+                    imported += len(materials)
+                    for material in materials:
+                        for category_id in material.category_ids:
+                            category_materials[category_id].append(material.pk)
+                    self.stdout.write("Imported " + str(imported) + " materials")
+        finally:
+            # the committed batches stay when a later one fails, their caches and subscribers are updated all the same
+            if imported:
+                fragments.bump_version(EduMaterial)
+                if not options["no_notify"]:
+                    notifications.schedule_bulk_update(category_materials)
+
+        self.stdout.write(self.style.SUCCESS("Imported " + str(imported) + " materials, skipped " + str(skipped) +
+                                             " rows in " + str(round(time.monotonic() - started, 1)) + " s"))
+
+    def validate(self, batch: List[Union[dict, InvalidLine]], files_dir: str) -> List[dict]:
+        """Get the rows that can be imported, with their file path, access type and ids parsed."""
+        parsed = []
+        for row in batch:
+            if isinstance(row, InvalidLine):
+                self.stderr.write("Skipping " + str(row))
+                continue
+            try:
+                parsed.append(dict(row, author=int(row["author"]) if row.get("author") else None,
+                                   categories=parse_ids(row.get("categories")),
+                                   access_type=row.get("access_type") or "e"))
+            except (TypeError, ValueError) as e:
+                self.stderr.write("Skipping '" + str(row.get("title")) + "': invalid ids " + str(e))
+
+        authors = Author.objects.in_bulk({row["author"] for row in parsed if row["author"] is not None})
+        categories = Category.objects.in_bulk({pk for row in parsed for pk in row["categories"]})
+
+        valid = []
+        for row in parsed:
+            path = os.path.join(files_dir, row.get("file") or "")
+            problem = None
+            if not row.get("title"):
+                problem = "no title"
+            elif len(str(row["title"])) > TITLE_MAX_LENGTH:
+                problem = "title longer than " + str(TITLE_MAX_LENGTH) + " characters"
+            elif not os.path.isfile(path):
+                problem = "no file " + path
+            elif row["author"] is not None and row["author"] not in authors:
+                problem = "no author " + str(row["author"])
+            elif any(pk not in categories for pk in row["categories"]):
+                problem = "unknown categories " + str(row["categories"])
+            elif row["access_type"] not in ACCESS_TYPES:
+                problem = "invalid access type " + str(row["access_type"])
+
+            if problem is None:
+                valid.append(dict(row, path=path))
+            else:
+                self.stderr.write("Skipping '" + str(row.get("title")) + "': " + problem)
+        return valid
+
+    def import_batch(self, batch: List[dict], files_dir: str, uploader: ThreadPoolExecutor) -> List[EduMaterial]:
+        """Upload the files of the batch and insert its materials in one transaction."""
+        rows = self.validate(batch, files_dir)
+        if not rows:
+            return []
+
+        names = list(uploader.map(upload, (row["path"] for row in rows)))
+        try:
+            with transaction.atomic():
+                materials = EduMaterial.objects.bulk_create(
+                    EduMaterial(title=row["title"], summary=row.get("summary") or "",
+                                access_type=row["access_type"], author_id=row["author"], pdf_file=name)
+                    for row, name in zip(rows, names)
+                )
+                through = EduMaterial.category.through
+                through.objects.bulk_create(
+                    through(edumaterial_id=material.pk, category_id=category_id)
+                    for material, row in zip(materials, rows) for category_id in set(row["categories"])
+                )
+
+                # committed with the materials, so a failed batch leaves neither the rows nor their counts
+                for material, row in zip(materials, rows):
+                    material.category_ids = set(row["categories"])
+                counters.categories_changed({material.pk: (set(), material.category_ids) for material in materials})
+                counters.authors_changed(Counter(material.author_id for material in materials if material.author_id))
+                signals.index_on_commit([material.pk for material in materials])
+                labels = [(("material", material.pk), material.title) for material in materials]
+                transaction.on_commit(lambda: autocomplete.prefix_index.update_many(labels))
+        except Exception:
+            for name in names:
+                EduMaterial._meta.get_field("pdf_file").storage.delete(name)
+            raise
+
+        extraction.schedule_extractions(materials)
+        return materials
+
+
+def upload(path: str) -> str:
+    """Save the file in the storage of the material files and get its stored name."""
+    field = EduMaterial._meta.get_field("pdf_file")
+    with open(path, "rb") as fh:
+        return field.storage.save(field.generate_filename(None, os.path.basename(path)), File(fh))
@@ -0,0 +1,23 @@
+"""Command that rebuilds the counters of the categories and authors."""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from catalog import fragments
+from catalog.models import Author, Category
+
+
+class Command(BaseCommand):
+    """Recompute every denormalized counter from the relations, repairing any drift."""
+
+    help = "Rebuild the material, subcategory and subscriber counters of the categories and authors."
+
+    def handle(self, *args, **options):
+        """Recount."""
+        with transaction.atomic():
+            categories = Category.objects.recount()
+            authors = Author.objects.recount()
+        fragments.bump_version(Category)
+        fragments.bump_version(Author)
+        self.stdout.write(self.style.SUCCESS("Recounted " + str(categories) + " categories and " + str(authors) +
+                                             " authors"))
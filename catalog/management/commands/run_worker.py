@@ -0,0 +1,69 @@
+"""Command that runs the background jobs."""
+
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from catalog import jobs
+
+# seconds between two deletions of the old finished jobs
+PURGE_INTERVAL = 3600
+
+
+class Command(BaseCommand):
+    """Claim due jobs from the queue and run them on a bounded pool of threads."""
+
+    help = "Run background jobs from the database queue."
+
+    def add_arguments(self, parser):
+        """Add the command options."""
+        parser.add_argument("--workers", type=int, default=settings.JOB_WORKERS,
+                            help="Number of jobs run at the same time.")
+        parser.add_argument("--poll-interval", type=float, default=settings.JOB_POLL_INTERVAL,
+                            help="Seconds to wait when there are no due jobs.")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit when there are no due jobs left.")
+
+    def handle(self, *args, **options):
+        """Run jobs until interrupted or terminated, then wait for the running ones."""
+        workers = options["workers"]
+        in_flight = {}
+        stopping = threading.Event()
+        previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+        # the locks are refreshed well before another worker would take them for stale
+        heartbeat_interval = settings.JOB_LOCK_TIMEOUT / 3
+        last_heartbeat = time.monotonic()
+        last_purge = None
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                while not stopping.is_set():
+                    in_flight = {future: job for future, job in in_flight.items() if not future.done()}
+                    if in_flight and time.monotonic() - last_heartbeat >= heartbeat_interval:
+                        jobs.heartbeat(in_flight.values())
+                        last_heartbeat = time.monotonic()
+                    if last_purge is None or time.monotonic() - last_purge >= PURGE_INTERVAL:
+                        jobs.purge_finished(timedelta(seconds=settings.JOB_RETENTION))
+                        last_purge = time.monotonic()
+
+                    claimed = jobs.claim(workers - len(in_flight)) if len(in_flight) < workers else []
+                    for job in claimed:
+                        in_flight[pool.submit(jobs.run_in_worker, job)] = job
+
+                    if not claimed:
+                        if options["once"] and not in_flight:
+                            break
+                        stopping.wait(options["poll_interval"])
+            except KeyboardInterrupt:
+                stopping.set()
+            finally:
+                signal.signal(signal.SIGTERM, previous_handler)
+                if stopping.is_set():
+                    self.stdout.write("Waiting for the running jobs to finish...")
+
+        self.stdout.write(self.style.SUCCESS("Worker stopped"))
@@ -0,0 +1,26 @@
+"""Command that sends the notification digests."""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from catalog import notifications
+
+
+class Command(BaseCommand):
+    """Send every subscriber one email about all category updates of the window."""
+
+    help = "Send the digests of the category updates. Meant to be run by a scheduler once per window."
+
+    def add_arguments(self, parser):
+        """Add the command options."""
+        parser.add_argument("--window", type=float, default=settings.NOTIFY_DIGEST_WINDOW_HOURS,
+                            help="Hours of updates to include in the digest, older ones are dropped.")
+
+    def handle(self, *args, **options):
+        """Send the digests."""
+        until = timezone.now()
+        sent = notifications.send_digests(until - timedelta(hours=options["window"]), until)
+        self.stdout.write(self.style.SUCCESS("Sent " + str(sent) + " digests"))
@@ -0,0 +1,50 @@
+"""Prometheus metrics of the catalog, exposed by logmiddleware at /metrics.
+
+Only the web processes are scraped. Counters increased by the worker and by
+the management commands are kept in the database with count_in_database and
+read at scrape time, like the depth of the job queue.
+"""
+
+from django.db.models import Count, F
+from logmiddleware.metrics import Counter, Gauge, Histogram, registry
+
+from .models import Job, MetricTotal
+
+SEARCH_LATENCY = Histogram("catalog_search_duration_seconds",
+                           "Time to find and load a page of search results, by search backend.",
+                           labelnames=("backend",))
+
+PDF_BYTES_SERVED = Counter("catalog_pdf_bytes_served",
+                           "Bytes of material files served by MaterialFileView, by who sends them.",
+                           labelnames=("sender",))
+
+# counted in the database, the emails are sent by the worker and the send_digests command
+EMAILS_SENT = Counter("catalog_emails_sent", "Notification emails accepted by the mail server.")
+
+JOBS = Gauge("catalog_jobs", "Background jobs waiting or running, by status.", labelnames=("status",))
+
+
+def count_in_database(counter: Counter, amount: int = 1):
+    """Increase the total of the counter kept in the database, which every process adds to."""
+    if not amount:
+        return
+    if not MetricTotal.objects.filter(name=counter.name).update(value=F("value") + amount):
+        total, created = MetricTotal.objects.get_or_create(name=counter.name, defaults={"value": amount})
+        if not created:
+            MetricTotal.objects.filter(pk=total.pk).update(value=F("value") + amount)
+
+
+@registry.collector
+def database_totals():
+    """Read the totals of the counters kept in the database."""
+    return [(name, {}, value) for name, value in MetricTotal.objects.values_list("name", "value")]
+
+
+@registry.collector
+def job_queue_depth():
+    """Count the queued and running jobs, the table is shared by all processes so it is read at scrape time."""
+    counts = dict.fromkeys(("queued", "running"), 0)
+    names = dict(Job.STATUS)
+    for row in Job.objects.filter(status__in=("q", "r")).values("status").annotate(count=Count("pk")):
+        counts[names[row["status"]].lower()] = row["count"]
+    return [(JOBS.name, {"status": status}, count) for status, count in counts.items()]
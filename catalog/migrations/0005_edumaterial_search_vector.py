@@ -0,0 +1,43 @@
+# Generated by Django 4.0.5 on 2026-10-18 10:02
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+SEARCH_VECTOR_SQL = """
+UPDATE catalog_edumaterial AS m SET search_vector =
+    setweight(to_tsvector('simple', coalesce(m.title, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce((SELECT a.first_name || ' ' || a.last_name
+                                              FROM catalog_author AS a
+                                              WHERE a.id = m.author_id), '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(m.summary, '')), 'B')
+"""
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(SEARCH_VECTOR_SQL)
+    schema_editor.execute("CREATE INDEX catalog_edumaterial_search_vector_gin "
+                          "ON catalog_edumaterial USING gin (search_vector)")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS catalog_edumaterial_search_vector_gin")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0004_remove_edumaterial_pdf_file_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='edumaterial',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
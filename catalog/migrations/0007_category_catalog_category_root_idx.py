@@ -0,0 +1,17 @@
+# Generated by Django 4.0.5 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0006_categoryclosure'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(condition=models.Q(('parent_category__isnull', True)), fields=['name'], name='catalog_category_root_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.0.5 on 2026-10-18 13:37
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0008_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryUpdateEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='update_events', to='catalog.category')),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catalog.edumaterial')),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.0.5 on 2026-10-18 14:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0009_categoryupdateevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterialText',
+            fields=[
+                ('material', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='text', serialize=False, to='catalog.edumaterial')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('page_count', models.PositiveIntegerField(default=0)),
+                ('terms', models.TextField(blank=True)),
+                ('extracted_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
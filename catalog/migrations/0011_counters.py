@@ -0,0 +1,66 @@
+# Generated by Django 4.0.5 on 2026-10-18 16:40
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count(subquery):
+    return Coalesce(Subquery(subquery.order_by().annotate(count=Count('pk')).values('count'),
+                             output_field=models.IntegerField()), 0)
+
+
+def recount(apps, schema_editor):
+    Author = apps.get_model('catalog', 'Author')
+    Category = apps.get_model('catalog', 'Category')
+    EduMaterial = apps.get_model('catalog', 'EduMaterial')
+
+    Author.objects.update(material_count=count(EduMaterial.objects.filter(author=OuterRef('pk')).values('author')))
+    subtree = EduMaterial.objects.filter(category__ancestor_links__ancestor=OuterRef('pk')) \
+                                 .order_by() \
+                                 .values('category__ancestor_links__ancestor') \
+                                 .annotate(count=Count('pk', distinct=True)) \
+                                 .values('count')
+    Category.objects.update(
+        material_count=count(EduMaterial.category.through.objects.filter(category=OuterRef('pk')).values('category')),
+        subtree_material_count=Coalesce(Subquery(subtree, output_field=models.IntegerField()), 0),
+        subcategory_count=count(Category.objects.filter(parent_category=OuterRef('pk')).values('parent_category')),
+        subscriber_count=count(Category.users_subscribed.through.objects.filter(category=OuterRef('pk'))
+                                                                      .values('category')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0010_materialtext'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='material_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='material_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='subcategory_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='subscriber_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='subtree_material_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(recount, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.0.5 on 2026-10-18 16:40
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+def rename_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("ALTER INDEX catalog_edumaterial_search_vector_gin RENAME TO catalog_material_search_gin")
+
+
+def restore_search_index_name(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("ALTER INDEX catalog_material_search_gin RENAME TO catalog_edumaterial_search_vector_gin")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0011_counters'),
+    ]
+
+    operations = [
+        # 0005 created the index with raw SQL on PostgreSQL only, it is declared on the model from now on
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(rename_search_index, restore_search_index_name),
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='edumaterial',
+                    index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'],
+                                                                   name='catalog_material_search_gin'),
+                ),
+            ],
+        ),
+    ]
@@ -1,8 +1,13 @@
 """Models for catalog app."""
 
 from django.contrib.auth.models import User
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 from django.shortcuts import reverse
+from django.utils import timezone
 
 
 class EduMaterial(models.Model):
@@ -20,11 +25,24 @@ class EduMaterial(models.Model):
     access_type = models.CharField(max_length=1, choices=ACCESS_TYPE, default='e')
     pdf_file = models.FileField(upload_to="pdfmaterials/")
     category = models.ManyToManyField('Category')
+    # Kept up to date by catalog.search on save; only filled in on PostgreSQL.
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         """Meta info."""
 
         permissions = (("can_view_premium", "View premium materials"),)
+        indexes = [
+            GinIndex(fields=['search_vector'], name='catalog_material_search_gin'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remember the author the material was loaded with, unless it was deferred."""
+        instance = super().from_db(db, field_names, values)
+        if 'author_id' in instance.__dict__:
+            instance._loaded_author_id = instance.author_id
+        return instance
 
     def __str__(self) -> str:
         """Convert material to string."""
@@ -39,6 +57,33 @@ class EduMaterial(models.Model):
         return reverse('edumaterial-file', args=[str(self.id)])
 
 
+def _count(subquery: models.QuerySet) -> Coalesce:
+    return Coalesce(Subquery(subquery, output_field=models.IntegerField()), 0)
+
+
+def _without_counters(instance: models.Model, counters, kwargs: dict) -> dict:
+    """Leave the counters out of the update of an existing row, so a stale instance does not overwrite them."""
+    if instance._state.adding or kwargs.get('force_insert'):
+        return kwargs
+    update_fields = kwargs.get('update_fields')
+    if update_fields is None:
+        update_fields = [field.name for field in instance._meta.concrete_fields if not field.primary_key]
+    return dict(kwargs, update_fields=[name for name in update_fields if name not in counters])
+
+
+class AuthorQuerySet(models.QuerySet):
+    """Queries over the authors."""
+
+    def recount(self) -> int:
+        """Recompute the material counters of the authors from the materials."""
+        materials = EduMaterial.objects.filter(author=OuterRef('pk')) \
+                                       .order_by() \
+                                       .values('author') \
+                                       .annotate(count=models.Count('pk')) \
+                                       .values('count')
+        return self.update(material_count=_count(materials))
+
+
 class Author(models.Model):
     """The author of the material. Has a one-to-one relationship to User."""
 
@@ -46,6 +91,12 @@ class Author(models.Model):
     first_name = models.CharField(max_length=100, db_index=True)
     last_name = models.CharField(max_length=100, db_index=True)
     info = models.TextField(max_length=1000)
+    # Kept up to date by catalog.counters, rebuilt by `manage.py recount`
+    material_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = AuthorQuerySet.as_manager()
+
+    COUNTERS = ('material_count',)
 
     class Meta:
         """Meta info."""
@@ -56,13 +107,63 @@ class Author(models.Model):
         """Convert author to string."""
         return self.first_name + " " + self.last_name
 
+    def save(self, *args, **kwargs):
+        """Save the author, but not the counters."""
+        super().save(*args, **_without_counters(self, self.COUNTERS, kwargs))
+
     def get_absolute_url(self) -> str:
         """Get the absolute url of the author."""
         return reverse('author-detail', args=[str(self.id)])
 
 
+class CategoryQuerySet(models.QuerySet):
+    """Queries over the category tree."""
+
+    def ancestors_of(self, categories) -> models.QuerySet:
+        """Get the categories and all their ancestors."""
+        return self.filter(descendant_links__descendant__in=categories).distinct()
+
+    def roots(self) -> models.QuerySet:
+        """Get the main categories, the ones without a parent."""
+        return self.filter(parent_category__isnull=True).order_by('name')
+
+    def recount(self) -> int:
+        """Recompute the material, subcategory and subscriber counters of the categories from the relations."""
+        direct = EduMaterial.category.through.objects.filter(category=OuterRef('pk')) \
+                                                     .order_by() \
+                                                     .values('category') \
+                                                     .annotate(count=models.Count('pk')) \
+                                                     .values('count')
+        subtree = EduMaterial.objects.filter(category__ancestor_links__ancestor=OuterRef('pk')) \
+                                     .order_by() \
+                                     .values('category__ancestor_links__ancestor') \
+                                     .annotate(count=models.Count('pk', distinct=True)) \
+                                     .values('count')
+        subcategories = Category.objects.filter(parent_category=OuterRef('pk')) \
+                                        .order_by() \
+                                        .values('parent_category') \
+                                        .annotate(count=models.Count('pk')) \
+                                        .values('count')
+        subscribers = Category.users_subscribed.through.objects.filter(category=OuterRef('pk')) \
+                                                              .order_by() \
+                                                              .values('category') \
+                                                              .annotate(count=models.Count('pk')) \
+                                                              .values('count')
+        return self.update(
+            material_count=_count(direct),
+            subtree_material_count=_count(subtree),
+            subcategory_count=_count(subcategories),
+            subscriber_count=_count(subscribers),
+        )
+
+
 class Category(models.Model):
-    """Category of educational materials. Can itself be inside other category."""
+    """Category of educational materials. Can itself be inside other category.
+
+    Every path of the tree is stored in CategoryClosure, which is kept up to date
+    when a category is created or moved, so whole branches are fetched in one query.
+    The counters of the parent and of the ancestors are updated along with it.
+    """
 
     name = models.CharField(max_length=100, db_index=True)
     info = models.TextField(max_length=1000)
@@ -70,6 +171,89 @@ class Category(models.Model):
                                         null=True, blank=True,
                                         on_delete=models.CASCADE)
     users_subscribed = models.ManyToManyField(User, blank=True)
+    # Kept up to date by catalog.counters, rebuilt by `manage.py recount`
+    material_count = models.PositiveIntegerField(default=0, editable=False)
+    subtree_material_count = models.PositiveIntegerField(default=0, editable=False)
+    subcategory_count = models.PositiveIntegerField(default=0, editable=False)
+    subscriber_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = CategoryQuerySet.as_manager()
+
+    COUNTERS = ('material_count', 'subtree_material_count', 'subcategory_count', 'subscriber_count')
+
+    class Meta:
+        """Meta info."""
+
+        indexes = [
+            models.Index(fields=['name'], condition=Q(parent_category__isnull=True), name='catalog_category_root_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remember the parent the category was loaded with."""
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_parent_id = instance.__dict__.get('parent_category_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        """Save the category, but not the counters, and update the paths to it."""
+        adding = self._state.adding
+        moved = not adding and 'parent_category_id' in self.__dict__ and \
+            self.parent_category_id != getattr(self, '_loaded_parent_id', None)
+
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **_without_counters(self, self.COUNTERS, kwargs))
+            if adding:
+                self._insert_paths()
+                Category.objects.filter(pk=self.parent_category_id) \
+                                .update(subcategory_count=F('subcategory_count') + 1)
+            elif moved:
+                old_ancestors = set(self.ancestors().values_list('pk', flat=True))
+                self._move_paths()
+                new_ancestors = set(self.ancestors().values_list('pk', flat=True))
+                Category.objects.filter(pk__in=old_ancestors | new_ancestors).recount()
+        self._loaded_parent_id = self.parent_category_id
+
+    def _insert_paths(self):
+        links = [CategoryClosure(ancestor=self, descendant=self, depth=0)]
+        if self.parent_category_id is not None:
+            for ancestor_id, depth in CategoryClosure.objects.filter(descendant_id=self.parent_category_id) \
+                                                            .values_list('ancestor_id', 'depth'):
+                links.append(CategoryClosure(ancestor_id=ancestor_id, descendant=self, depth=depth + 1))
+        CategoryClosure.objects.bulk_create(links)
+
+    def _move_paths(self):
+        subtree = dict(CategoryClosure.objects.filter(ancestor=self).values_list('descendant_id', 'depth'))
+        if self.parent_category_id in subtree:
+            raise ValueError("Category cannot be moved inside of itself")
+
+        CategoryClosure.objects.filter(descendant_id__in=subtree) \
+                               .exclude(ancestor_id__in=subtree) \
+                               .delete()
+        if self.parent_category_id is None:
+            return
+
+        ancestors = CategoryClosure.objects.filter(descendant_id=self.parent_category_id) \
+                                           .values_list('ancestor_id', 'depth')
+        CategoryClosure.objects.bulk_create(
+            CategoryClosure(ancestor_id=ancestor_id, descendant_id=descendant_id,
+                            depth=ancestor_depth + descendant_depth + 1)
+            for ancestor_id, ancestor_depth in ancestors
+            for descendant_id, descendant_depth in subtree.items()
+        )
+
+    def ancestors(self) -> models.QuerySet:
+        """Get the ancestors of the category, from the root down to the parent."""
+        return Category.objects.filter(descendant_links__descendant=self, descendant_links__depth__gt=0) \
+                               .order_by('-descendant_links__depth')
+
+    def descendants(self) -> models.QuerySet:
+        """Get all categories nested in this one at any depth."""
+        return Category.objects.filter(ancestor_links__ancestor=self, ancestor_links__depth__gt=0)
+
+    def subtree_materials(self) -> models.QuerySet:
+        """Get the materials of this category and of all nested categories."""
+        return EduMaterial.objects.filter(category__ancestor_links__ancestor=self).distinct()
 
     def __str__(self) -> str:
         """Convert model instance to string."""
@@ -82,3 +266,87 @@ class Category(models.Model):
     def get_absolute_url(self) -> str:
         """Get the absolute url of the category."""
         return reverse('category-detail', args=[str(self.id)])
+
+
+class CategoryClosure(models.Model):
+    """A path from a category to one of its descendants. Every category is its own descendant at depth 0."""
+
+    ancestor = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        """Meta info."""
+
+        unique_together = (('ancestor', 'descendant'),)
+
+
+class CategoryUpdateEvent(models.Model):
+    """A material added to a category, waiting to be mentioned in the next notification digest."""
+
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='update_events')
+    material = models.ForeignKey(EduMaterial, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+
+class Job(models.Model):
+    """A background task stored in the database. Jobs are run by the run_worker command."""
+
+    STATUS = (
+        ('q', 'Queued'),
+        ('r', 'Running'),
+        ('d', 'Done'),
+        ('f', 'Failed'),
+    )
+    task = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=1, choices=STATUS, default='q')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        """Meta info."""
+
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='catalog_job_status_run_at_idx'),
+        ]
+
+    def __str__(self) -> str:
+        """Convert job to string."""
+        return self.task + " #" + str(self.id)
+
+
+class MetricTotal(models.Model):
+    """Total of a counter increased by processes that are not scraped, like the worker and the commands."""
+
+    name = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self) -> str:
+        """Convert metric total to string."""
+        return self.name + " = " + str(self.value)
+
+
+class MaterialText(models.Model):
+    """Terms found in the PDF file of a material, filled in by the extract_material_text job.
+
+    Only the distinct terms are kept, in sorted order: that is all the search needs
+    and much smaller than the text itself. The hash of the file lets the job skip
+    files it has already seen.
+    """
+
+    material = models.OneToOneField(EduMaterial, on_delete=models.CASCADE, primary_key=True, related_name='text')
+    content_hash = models.CharField(max_length=64)
+    page_count = models.PositiveIntegerField(default=0)
+    # space separated
+    terms = models.TextField(blank=True)
+    extracted_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        """Convert material text to string."""
+        return "Text of " + str(self.material_id)
@@ -0,0 +1,176 @@
+"""Email notifications about category updates."""
+
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.mail import EmailMessage, get_connection
+
+from . import jobs, metrics
+from .models import CategoryUpdateEvent, EduMaterial
+
+logger = logging.getLogger(__name__)
+
+
+def subscriptions_affected_by(category_ids: Iterable[int]) -> Dict[str, List[str]]:
+    """Get the names of the updated categories every subscriber follows, by email.
+
+    A user subscribed to a category is notified about updates of all nested
+    categories. Every user is listed once however many of the categories they follow.
+    """
+    rows = User.objects.filter(category__descendant_links__descendant__in=list(category_ids)) \
+                       .exclude(email="") \
+                       .values_list("email", "category__name") \
+                       .order_by("email", "category__name") \
+                       .distinct()
+
+    subscriptions = defaultdict(list)
+    for email, category_name in rows:
+        subscriptions[email].append(category_name)
+    return subscriptions
+
+
+def send_in_chunks(messages: List[EmailMessage],
+                   on_chunk_sent: Optional[Callable[[List[EmailMessage]], None]] = None) -> int:
+    """Send the messages in chunks over a single connection to the mail server, calling on_chunk_sent after each."""
+    if not messages:
+        return 0
+
+    connection = get_connection(fail_silently=False)
+    chunk_size = settings.NOTIFY_EMAIL_CHUNK_SIZE
+    sent = 0
+
+    connection.open()
+    try:
+        for start in range(0, len(messages), chunk_size):
+            chunk = messages[start:start + chunk_size]
+            sent += connection.send_messages(chunk) or 0
+            if on_chunk_sent is not None:
+                on_chunk_sent(chunk)
+    finally:
+        connection.close()
+        metrics.count_in_database(metrics.EMAILS_SENT, sent)
+    return sent
+
+
+def category_update_message(email: str, category_names: List[str], material: Optional[EduMaterial]) -> EmailMessage:
+    """Build the message telling the user that the categories were updated."""
+    names = ", ".join("'" + name + "'" for name in category_names)
+    subject = "Category " + names + " was updated" if len(category_names) == 1 \
+        else "Categories " + names + " were updated"
+    body = "The category was updated! Don't forget to check it out!"
+    if material is not None:
+        body += "\n\nNew material: " + material.title
+    return EmailMessage(subject, body, settings.NOTIFY_EMAIL_FROM, [email])
+
+
+def record_sent_until(chunk: List[EmailMessage]):
+    """Record the last recipient of the delivered chunk, a retry of the job starts after them."""
+    jobs.save_progress(sent_until=chunk[-1].to[0])
+
+
+@jobs.task("notify_category_update")
+def notify_category_update(category_ids: List[int], material_id: Optional[int] = None, sent_until: str = ""):
+    """Notify the subscribers of the categories and of all their ancestors, once per user.
+
+    The users are notified in the code point order of their email, those up to
+    sent_until were notified by an earlier attempt of the job.
+    """
+    subscriptions = subscriptions_affected_by(category_ids)
+    if not subscriptions:
+        logger.info("No users to send notifications about the category update")
+        return
+
+    material = EduMaterial.objects.filter(pk=material_id).first() if material_id is not None else None
+    # sorted by code point here, the database orders the emails by the collation of the column
+    messages = [category_update_message(email, subscriptions[email], material) for email in sorted(subscriptions)
+                if email > sent_until]
+    sent = send_in_chunks(messages, record_sent_until)
+    logger.info("Notifications about the category update sent to " + str(sent) + " users")
+
+
+def schedule_category_update(material_id: int, category_ids: List[int]):
+    """Queue the notifications about a material added to the categories.
+
+    In the digest mode the update is only recorded, it will be sent by the
+    send_digests command together with the other updates.
+    """
+    if settings.NOTIFY_MODE == "digest":
+        CategoryUpdateEvent.objects.bulk_create(
+            CategoryUpdateEvent(category_id=category_id, material_id=material_id) for category_id in category_ids
+        )
+        return
+
+    jobs.enqueue("notify_category_update", {"category_ids": category_ids, "material_id": material_id},
+                 idempotency_key="material-added-" + str(material_id))
+
+
+def schedule_bulk_update(category_materials: Dict[int, List[int]]):
+    """Queue a single notification about many materials added to the categories, e.g. by an import.
+
+    In the instant mode the subscribers get one email for all the categories
+    they follow, without the list of the materials.
+    """
+    if not category_materials:
+        return
+    if settings.NOTIFY_MODE == "digest":
+        CategoryUpdateEvent.objects.bulk_create(
+            (CategoryUpdateEvent(category_id=category_id, material_id=material_id)
+             for category_id, material_ids in category_materials.items() for material_id in material_ids),
+            batch_size=1000,
+        )
+        return
+
+    jobs.enqueue("notify_category_update", {"category_ids": sorted(category_materials)})
+
+
+def digest_subscriptions(category_materials: Dict[int, Set[int]]) -> Dict[str, List[Tuple[str, int]]]:
+    """Get the updated categories every subscriber follows with the number of new materials, by email."""
+    rows = User.objects.filter(category__descendant_links__descendant__in=list(category_materials)) \
+                       .exclude(email="") \
+                       .values_list("email", "category__name", "category__descendant_links__descendant") \
+                       .order_by("email", "category__name")
+
+    # a material added to several categories of the subtree is counted once
+    materials = defaultdict(set)
+    for email, category_name, updated_category_id in rows:
+        materials[email, category_name] |= category_materials[updated_category_id]
+
+    subscriptions = defaultdict(list)
+    for (email, category_name), material_ids in materials.items():
+        subscriptions[email].append((category_name, len(material_ids)))
+    return subscriptions
+
+
+def digest_message(email: str, categories: List[Tuple[str, int]]) -> EmailMessage:
+    """Build the digest message listing the updated categories."""
+    lines = ["'" + name + "': " + str(materials) + " new materials" for name, materials in categories]
+    body = "The categories you follow were updated! Don't forget to check them out!\n\n" + "\n".join(lines)
+    return EmailMessage("Updates of your categories", body, settings.NOTIFY_EMAIL_FROM, [email])
+
+
+def send_digests(since: datetime, until: datetime, batch_size: int = 500) -> int:
+    """Send one digest to every subscriber and forget the events it was made of.
+
+    Events recorded until the given time but committed after they were read are
+    kept for the next digest.
+    """
+    events = CategoryUpdateEvent.objects.filter(created_at__lte=until) \
+                                        .values_list("pk", "category_id", "material_id", "created_at")
+    event_ids = []
+    category_materials = defaultdict(set)
+    for pk, category_id, material_id, created_at in events:
+        event_ids.append(pk)
+        # older events are dropped without being sent
+        if created_at > since:
+            category_materials[category_id].add(material_id)
+
+    subscriptions = digest_subscriptions(category_materials)
+    sent = send_in_chunks([digest_message(email, categories) for email, categories in subscriptions.items()])
+    for start in range(0, len(event_ids), batch_size):
+        CategoryUpdateEvent.objects.filter(pk__in=event_ids[start:start + batch_size]).delete()
+    logger.info("Digests sent to " + str(sent) + " users")
+    return sent
@@ -0,0 +1,206 @@
+"""Keyset (cursor) pagination.
+
+A page is located by the ordering key of the last row of the previous page, not
+by an offset, so every page costs the same as the first one and no COUNT is run.
+The key is passed between pages as an opaque url-safe token.
+"""
+
+import base64
+import binascii
+import json
+import math
+from typing import Iterable, List, Optional, Tuple
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.http import Http404, QueryDict
+from django.utils.functional import cached_property
+
+
+class InvalidCursor(ValueError):
+    """The cursor token cannot be decoded."""
+
+
+def encode_cursor(key: Tuple) -> str:
+    """Encode an ordering key as an opaque token."""
+    data = json.dumps(list(key), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(token: str, key_length: int) -> Tuple:
+    """Decode a token made by encode_cursor."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(token)
+
+    if not isinstance(key, list) or len(key) != key_length or not all(map(is_key_value, key)):
+        raise InvalidCursor(token)
+    return tuple(key)
+
+
+def is_key_value(value) -> bool:
+    """Check if the value may be part of an ordering key: a string, a 64-bit integer or a finite float."""
+    if isinstance(value, float):
+        return math.isfinite(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return -2 ** 63 <= value < 2 ** 63
+    return isinstance(value, str)
+
+
+class QuerySetSource:
+    """Rows of a queryset in a stable order given by unique ordering fields."""
+
+    def __init__(self, queryset: QuerySet, ordering: Iterable[str]):
+        """Remember the queryset and the ordering, the last field must be unique."""
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+
+    @property
+    def key_length(self) -> int:
+        """Get the number of values in the ordering key."""
+        return len(self.ordering)
+
+    def key(self, obj) -> Tuple:
+        """Get the ordering key of the row."""
+        return tuple(getattr(obj, field.lstrip("-")) for field in self.ordering)
+
+    def parse_key(self, key: Tuple) -> Tuple:
+        """Convert the values of a decoded key to the ordering fields, InvalidCursor if they do not fit."""
+        opts = self.queryset.model._meta
+        values = []
+        for field_name, value in zip(self.ordering, key):
+            name = field_name.lstrip("-")
+            field = opts.pk if name == "pk" else opts.get_field(name)
+            try:
+                value = field.to_python(value)
+                field.run_validators(value)
+            except (ValidationError, OverflowError):
+                raise InvalidCursor(value)
+            values.append(value)
+        return tuple(values)
+
+    def _after(self, key: Tuple) -> Q:
+        """Build the filter selecting the rows after the key."""
+        condition = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, key):
+            name = field.lstrip("-")
+            lookup = "__lt" if field.startswith("-") else "__gt"
+            condition |= equal & Q(**{name + lookup: value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def fetch(self, after: Optional[Tuple], limit: int) -> List:
+        """Get at most limit rows following the key."""
+        queryset = self.queryset.order_by(*self.ordering)
+        if after is not None:
+            queryset = queryset.filter(self._after(after))
+        return list(queryset[:limit])
+
+
+class KeysetPage:
+    """A page of rows. The rows are fetched on first access."""
+
+    def __init__(self, paginator: "KeysetPaginator", after: Optional[Tuple], query: Optional[QueryDict] = None):
+        """Remember where the page starts and the query string it was requested with."""
+        self.paginator = paginator
+        self.after = after
+        self.query = query if query is not None else QueryDict()
+
+    @cached_property
+    def _rows(self) -> List:
+        # one extra row tells whether there is a next page
+        return self.paginator.source.fetch(self.after, self.paginator.per_page + 1)
+
+    @property
+    def object_list(self) -> List:
+        """Get the rows of the page."""
+        return self._rows[:self.paginator.per_page]
+
+    def has_next(self) -> bool:
+        """Check if there are rows after this page."""
+        return len(self._rows) > self.paginator.per_page
+
+    def has_previous(self) -> bool:
+        """Check if this is not the first page."""
+        return self.after is not None
+
+    @property
+    def next_cursor(self) -> Optional[str]:
+        """Get the token of the next page."""
+        if not self.has_next():
+            return None
+        return encode_cursor(self.paginator.source.key(self.object_list[-1]))
+
+    @property
+    def next_query_string(self) -> Optional[str]:
+        """Get the query string of the next page, keeping the other parameters."""
+        if not self.has_next():
+            return None
+        query = self.query.copy()
+        query[self.paginator.cursor_kwarg] = self.next_cursor
+        return query.urlencode()
+
+    def __iter__(self):
+        """Iterate over the rows of the page."""
+        return iter(self.object_list)
+
+    def __len__(self) -> int:
+        """Get the number of rows on the page."""
+        return len(self.object_list)
+
+    def __bool__(self) -> bool:
+        """Check if the page has any rows."""
+        return bool(self.object_list)
+
+
+class KeysetPaginator:
+    """Split a row source into pages of per_page rows.
+
+    A source has a ``fetch(after, limit)`` method returning the rows following an
+    ordering key, a ``key(row)`` method, a ``parse_key(key)`` method checking a
+    decoded key and a ``key_length`` attribute.
+    """
+
+    cursor_kwarg = "after"
+
+    def __init__(self, source, per_page: int):
+        """Remember the source and the page size."""
+        self.source = source
+        self.per_page = per_page
+
+    def page(self, cursor: Optional[str], query: Optional[QueryDict] = None) -> KeysetPage:
+        """Get the page following the cursor, or the first page."""
+        after = self.source.parse_key(decode_cursor(cursor, self.source.key_length)) if cursor else None
+        return KeysetPage(self, after, query)
+
+
+class KeysetPaginationMixin:
+    """Keyset pagination for views.
+
+    List views get it in place of the page number pagination. Querysets are
+    ordered by keyset_ordering, the last field of which must be unique.
+    """
+
+    keyset_ordering = ("-pk",)
+
+    def page_query(self) -> QueryDict:
+        """Get the query parameters kept in the links to the other pages."""
+        return self.request.GET
+
+    def keyset_page(self, source, per_page: int) -> KeysetPage:
+        """Get the page of the source requested by the cursor in the query string."""
+        paginator = KeysetPaginator(source, per_page)
+        try:
+            return paginator.page(self.request.GET.get(paginator.cursor_kwarg), self.page_query())
+        except InvalidCursor:
+            raise Http404("Invalid page cursor")
+
+    def paginate_queryset(self, queryset, page_size: int) -> tuple:
+        """Paginate the queryset or row source by the cursor."""
+        if isinstance(queryset, QuerySet):
+            queryset = QuerySetSource(queryset, self.keyset_ordering)
+        page = self.keyset_page(queryset, page_size)
+        return page.paginator, page, page, True
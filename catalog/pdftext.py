@@ -0,0 +1,39 @@
+"""Text extraction from PDF files, run in worker processes of catalog.extraction.
+
+Nothing here touches the database or the models, so the functions can run in a
+process that has not set Django up.
+"""
+
+import hashlib
+from typing import Tuple
+
+from .terms import tokenize
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path: str) -> str:
+    """Hash the file in chunks, without reading it into memory."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract_terms(path: str, max_terms: int) -> Tuple[str, int]:
+    """Get the distinct terms of the text of the PDF file, space separated and sorted, and its page count.
+
+    The reader parses the pages on demand and the text of a page is dropped
+    once its terms are taken, so only the set of terms grows with the file.
+    """
+    from pypdf import PdfReader
+
+    terms = set()
+    page_count = 0
+    with open(path, "rb") as fh:
+        for page in PdfReader(fh).pages:
+            page_count += 1
+            if len(terms) < max_terms:
+                terms.update(tokenize(page.extract_text()))
+    return " ".join(sorted(terms)[:max_terms]), page_count
@@ -0,0 +1,221 @@
+"""Routing of the catalog reads to the read replicas.
+
+The reads of the catalog models made by the read views go to a replica, chosen
+once per request among those whose replication lag is at most REPLICA_MAX_LAG.
+The lag of every replica is checked at most once per REPLICA_LAG_CHECK_INTERVAL,
+and when none is fresh enough the reads go to the primary. After a write to the
+catalog the rest of the request and the requests of the next
+REPLICA_STICKY_SECONDS read from the primary, so the user always sees their own
+changes. Streamed responses read after the middleware is done, so their views
+choose the database themselves with choose_replica.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+import types
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError, connections
+from django.http import HttpRequest, HttpResponse
+from logmiddleware import metrics
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = "default"
+
+STICKY_COOKIE = "read_primary_until"
+
+# urls whose catalog reads may be served by a replica
+REPLICA_URL_NAMES = {
+    "category-list", "category-detail", "edumaterial-detail", "edumaterial-file", "author-list", "author-detail",
+    "search-material", "autocomplete",
+}
+
+LAG_QUERY = """
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+
+
+class RequestState:
+    """The database the catalog reads of a request go to, and whether it wrote to the catalog."""
+
+    def __init__(self):
+        """Start with the reads on the primary and no write."""
+        self.read_alias: Optional[str] = None
+        self.wrote = False
+
+
+_request_state: ContextVar = ContextVar("replica_request_state", default=None)
+
+# (checked at, lag in seconds) by replica alias, shared by the threads of the process
+_lags: Dict[str, Tuple[float, float]] = {}
+_lags_lock = threading.Lock()
+
+
+def replica_lag(alias: str) -> float:
+    """Query the replication lag of the replica in seconds, infinite if it cannot be reached."""
+    connection = connections[alias]
+    if connection.vendor != "postgresql":
+        return 0.0
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LAG_QUERY)
+            lag = cursor.fetchone()[0]
+    except DatabaseError as e:
+        logger.error("cannot check the lag of replica " + alias + ": " + str(e))
+        connection.close()
+        return float("inf")
+    # NULL when the database is not replaying, i.e. not a replica at all
+    return float(lag or 0)
+
+
+def current_lag(alias: str) -> float:
+    """Get the lag of the replica, checking it again if the last check is too old."""
+    now = time.monotonic()
+    checked_at, lag = _lags.get(alias, (float("-inf"), 0.0))
+    if now - checked_at < settings.REPLICA_LAG_CHECK_INTERVAL:
+        return lag
+    with _lags_lock:
+        # only one thread checks, the others use the last known lag meanwhile
+        checked_at, lag = _lags.get(alias, (float("-inf"), 0.0))
+        _lags[alias] = (now, lag)
+    if now - checked_at < settings.REPLICA_LAG_CHECK_INTERVAL:
+        return lag
+
+    lag = replica_lag(alias)
+    _lags[alias] = (time.monotonic(), lag)
+    if lag > settings.REPLICA_MAX_LAG:
+        logger.warning("replica " + alias + " is " + str(lag) + " s behind, reading from the primary")
+        metrics.DB_REPLICA_SKIPPED.inc(alias=alias)
+    return lag
+
+
+def lags_are_known() -> bool:
+    """Whether the lags of all the replicas were checked recently enough to choose without a query."""
+    now = time.monotonic()
+    return all(now - _lags.get(alias, (float("-inf"), 0.0))[0] < settings.REPLICA_LAG_CHECK_INTERVAL
+               for alias in settings.DATABASE_REPLICAS)
+
+
+def choose_replica() -> str:
+    """Get a replica that is fresh enough, or the primary if there is none."""
+    fresh = [alias for alias in settings.DATABASE_REPLICAS if current_lag(alias) <= settings.REPLICA_MAX_LAG]
+    return random.choice(fresh) if fresh else PRIMARY
+
+
+def replica_reads_enabled() -> bool:
+    """Whether the catalog reads of the current request go to a replica chosen for it."""
+    state = _request_state.get()
+    return state is not None and state.read_alias is not None
+
+
+class ReplicaRouter:
+    """Send the catalog reads of the read views to a replica and everything else to the primary."""
+
+    def db_for_read(self, model, **hints) -> Optional[str]:
+        """Send the reads of the catalog models in the read views to the replica chosen for the request."""
+        state = _request_state.get()
+        if model._meta.app_label != "catalog" or state is None:
+            return None
+        return state.read_alias
+
+    def db_for_write(self, model, **hints) -> str:
+        """Always write to the primary, and read from it after a write to the catalog."""
+        state = _request_state.get()
+        if state is not None and model._meta.app_label == "catalog":
+            state.wrote = True
+            state.read_alias = None
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints) -> bool:
+        """The replicas have the same data as the primary."""
+        return True
+
+    def allow_migrate(self, db: str, app_label: str, model_name: Optional[str] = None, **hints) -> bool:
+        """Only migrate the primary, the replicas follow it."""
+        return db == PRIMARY
+
+
+class ReplicaMiddleware:
+    """Enables the replica reads in the read views, and keeps the user on the primary for a while after a write.
+
+    Works in both sync and async handler chains.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response: types.FunctionType):
+        """Init self.get_response with a function to get the response."""
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # mark the instance as a coroutine function, like django.utils.deprecation.MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            # the handler would run a sync process_view in a thread
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        """Reset the replica reads after the request and make the user sticky after a successful write."""
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        state = RequestState()
+        token = _request_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_state.reset(token)
+        return self.make_sticky(state, response)
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        """Reset the replica reads after the request of the async handler chain and make the user sticky."""
+        state = RequestState()
+        token = _request_state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_state.reset(token)
+        return self.make_sticky(state, response)
+
+    @staticmethod
+    def make_sticky(state: RequestState, response: HttpResponse) -> HttpResponse:
+        """Keep the user on the primary for a while after a successful write, whatever the method of the request."""
+        if state.wrote and response.status_code < 400:
+            response.set_cookie(STICKY_COOKIE, str(int(time.time() + settings.REPLICA_STICKY_SECONDS)),
+                                max_age=settings.REPLICA_STICKY_SECONDS, httponly=True, samesite="Lax")
+        return response
+
+    @staticmethod
+    def reads_from_replica(request: HttpRequest) -> bool:
+        """Whether the view only reads and the user has not written recently."""
+        if request.method not in ("GET", "HEAD") or request.resolver_match.url_name not in REPLICA_URL_NAMES:
+            return False
+        sticky_until = request.COOKIES.get(STICKY_COOKIE, "")
+        return not (sticky_until.isdigit() and int(sticky_until) > time.time())
+
+    def process_view(self, request: HttpRequest, view_func, view_args, view_kwargs):
+        """Choose the replica of the request if the view only reads and the user has not written recently."""
+        state = _request_state.get()
+        if state is not None and self.reads_from_replica(request):
+            state.read_alias = choose_replica()
+        return None
+
+    async def aprocess_view(self, request: HttpRequest, view_func, view_args, view_kwargs):
+        """Choose the replica like process_view, in the task of the request unless a lag has to be checked."""
+        state = _request_state.get()
+        if state is not None and self.reads_from_replica(request):
+            if lags_are_known():
+                state.read_alias = choose_replica()
+            else:
+                state.read_alias = await sync_to_async(choose_replica)()
+        return None
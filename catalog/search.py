@@ -0,0 +1,299 @@
+"""Full-text search over educational materials.
+
+On PostgreSQL the search is served by the ``EduMaterial.search_vector`` tsvector
+column and its GIN index. Other databases (SQLite in tests and local development)
+fall back to an in-process inverted index built from the same fields.
+"""
+
+import bisect
+import hashlib
+import threading
+from array import array
+from collections import defaultdict
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Concat
+
+from . import fragments
+from .changelog import ChangeLog
+from .models import Author, EduMaterial, MaterialText
+from .pagination import InvalidCursor
+from .terms import tokenize
+
+SEARCH_CONFIG = "simple"
+
+TITLE_WEIGHT = 1.0
+AUTHOR_WEIGHT = 1.0
+SUMMARY_WEIGHT = 0.4
+# terms found in the PDF file
+CONTENT_WEIGHT = 0.1
+
+
+class RankedIdSource:
+    """Materials given by parallel id and rank sequences, best first, as a keyset pagination source."""
+
+    key_length = 2
+
+    def __init__(self, ids: Sequence[int], ranks: Sequence[float], cache_key: Optional[str] = None):
+        """Remember the ranked ids and the cache key they are stored under, if any."""
+        self.ids = ids
+        self.ranks = ranks
+        self.cache_key = cache_key
+
+    @classmethod
+    def from_pairs(cls, ranked: List[Tuple[float, int]]) -> "RankedIdSource":
+        """Make the source from (rank, id) pairs."""
+        return cls(array("q", (pk for _, pk in ranked)), array("d", (rank for rank, _ in ranked)))
+
+    def key(self, material: EduMaterial) -> Tuple[float, int]:
+        """Get the ordering key of the material."""
+        return material.rank, material.pk
+
+    def parse_key(self, key: Tuple) -> Tuple[float, int]:
+        """Check that the decoded key is a rank and an id."""
+        rank, pk = key
+        if not isinstance(rank, (int, float)) or not isinstance(pk, int):
+            raise InvalidCursor(key)
+        return float(rank), pk
+
+    def fetch(self, after: Optional[Tuple[float, int]], limit: int) -> List[EduMaterial]:
+        """Load at most limit materials ranked below the key."""
+        start, end = 0, len(self.ids)
+        if after is not None:
+            while start < end:
+                middle = (start + end) // 2
+                if (self.ranks[middle], self.ids[middle]) < after:
+                    end = middle
+                else:
+                    start = middle + 1
+
+        ids = self.ids[start:start + limit]
+        ranks = self.ranks[start:start + limit]
+        materials = EduMaterial.objects.select_related("author").in_bulk(list(ids))
+        page = []
+        for pk, rank in zip(ids, ranks):
+            if pk in materials:
+                materials[pk].rank = rank
+                page.append(materials[pk])
+        return page
+
+
+class PostgresSearchBackend:
+    """Search backed by the tsvector column of the material."""
+
+    name = "postgres"
+
+    def ranked_ids(self, usr_query: str) -> List[Tuple[float, int]]:
+        """Get (rank, id) pairs of the best SEARCH_MAX_RESULTS materials matching all terms, best first."""
+        tokens = tokenize(usr_query)
+        if not tokens:
+            return []
+
+        query = SearchQuery(" & ".join(token + ":*" for token in tokens),
+                            search_type="raw", config=SEARCH_CONFIG)
+        return list(EduMaterial.objects.filter(search_vector=query)
+                                       .annotate(rank=SearchRank(F("search_vector"), query))
+                                       .order_by("-rank", "-pk")
+                                       .values_list("rank", "pk")[:settings.SEARCH_MAX_RESULTS])
+
+    def search(self, usr_query: str) -> RankedIdSource:
+        """Get the matching materials, best first."""
+        return RankedIdSource.from_pairs(self.ranked_ids(usr_query))
+
+    def index_materials(self, material_ids: Iterable[int]):
+        """Recompute the search vector of the materials."""
+        author_name = Subquery(Author.objects.filter(pk=OuterRef("author_id"))
+                                             .annotate(full_name=Concat("first_name", Value(" "), "last_name"))
+                                             .values("full_name")[:1])
+        content_terms = Subquery(MaterialText.objects.filter(material_id=OuterRef("pk")).values("terms")[:1])
+        vector = SearchVector("title", weight="A", config=SEARCH_CONFIG) + \
+                 SearchVector(author_name, weight="A", config=SEARCH_CONFIG) + \
+                 SearchVector("summary", weight="B", config=SEARCH_CONFIG) + \
+                 SearchVector(Coalesce(content_terms, Value("")), weight="D", config=SEARCH_CONFIG)
+        EduMaterial.objects.filter(pk__in=list(material_ids)).update(search_vector=vector)
+
+    def remove_materials(self, material_ids: Iterable[int]):
+        """Nothing to do: the vector is deleted together with the row."""
+
+
+class InvertedIndexBackend:
+    """Search backed by an in-process inverted index.
+
+    The index maps every term to the materials containing it. Terms are also kept
+    in a sorted list, so a query term matches every indexed term it is a prefix of.
+    The index is built lazily from the database on the first search. The ids of
+    the materials indexed again are appended to a catalog.changelog log, and the
+    index of every process loads those materials again before a search.
+    """
+
+    name = "inverted_index"
+
+    def __init__(self):
+        """Create an empty, not yet built index."""
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Drop the index. It will be rebuilt from the database on the next search."""
+        with self._lock:
+            self._postings = defaultdict(dict)
+            self._documents = {}
+            self._terms = []
+            self._sequence: Optional[int] = None
+
+    def _ensure_current(self):
+        sequence = index_changes.current()
+        if sequence == self._sequence:
+            return
+        missed = index_changes.since(self._sequence, sequence)
+        if missed is not None:
+            self._reindex({pk for material_ids in missed for pk in material_ids})
+            self._sequence = sequence
+            return
+
+        self.reset()
+        rows = EduMaterial.objects.values_list("pk", "title", "summary",
+                                               "author__first_name", "author__last_name", "text__terms")
+        for row in rows.iterator(chunk_size=2000):
+            self._add(*row)
+        self._terms = sorted(self._postings)
+        # the changes made while loading are replayed on the next search, loading a material twice does nothing
+        self._sequence = sequence
+
+    def _add(self, pk: int, title: str, summary: str, first_name: str, last_name: str,
+             content_terms: Optional[str]):
+        weights = dict.fromkeys((content_terms or "").split(), CONTENT_WEIGHT)
+        for term in tokenize(summary):
+            weights[term] = SUMMARY_WEIGHT
+        for term in tokenize(first_name) + tokenize(last_name):
+            weights[term] = max(weights.get(term, 0), AUTHOR_WEIGHT)
+        for term in tokenize(title):
+            weights[term] = max(weights.get(term, 0), TITLE_WEIGHT)
+
+        for term, weight in weights.items():
+            if term not in self._postings and self._sequence is not None:
+                bisect.insort(self._terms, term)
+            self._postings[term][pk] = weight
+        self._documents[pk] = tuple(weights)
+
+    def _discard(self, pk: int):
+        for term in self._documents.pop(pk, ()):
+            postings = self._postings[term]
+            postings.pop(pk, None)
+            if not postings:
+                del self._postings[term]
+                index = bisect.bisect_left(self._terms, term)
+                del self._terms[index]
+
+    def _reindex(self, material_ids: Iterable[int]):
+        # the materials that are not found were deleted
+        material_ids = list(material_ids)
+        for pk in material_ids:
+            self._discard(pk)
+        for batch_start in range(0, len(material_ids), 500):
+            rows = EduMaterial.objects.filter(pk__in=material_ids[batch_start:batch_start + 500]) \
+                                      .values_list("pk", "title", "summary",
+                                                   "author__first_name", "author__last_name", "text__terms")
+            for row in rows:
+                self._add(*row)
+
+    def index_materials(self, material_ids: Iterable[int]):
+        """Add the materials to the index of every process or refresh them."""
+        material_ids = list(material_ids)
+        if not material_ids:
+            return
+        index_changes.publish([material_ids])
+        with self._lock:
+            # this process sees its own changes at once, the log replays them in order with the others
+            if self._sequence is not None:
+                self._reindex(material_ids)
+
+    def remove_materials(self, material_ids: Iterable[int]):
+        """Remove the materials from the index of every process."""
+        self.index_materials(material_ids)
+
+    def _matches(self, token: str) -> dict:
+        """Get the best weight of every material containing a term starting with the token."""
+        matches = {}
+        index = bisect.bisect_left(self._terms, token)
+        while index < len(self._terms) and self._terms[index].startswith(token):
+            for pk, weight in self._postings[self._terms[index]].items():
+                if weight > matches.get(pk, 0):
+                    matches[pk] = weight
+            index += 1
+        return matches
+
+    def ranked_ids(self, usr_query: str) -> List[Tuple[float, int]]:
+        """Get (rank, id) pairs of the best SEARCH_MAX_RESULTS materials matching all terms, best first."""
+        tokens = tokenize(usr_query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            self._ensure_current()
+            # start from the rarest term to keep the intersection small
+            matches = sorted((self._matches(token) for token in set(tokens)), key=len)
+
+        ranks = dict(matches[0])
+        for token_matches in matches[1:]:
+            ranks = {pk: rank + token_matches[pk] for pk, rank in ranks.items() if pk in token_matches}
+
+        return sorted(((rank, pk) for pk, rank in ranks.items()), reverse=True)[:settings.SEARCH_MAX_RESULTS]
+
+    def search(self, usr_query: str) -> RankedIdSource:
+        """Get the matching materials, best first."""
+        return RankedIdSource.from_pairs(self.ranked_ids(usr_query))
+
+
+index_changes = ChangeLog("search")
+
+postgres_backend = PostgresSearchBackend()
+inverted_index = InvertedIndexBackend()
+
+
+def get_backend():
+    """Get the search backend for the database in use."""
+    if connection.vendor == "postgresql":
+        return postgres_backend
+    return inverted_index
+
+
+def normalize_query(usr_query: str) -> str:
+    """Get the canonical form of the query: the order and repetition of the terms do not change the results."""
+    return " ".join(sorted(set(tokenize(usr_query))))
+
+
+def result_cache_key(normalized_query: str) -> str:
+    """Get the cache key of the results of the query for the current materials and authors."""
+    version = fragments.get_version((EduMaterial, Author))
+    return "catalog:search:" + version + ":" + hashlib.sha1(normalized_query.encode()).hexdigest()
+
+
+def search_materials(usr_query: str) -> RankedIdSource:
+    """Get the materials matching the query, best first, as a keyset pagination source.
+
+    The ranked ids are cached as packed arrays. Saving or deleting any material or
+    author bumps the version in the cache key, so cached results never go stale.
+    """
+    normalized_query = normalize_query(usr_query)
+    if not normalized_query:
+        return RankedIdSource(array("q"), array("d"))
+
+    key = result_cache_key(normalized_query)
+    cached = cache.get(key)
+    if cached is not None:
+        ids, ranks = array("q"), array("d")
+        ids.frombytes(cached[0])
+        ranks.frombytes(cached[1])
+        return RankedIdSource(ids, ranks, key)
+
+    source = get_backend().search(normalized_query)
+    cache.set(key, (source.ids.tobytes(), source.ranks.tobytes()), settings.SEARCH_CACHE_TIMEOUT)
+    source.cache_key = key
+    return source
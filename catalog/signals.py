@@ -0,0 +1,207 @@
+"""Signal handlers of the catalog app."""
+
+from collections import Counter
+from typing import List, Optional
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
+from django.dispatch import receiver
+
+from . import autocomplete, counters, fragments, search
+from .models import Author, Category, EduMaterial
+
+
+def index_on_commit(material_ids: List[int]):
+    """Update the search index of the materials once the transaction changing them is committed."""
+    if material_ids:
+        transaction.on_commit(lambda: search.get_backend().index_materials(material_ids))
+
+
+@receiver(post_save, sender=EduMaterial)
+def index_material(sender, instance: EduMaterial, **kwargs):
+    """Update the search index after a material is saved."""
+    index_on_commit([instance.pk])
+
+
+@receiver(post_delete, sender=EduMaterial)
+def unindex_material(sender, instance: EduMaterial, **kwargs):
+    """Remove a deleted material from the search index."""
+    material_ids = [instance.pk]
+    transaction.on_commit(lambda: search.get_backend().remove_materials(material_ids))
+
+
+@receiver(post_save, sender=Author)
+def reindex_author_materials(sender, instance: Author, **kwargs):
+    """Update the search index of the author's materials, the author name is indexed too."""
+    index_on_commit(list(instance.edumaterial_set.values_list("pk", flat=True)))
+
+
+@receiver(pre_delete, sender=Author)
+def remember_author_materials(sender, instance: Author, **kwargs):
+    """Remember the materials of the author before they lose their author."""
+    instance.search_material_ids = list(instance.edumaterial_set.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Author)
+def reindex_orphaned_materials(sender, instance: Author, **kwargs):
+    """Update the search index of the materials of a deleted author."""
+    index_on_commit(getattr(instance, "search_material_ids", []))
+
+
+@receiver(post_save, sender=EduMaterial)
+@receiver(post_delete, sender=EduMaterial)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+def bump_fragment_version(sender, **kwargs):
+    """Make the cached fragments showing the changed model stale."""
+    fragments.bump_version(sender)
+
+
+@receiver(m2m_changed, sender=EduMaterial.category.through)
+def bump_material_fragment_version(sender, action: str, **kwargs):
+    """Make the cached fragments stale when materials are moved between categories."""
+    if action.startswith("post_"):
+        fragments.bump_version(EduMaterial)
+
+
+def update_suggestion_on_commit(item: autocomplete.Item, label: Optional[str]):
+    """Update the autocomplete index once the transaction is committed, after the versions are bumped."""
+    transaction.on_commit(lambda: autocomplete.prefix_index.update(item, label))
+
+
+@receiver(post_save, sender=EduMaterial)
+def update_material_suggestion(sender, instance: EduMaterial, **kwargs):
+    """Update the title in the autocomplete index."""
+    update_suggestion_on_commit(("material", instance.pk), instance.title)
+
+
+@receiver(post_save, sender=Author)
+def update_author_suggestion(sender, instance: Author, **kwargs):
+    """Update the author name in the autocomplete index."""
+    update_suggestion_on_commit(("author", instance.pk), instance.first_name + " " + instance.last_name)
+
+
+@receiver(post_save, sender=Category)
+def update_category_suggestion(sender, instance: Category, **kwargs):
+    """Update the category name in the autocomplete index."""
+    update_suggestion_on_commit(("category", instance.pk), instance.name)
+
+
+@receiver(post_delete, sender=EduMaterial)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Category)
+def remove_suggestion(sender, instance, **kwargs):
+    """Remove the deleted object from the autocomplete index."""
+    kind = {EduMaterial: "material", Author: "author", Category: "category"}[sender]
+    update_suggestion_on_commit((kind, instance.pk), None)
+
+
+@receiver(post_save, sender=EduMaterial)
+def count_author_material(sender, instance: EduMaterial, created: bool, **kwargs):
+    """Count the material for its author, and uncount it for the previous one."""
+    if "author_id" not in instance.__dict__:
+        # deferred and never set, the author did not change
+        return
+    if not created and not hasattr(instance, "_loaded_author_id"):
+        # loaded without its author, the one it had is unknown and the counters are left to `manage.py recount`
+        instance._loaded_author_id = instance.author_id
+        return
+
+    previous = None if created else instance._loaded_author_id
+    if previous != instance.author_id:
+        deltas = Counter()
+        if previous is not None:
+            deltas[previous] -= 1
+        if instance.author_id is not None:
+            deltas[instance.author_id] += 1
+        counters.authors_changed(deltas)
+    instance._loaded_author_id = instance.author_id
+
+
+@receiver(pre_delete, sender=EduMaterial)
+def remember_material_categories(sender, instance: EduMaterial, **kwargs):
+    """Remember the categories of the material, their links are deleted without m2m_changed."""
+    instance.counter_category_ids = counters.material_categories([instance.pk])[instance.pk]
+
+
+@receiver(post_delete, sender=EduMaterial)
+def uncount_material(sender, instance: EduMaterial, **kwargs):
+    """Uncount the deleted material in its categories and for its author."""
+    counters.categories_changed({instance.pk: (getattr(instance, "counter_category_ids", set()), set())})
+    if instance.author_id is not None:
+        counters.authors_changed(Counter({instance.author_id: -1}))
+
+
+@receiver(m2m_changed, sender=EduMaterial.category.through)
+def count_category_materials(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    """Count the materials added to or removed from categories, from either side of the relation."""
+    if action in ("pre_add", "pre_remove", "pre_clear"):
+        if not reverse:
+            material_ids = [instance.pk]
+        elif pk_set is not None:
+            material_ids = pk_set
+        else:
+            material_ids = list(instance.edumaterial_set.values_list("pk", flat=True))
+        instance.counter_categories_before = counters.material_categories(material_ids)
+    elif action in ("post_add", "post_remove", "post_clear"):
+        before = instance.__dict__.pop("counter_categories_before", {})
+        after = counters.material_categories(before)
+        counters.categories_changed({pk: (before[pk], after[pk]) for pk in before})
+
+
+def category_subscriptions(instance, reverse: bool, pk_set) -> Counter:
+    """Count the subscriptions of the changed categories, only to the given objects of the other side if any."""
+    through = Category.users_subscribed.through
+    if not reverse:
+        subscriptions = through.objects.filter(category_id=instance.pk)
+        if pk_set is not None:
+            subscriptions = subscriptions.filter(user_id__in=pk_set)
+        return Counter({instance.pk: subscriptions.count()})
+    subscriptions = through.objects.filter(user_id=instance.pk)
+    if pk_set is not None:
+        subscriptions = subscriptions.filter(category_id__in=pk_set)
+    return Counter(subscriptions.values_list("category_id", flat=True))
+
+
+@receiver(m2m_changed, sender=Category.users_subscribed.through)
+def count_subscribers(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    """Count the users subscribing to or unsubscribing from categories, from either side of the relation."""
+    if action in ("pre_add", "pre_remove", "pre_clear"):
+        # the given ids may include objects that were not (or already) linked, so compare the links themselves
+        pk_set = set(pk_set) if pk_set is not None else None
+        instance.counter_subscriptions_before = (pk_set, category_subscriptions(instance, reverse, pk_set))
+    elif action in ("post_add", "post_remove", "post_clear"):
+        pk_set, before = instance.__dict__.pop("counter_subscriptions_before", (set(), Counter()))
+        deltas = category_subscriptions(instance, reverse, pk_set)
+        deltas.subtract(before)
+        counters.subscribers_changed(deltas)
+
+
+@receiver(pre_delete, sender=User)
+def remember_subscriptions(sender, instance: User, **kwargs):
+    """Remember the categories the user is subscribed to, the subscriptions are deleted without m2m_changed."""
+    instance.counter_subscribed_ids = list(instance.category_set.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=User)
+def uncount_subscriber(sender, instance: User, **kwargs):
+    """Uncount the deleted user in the categories they were subscribed to."""
+    counters.subscribers_changed(Counter({pk: -1 for pk in getattr(instance, "counter_subscribed_ids", [])}))
+
+
+@receiver(pre_delete, sender=Category)
+def remember_category_ancestors(sender, instance: Category, **kwargs):
+    """Remember the ancestors of the category before its paths are deleted."""
+    instance.counter_ancestor_ids = list(instance.ancestors().values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Category)
+def recount_category_ancestors(sender, instance: Category, **kwargs):
+    """Recount the ancestors of a deleted category, they lost a subcategory and maybe materials."""
+    ancestor_ids = getattr(instance, "counter_ancestor_ids", [])
+    if ancestor_ids:
+        Category.objects.filter(pk__in=ancestor_ids).recount()
@@ -0,0 +1,52 @@
+"""File storages that can hand out short-lived signed download urls.
+
+With PDF_DELIVERY set to 'signed' MaterialFileView only checks the permissions
+and redirects to such a url, so the file bytes never pass through the app.
+"""
+
+import os
+import time
+from urllib.parse import urlencode
+
+import cloudinary.utils
+from cloudinary_storage.storage import MediaCloudinaryStorage
+from django.core.files.storage import FileSystemStorage
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+SIGNATURE_SALT = "catalog.storage.SignedFileSystemStorage"
+
+
+class SignedMediaCloudinaryStorage(MediaCloudinaryStorage):
+    """Cloudinary storage with expiring, signed download urls of the Cloudinary API."""
+
+    def signed_url(self, name: str, expires_in: int) -> str:
+        """Get a url to download the file, valid for expires_in seconds."""
+        public_id, extension = os.path.splitext(self._prepend_prefix(name))
+        return cloudinary.utils.private_download_url(public_id, extension.lstrip("."),
+                                                     resource_type=self._get_resource_type(name),
+                                                     type="upload",
+                                                     expires_at=int(time.time()) + expires_in)
+
+
+class SignedFileSystemStorage(FileSystemStorage):
+    """Local storage with HMAC-signed download urls served by SignedFileView. Meant for development and tests."""
+
+    @staticmethod
+    def signature(name: str, expires: int) -> str:
+        """Sign the file name together with the expiry time."""
+        return salted_hmac(SIGNATURE_SALT, name + ":" + str(expires), algorithm="sha256").hexdigest()
+
+    def signed_url(self, name: str, expires_in: int) -> str:
+        """Get a url to download the file, valid for expires_in seconds."""
+        expires = int(time.time()) + expires_in
+        query = urlencode({"expires": expires, "signature": self.signature(name, expires)})
+        return reverse("signed-file", args=[name]) + "?" + query
+
+    def verify(self, name: str, expires: str, signature: str) -> bool:
+        """Check that the url of the file was signed by us and has not expired."""
+        try:
+            expires = int(expires)
+        except (TypeError, ValueError):
+            return False
+        return expires >= time.time() and constant_time_compare(signature or "", self.signature(name, expires))
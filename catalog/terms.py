@@ -0,0 +1,12 @@
+"""Splitting text into search terms. Kept free of model imports, so extraction processes can use it."""
+
+import re
+import unicodedata
+from typing import List
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Split the text into lowercase search terms."""
+    return TOKEN_RE.findall(unicodedata.normalize("NFKC", text or "").casefold())
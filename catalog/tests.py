@@ -1,9 +1,69 @@
-from django.contrib.auth.models import Group, Permission, User
+import asyncio
+import csv
+import gzip
+import importlib.util
+import json
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from datetime import timedelta
+from io import StringIO
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, Group, Permission, User
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
 from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
 from django.shortcuts import reverse
-from django.test import TestCase
-
-from . import forms, models
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from django.utils.http import http_date
+from edu_catalog import handlers
+from edu_catalog.pooled_postgresql import base as pooled_postgresql
+from logmiddleware import metrics
+from psycopg2 import extensions as psycopg2_extensions
+
+from . import cache as catalog_cache
+from . import metrics as catalog_metrics
+from . import (async_views, autocomplete, export, extraction, facets, files,
+               forms, fragments, jobs, models, notifications, pagination,
+               pdftext, replicas, search)
+from .storage import SignedFileSystemStorage
+
+# the tests clear the cache, so they must never use the shared one of the deployment
+TEST_CACHES = {
+    "default": {
+        "BACKEND": "catalog.cache.TwoTierCache",
+        "OPTIONS": {"L2": "shared", "GENERATION_CHECK_INTERVAL": 0},
+    },
+    "shared": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "catalog-tests",
+    },
+}
+
+test_caches = override_settings(CACHES=TEST_CACHES)
+
+
+def setUpModule():
+    test_caches.enable()
+
+
+def tearDownModule():
+    test_caches.disable()
 
 
 class AuthorModelTest(TestCase):
@@ -90,6 +150,153 @@ class CategoryModelTest(TestCase):
         self.assertEqual(users_child_category.get_queryset()[0], User.objects.get(username__exact="somename2"))
 
 
+class CategoryTreeTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        physics = models.Category.objects.create(name="Physics", info="physics")
+        mechanics = models.Category.objects.create(name="Mechanics", info="mechanics", parent_category=physics)
+        dynamics = models.Category.objects.create(name="Dynamics", info="dynamics", parent_category=mechanics)
+        models.Category.objects.create(name="Math", info="math")
+
+        for category in (physics, mechanics, dynamics):
+            material = models.EduMaterial.objects.create(title=category.name + " material",
+                                                         summary="summary",
+                                                         pdf_file="pdfmaterials/curse.pdf")
+            material.category.add(category)
+        material.category.add(mechanics)
+
+    def test_ancestors_and_descendants(self):
+        dynamics = models.Category.objects.get(name="Dynamics")
+        physics = models.Category.objects.get(name="Physics")
+
+        with self.assertNumQueries(1):
+            self.assertEqual([c.name for c in dynamics.ancestors()], ["Physics", "Mechanics"])
+        with self.assertNumQueries(1):
+            self.assertEqual({c.name for c in physics.descendants()}, {"Mechanics", "Dynamics"})
+        with self.assertNumQueries(1):
+            self.assertEqual(physics.subtree_materials().count(), 3)
+
+    def test_ancestors_of(self):
+        categories = models.Category.objects.filter(name__in=["Dynamics", "Mechanics"])
+        names = {c.name for c in models.Category.objects.ancestors_of(categories)}
+        self.assertEqual(names, {"Physics", "Mechanics", "Dynamics"})
+
+    def test_move(self):
+        mechanics = models.Category.objects.get(name="Mechanics")
+        mechanics.parent_category = models.Category.objects.get(name="Math")
+        mechanics.save()
+
+        dynamics = models.Category.objects.get(name="Dynamics")
+        self.assertEqual([c.name for c in dynamics.ancestors()], ["Math", "Mechanics"])
+        self.assertEqual(models.Category.objects.get(name="Physics").subtree_materials().count(), 1)
+
+        mechanics.parent_category = dynamics
+        with self.assertRaises(ValueError):
+            mechanics.save()
+
+    def test_category_list_shows_roots_with_counts(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("category-list"))
+        self.assertEqual(response.status_code, 200)
+
+        counts = [(c.name, c.subcategory_count, c.subtree_material_count) for c in response.context["category_list"]]
+        self.assertEqual(counts, [("Math", 0, 0), ("Physics", 1, 3)])
+
+    def counters(self):
+        return {c.name: (c.material_count, c.subtree_material_count, c.subcategory_count)
+                for c in models.Category.objects.all()}
+
+    def test_counters_follow_materials_and_moves(self):
+        self.assertEqual(self.counters(), {"Physics": (1, 3, 1), "Mechanics": (2, 2, 1), "Dynamics": (1, 1, 0),
+                                           "Math": (0, 0, 0)})
+        physics, mechanics, dynamics, math = (models.Category.objects.get(name=name)
+                                              for name in ("Physics", "Mechanics", "Dynamics", "Math"))
+
+        # a material in two categories of a subtree is counted once in it
+        material = models.EduMaterial.objects.get(title="Dynamics material")
+        material.category.add(physics)
+        self.assertEqual(self.counters()["Physics"], (2, 3, 1))
+        mechanics.edumaterial_set.remove(models.EduMaterial.objects.get(title="Mechanics material"))
+        self.assertEqual(self.counters()["Physics"], (2, 2, 1))
+        self.assertEqual(self.counters()["Mechanics"], (1, 1, 1))
+
+        mechanics.parent_category = math
+        mechanics.save()
+        self.assertEqual(self.counters()["Physics"], (2, 2, 0))
+        self.assertEqual(self.counters()["Math"], (0, 1, 1))
+
+        material.category.clear()
+        self.assertEqual(self.counters()["Math"], (0, 0, 1))
+        self.assertEqual(self.counters()["Physics"], (1, 1, 0))
+        models.EduMaterial.objects.get(title="Physics material").delete()
+        self.assertEqual(self.counters()["Physics"], (0, 0, 0))
+
+        dynamics.edumaterial_set.add(material)
+        dynamics.delete()
+        self.assertEqual(self.counters(), {"Physics": (0, 0, 0), "Mechanics": (0, 0, 0), "Math": (0, 0, 1)})
+
+    def test_subscriber_and_author_counters(self):
+        physics, math = models.Category.objects.get(name="Physics"), models.Category.objects.get(name="Math")
+        first = User.objects.create_user(username="first", password="passwodr")
+        second = User.objects.create_user(username="second", password="passwodr")
+        stale_physics = models.Category.objects.get(name="Physics")
+        physics.users_subscribed.add(first, second)
+        second.category_set.add(math)
+        second.category_set.add(math)
+        physics.users_subscribed.remove(first)
+        math.users_subscribed.remove(first)
+        first.category_set.remove(math)
+        stale_physics.info = "changed info"
+        stale_physics.save()
+        physics.refresh_from_db()
+        math.refresh_from_db()
+        self.assertEqual((physics.subscriber_count, math.subscriber_count), (1, 1))
+        second.delete()
+        physics.refresh_from_db()
+        math.refresh_from_db()
+        self.assertEqual((physics.subscriber_count, math.subscriber_count), (0, 0))
+
+        newton = models.Author.objects.create(first_name="Isaac", last_name="Newton", info="info")
+        leibniz = models.Author.objects.create(first_name="Gottfried", last_name="Leibniz", info="info")
+        material = models.EduMaterial.objects.create(title="Principia", summary="summary", author=newton,
+                                                     pdf_file="pdfmaterials/curse.pdf")
+        material = models.EduMaterial.objects.get(pk=material.pk)
+        material.author = leibniz
+        material.save()
+        leibniz.info = "changed info"
+        leibniz.save()
+        newton.refresh_from_db()
+        leibniz.refresh_from_db()
+        self.assertEqual((newton.material_count, leibniz.material_count), (0, 1))
+
+        # the author of a material loaded without it is not counted again
+        deferred = models.EduMaterial.objects.only("title").get(pk=material.pk)
+        deferred.title = "Principia Mathematica"
+        deferred.save()
+        self.assertEqual(deferred.author_id, leibniz.pk)
+        deferred.save()
+        leibniz.refresh_from_db()
+        self.assertEqual(leibniz.material_count, 1)
+
+        material.delete()
+        leibniz.refresh_from_db()
+        self.assertEqual(leibniz.material_count, 0)
+
+    def test_recount_command(self):
+        expected = self.counters()
+        models.Category.objects.update(material_count=7, subtree_material_count=7, subcategory_count=7)
+        stdout = StringIO()
+        call_command("recount", stdout=stdout)
+        self.assertIn("Recounted 4 categories", stdout.getvalue())
+        self.assertEqual(self.counters(), expected)
+
+    def test_delete(self):
+        models.Category.objects.get(name="Mechanics").delete()
+        physics = models.Category.objects.get(name="Physics")
+        self.assertEqual(physics.descendants().count(), 0)
+        self.assertEqual(models.CategoryClosure.objects.count(), 2)
+
+
 class EduMaterialModelTest(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -258,6 +465,182 @@ class EduMaterialCreateViewTest(TestCase):
         self.assertEqual(created_material.author, models.Author.objects.get(first_name="Test"))
         self.assertEqual(created_material.category.get_queryset()[0], models.Category.objects.get(name="child"))
 
+        # the subscribers are notified by the background worker, which also extracts the text of the file
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(set(models.Job.objects.values_list("task", flat=True)),
+                         {"notify_category_update", "extract_material_text"})
+        self.assertEqual(jobs.run_pending(), 2)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["user2@example.com"])
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """Fails once, on the second chunk it is given."""
+
+    calls = 0
+
+    def send_messages(self, messages):
+        FlakyEmailBackend.calls += 1
+        if FlakyEmailBackend.calls == 2:
+            raise ConnectionError("connection lost")
+        return super().send_messages(messages)
+
+
+class NotificationFanOutTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        parent = models.Category.objects.create(name="Physics", info="physics")
+        first = models.Category.objects.create(name="Mechanics", info="mechanics", parent_category=parent)
+        second = models.Category.objects.create(name="Optics", info="optics", parent_category=parent)
+        models.Category.objects.create(name="Math", info="math").users_subscribed.add(
+            User.objects.create_user("math", email="math@example.com"))
+
+        both = User.objects.create_user("both", email="both@example.com")
+        parent.users_subscribed.add(both)
+        first.users_subscribed.add(both, User.objects.create_user("noemail", email=""))
+        for i in range(5):
+            second.users_subscribed.add(User.objects.create_user("optics%d" % i, email="optics%d@example.com" % i))
+
+    def test_one_query_and_one_message_per_user(self):
+        category_ids = list(models.Category.objects.filter(name__in=["Mechanics", "Optics"])
+                                                   .values_list("pk", flat=True))
+        models.MetricTotal.objects.create(name=catalog_metrics.EMAILS_SENT.name, value=1)
+        # the subscriptions, and the count of the sent emails
+        with self.settings(NOTIFY_EMAIL_CHUNK_SIZE=2), self.assertNumQueries(2):
+            notifications.notify_category_update(category_ids)
+
+        recipients = sorted(message.to[0] for message in mail.outbox)
+        self.assertEqual(recipients, ["both@example.com"] + ["optics%d@example.com" % i for i in range(5)])
+        both = [message for message in mail.outbox if message.to == ["both@example.com"]][0]
+        self.assertEqual(both.subject, "Categories 'Mechanics', 'Physics' were updated")
+        self.assertEqual(models.MetricTotal.objects.get().value, 7)
+
+    def test_retry_skips_delivered_chunks(self):
+        category_ids = list(models.Category.objects.filter(name__in=["Mechanics", "Optics"])
+                                                   .values_list("pk", flat=True))
+        job = jobs.enqueue("notify_category_update", {"category_ids": category_ids})
+        FlakyEmailBackend.calls = 0
+        with self.settings(NOTIFY_EMAIL_CHUNK_SIZE=2, EMAIL_BACKEND="catalog.tests.FlakyEmailBackend"):
+            jobs.run_pending()
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.payload["sent_until"]), ("q", "optics0@example.com"))
+            delivered = [message.to[0] for message in mail.outbox]
+            # the progress is compared in Python, so the delivery follows the Python order whatever the collation
+            self.assertEqual(delivered, sorted(delivered))
+            models.Job.objects.update(run_at=timezone.now())
+            jobs.run_pending()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, "d")
+        recipients = sorted(message.to[0] for message in mail.outbox)
+        self.assertEqual(recipients, ["both@example.com"] + ["optics%d@example.com" % i for i in range(5)])
+
+    def test_digest(self):
+        mechanics = models.Category.objects.get(name="Mechanics")
+        optics = models.Category.objects.get(name="Optics")
+        with self.settings(NOTIFY_MODE="digest"):
+            for i in range(3):
+                material = models.EduMaterial.objects.create(title="digest %d" % i, summary="digest",
+                                                             pdf_file="pdfmaterials/curse.pdf")
+                notifications.schedule_category_update(material.id, [mechanics.id, optics.id])
+
+        self.assertEqual(models.Job.objects.count(), 0)
+        self.assertEqual(models.CategoryUpdateEvent.objects.count(), 6)
+
+        call_command("send_digests", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 6)
+        both = [message for message in mail.outbox if message.to == ["both@example.com"]][0]
+        self.assertIn("'Mechanics': 3 new materials", both.body)
+        self.assertIn("'Physics': 3 new materials", both.body)
+        self.assertEqual(models.CategoryUpdateEvent.objects.count(), 0)
+        # sent by a command, which is not scraped
+        self.assertIn("catalog_emails_sent_total 6.0", metrics.registry.generate_latest())
+
+
+class JobQueueTest(TestCase):
+    calls = []
+
+    @staticmethod
+    @jobs.task("test_flaky")
+    def flaky(value, failures):
+        JobQueueTest.calls.append(value)
+        if len(JobQueueTest.calls) <= failures:
+            raise RuntimeError("try again")
+
+    def setUp(self) -> None:
+        super().setUp()
+        JobQueueTest.calls = []
+
+    def test_idempotency_key(self):
+        first = jobs.enqueue("test_flaky", {"value": 1, "failures": 0}, idempotency_key="same")
+        second = jobs.enqueue("test_flaky", {"value": 2, "failures": 0}, idempotency_key="same")
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(models.Job.objects.get().status, "d")
+
+    def test_retry_with_backoff(self):
+        job = jobs.enqueue("test_flaky", {"value": 1, "failures": 2})
+        job.max_attempts = 3
+        job.save()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("q", 1))
+        self.assertIn("try again", job.last_error)
+        self.assertGreater(job.run_at, timezone.now())
+        # not due yet
+        self.assertEqual(jobs.run_pending(), 0)
+
+        models.Job.objects.update(run_at=timezone.now())
+        jobs.run_pending()
+        models.Job.objects.update(run_at=timezone.now())
+        jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("d", 3))
+
+    def test_gives_up(self):
+        job = jobs.enqueue("test_flaky", {"value": 1, "failures": 5})
+        job.max_attempts = 1
+        job.save()
+        jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.status, "f")
+
+    def test_lost_worker(self):
+        job = jobs.enqueue("test_flaky", {"value": 1, "failures": 0})
+        job.max_attempts = 2
+        job.save()
+        stale = timezone.now() - timedelta(seconds=settings.JOB_LOCK_TIMEOUT + 1)
+        self.assertEqual(len(jobs.claim(10)), 1)
+        # the worker is alive while it refreshes the lock
+        models.Job.objects.update(locked_at=stale)
+        jobs.heartbeat([job])
+        self.assertEqual(jobs.claim(10), [])
+
+        models.Job.objects.update(locked_at=stale)
+        self.assertEqual(len(jobs.claim(10)), 1)
+        models.Job.objects.update(locked_at=stale)
+        self.assertEqual(jobs.claim(10), [])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("f", 2))
+        self.assertEqual(self.calls, [])
+
+    def test_purge_finished(self):
+        for value, status in enumerate("dqrdf"):
+            models.Job.objects.create(task="test_flaky", payload={"value": value, "failures": 0}, status=status,
+                                      run_at=timezone.now() - timedelta(days=value))
+        self.assertEqual(jobs.purge_finished(timedelta(hours=36), batch_size=1), 2)
+        self.assertEqual(sorted(models.Job.objects.values_list("status", flat=True)), ["d", "q", "r"])
+
+    def test_worker_stops_on_sigterm(self):
+        stdout = StringIO()
+        threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        started = time.monotonic()
+        call_command("run_worker", poll_interval=30, stdout=stdout)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertIn("Waiting for the running jobs to finish", stdout.getvalue())
+
 
 class SignUpViewTest(TestCase):
     def test_view_url_exists_at_desired_location(self):
@@ -327,6 +710,150 @@ class MaterialFileViewTest(TestCase):
         self.assertEqual(self.client.get(material2.get_absolute_file_url()).status_code, 403)
         self.assertEqual(self.client.get(material3.get_absolute_file_url()).status_code, 200)
 
+    def test_range_and_conditional_requests(self):
+        url = models.EduMaterial.objects.get(title="Material 3").get_absolute_file_url()
+        with open("pdfmaterials/curse.pdf", "rb") as pdf:
+            content = pdf.read()
+
+        response = self.client.get(url)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(b"".join(response.streaming_content), content)
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_RANGE="bytes=0-9")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 0-9/%d" % len(content))
+        self.assertEqual(b"".join(response.streaming_content), content[:10])
+
+        response = self.client.get(url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(b"".join(response.streaming_content), content[-5:])
+
+        response = self.client.get(url, HTTP_RANGE="bytes=%d-" % len(content))
+        self.assertEqual(response.status_code, 416)
+
+        response = self.client.get(url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # the modified time comes from the storage, not from the local copy
+        last_modified = response["Last-Modified"]
+        material = models.EduMaterial.objects.get(title="Material 3")
+        self.assertEqual(last_modified, http_date(material.pdf_file.storage.get_modified_time(
+            material.pdf_file.name).timestamp()))
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date(0)).status_code, 200)
+        response = self.client.get(url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=last_modified)
+        self.assertEqual(response.status_code, 206)
+
+        # another copy of the file, e.g. in the cache of another worker, has the same ETag
+        material = models.EduMaterial.objects.get(title="Material 3")
+        os.unlink(files.pdf_cache.path(material.pdf_file.name))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_missing_file(self):
+        material = models.EduMaterial.objects.create(title="Lost", summary="lost", access_type="e",
+                                                     pdf_file=ContentFile(b"%PDF-lost", name="lost.pdf"))
+        self.assertEqual(self.client.get(material.get_absolute_file_url()).status_code, 200)
+        material.pdf_file.storage.delete(material.pdf_file.name)
+        os.unlink(files.pdf_cache.path(material.pdf_file.name))
+        self.assertEqual(self.client.get(material.get_absolute_file_url()).status_code, 404)
+
+    def test_async_file_view(self):
+        material = models.EduMaterial.objects.get(title="Material 3")
+        request = RequestFactory().get(material.get_absolute_file_url())
+        request.user = AnonymousUser()
+        response = async_to_sync(async_views.material_file)(request, pk=material.pk)
+        with open("pdfmaterials/curse.pdf", "rb") as pdf:
+            self.assertEqual(b"".join(response.streaming_content), pdf.read())
+
+        premium = models.EduMaterial.objects.get(title="Material 1")
+        with self.assertRaises(PermissionDenied):
+            async_to_sync(async_views.material_file)(request, pk=premium.pk)
+
+
+class SignedDeliveryTest(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        signed_settings = self.settings(DEFAULT_FILE_STORAGE="catalog.storage.SignedFileSystemStorage",
+                                        MEDIA_ROOT=directory.name,
+                                        PDF_DELIVERY="signed")
+        signed_settings.enable()
+        self.addCleanup(signed_settings.disable)
+
+        self.material = models.EduMaterial.objects.create(title="Signed", summary="signed", access_type="p",
+                                                          pdf_file=ContentFile(b"%PDF-signed", name="signed.pdf"))
+        User.objects.create_user("premium", password="passwodr").user_permissions.add(
+            Permission.objects.get(codename="can_view_premium"))
+
+    def test_redirects_to_signed_url(self):
+        url = self.material.get_absolute_file_url()
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.login(username="premium", password="passwodr")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith(reverse("signed-file", args=[self.material.pdf_file.name])))
+
+        self.client.logout()
+        response = self.client.get(response.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"%PDF-signed")
+
+    def test_rejects_tampered_and_expired_urls(self):
+        storage = SignedFileSystemStorage()
+        name = self.material.pdf_file.name
+        url = reverse("signed-file", args=[name])
+
+        expires = int(time.time()) + 60
+        self.assertEqual(self.client.get(url, {"expires": expires, "signature": "0" * 64}).status_code, 403)
+        signature = storage.signature(name, expires)
+        self.assertEqual(self.client.get(url, {"expires": expires + 1, "signature": signature}).status_code, 403)
+
+        expired = int(time.time()) - 1
+        signature = storage.signature(name, expired)
+        self.assertEqual(self.client.get(url, {"expires": expired, "signature": signature}).status_code, 403)
+
+
+class PdfCacheTest(TestCase):
+    def test_least_recently_used_files_are_evicted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = FileSystemStorage(location=os.path.join(directory, "storage"))
+            for name in ("a.pdf", "b.pdf", "c.pdf"):
+                storage.save(name, ContentFile(b"x" * 100))
+
+            cache = files.PdfCache(os.path.join(directory, "cache"), max_bytes=250)
+            with cache.local_copy("a.pdf", storage) as path_a:
+                os.utime(path_a, (1, 1))
+            with cache.local_copy("b.pdf", storage) as path_b:
+                os.utime(path_b, (2, 2))
+            cache.open("a.pdf", storage).close()
+            cache.open("c.pdf", storage).close()
+
+            self.assertTrue(os.path.exists(path_a))
+            self.assertFalse(os.path.exists(path_b))
+            self.assertTrue(os.path.exists(cache.path("c.pdf")))
+
+    def test_file_in_use_is_not_evicted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = FileSystemStorage(location=os.path.join(directory, "storage"))
+            storage.save("large.pdf", ContentFile(b"x" * 100))
+
+            # the file alone is larger than the cache
+            cache = files.PdfCache(os.path.join(directory, "cache"), max_bytes=50)
+            with cache.local_copy("large.pdf", storage) as path:
+                cache.evict()
+                self.assertTrue(os.path.exists(path))
+            cache.evict()
+            self.assertFalse(os.path.exists(path))
+
+            with cache.open("large.pdf", storage) as fh:
+                self.assertEqual(fh.read(), b"x" * 100)
+
 
 class SubscribeCategoryViewTest(TestCase):
     def setUp(self) -> None:
@@ -344,8 +871,41 @@ class SubscribeCategoryViewTest(TestCase):
         response = self.client.get(path)
         self.assertEqual(response.status_code, 200)
 
+    def test_subscribe_counts_subscriber_once(self):
+        category = models.Category.objects.get(name="example")
+        path = reverse("category-subscribe", args=[str(category.id)])
+        self.client.get(path)
+        self.client.get(path)
+        category.refresh_from_db()
+        self.assertEqual(category.subscriber_count, 1)
+
 
 class SearchViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = models.Author.objects.create(first_name="Isaac", last_name="Newton", info="Physicist")
+        models.EduMaterial.objects.create(title="Classical mechanics",
+                                          summary="Laws of motion and gravitation",
+                                          author=author,
+                                          pdf_file="pdfmaterials/curse.pdf")
+        models.EduMaterial.objects.create(title="Calculus",
+                                          summary="Fluxions, used in classical mechanics",
+                                          author=author,
+                                          pdf_file="pdfmaterials/curse.pdf")
+        models.EduMaterial.objects.create(title="Verilog basics",
+                                          summary="Digital design",
+                                          pdf_file="pdfmaterials/curse.pdf")
+
+    def setUp(self) -> None:
+        super().setUp()
+        search.inverted_index.reset()
+        cache.clear()
+
+    def search(self, usr_query):
+        response = self.client.get(reverse("search-material"), {"usr_query": usr_query})
+        self.assertEqual(response.status_code, 200)
+        return [material.title for material in response.context["edumaterial_list"]]
+
     def test_available_on_desired_location(self):
         url = reverse("search-material")
         url += "?usr_query=math"
@@ -353,6 +913,707 @@ class SearchViewTest(TestCase):
 
         self.assertEqual(response.status_code, 200)
 
+    def test_title_matches_rank_above_summary_matches(self):
+        self.assertEqual(self.search("Mechanics"), ["Classical mechanics", "Calculus"])
+
+    def test_prefixes_of_all_terms_must_match(self):
+        self.assertEqual(self.search("calc newt"), ["Calculus"])
+        self.assertEqual(self.search("verilog newton"), [])
+        self.assertEqual(self.search("   "), [])
+
+    def test_results_are_cached_by_normalized_query(self):
+        self.assertEqual(search.normalize_query(" Classical  MECHANICS classical"), "classical mechanics")
+        self.assertEqual(self.search("classical mechanics"), ["Classical mechanics", "Calculus"])
+        key = search.result_cache_key("classical mechanics")
+        self.assertIsNotNone(cache.get(key))
+
+        # only the page of materials, the search and the facets come from the cache
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.search("MECHANICS   Classical"), ["Classical mechanics", "Calculus"])
+        self.assertEqual(len(queries), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            models.EduMaterial.objects.create(title="Quantum mechanics", summary="classical limit",
+                                              pdf_file="pdfmaterials/curse.pdf")
+        self.assertNotEqual(search.result_cache_key("classical mechanics"), key)
+        self.assertIn("Quantum mechanics", self.search("classical mechanics"))
+
+    def test_facets(self):
+        physics = models.Category.objects.create(name="Physics", info="physics")
+        optics = models.Category.objects.create(name="Optics", info="optics", parent_category=physics)
+        newton = models.Author.objects.get(last_name="Newton")
+        models.EduMaterial.objects.get(title="Classical mechanics").category.add(physics)
+        optics_material = models.EduMaterial.objects.create(title="Opticks", summary="classical optics",
+                                                            author=newton, access_type="p",
+                                                            pdf_file="pdfmaterials/curse.pdf")
+        optics_material.category.add(optics, physics)
+        self.search("classical")
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("search-material"), {"usr_query": "classical"})
+        self.assertLessEqual(len(queries), 3)
+        facets = response.context["facets"]
+        self.assertEqual([(value["label"], value["count"]) for value in facets["category"]],
+                         [("Physics", 2), ("Optics", 1)])
+        self.assertEqual([(value["label"], value["count"]) for value in facets["author"]], [("Isaac Newton", 3)])
+        self.assertEqual([(value["label"], value["count"]) for value in facets["access"]],
+                         [("Everybody can access", 2), ("For premium users", 1)])
+
+        response = self.client.get(reverse("search-material"), {"usr_query": "classical", "category": physics.pk})
+        self.assertEqual([material.title for material in response.context["edumaterial_list"]],
+                         ["Classical mechanics", "Opticks"])
+        selected = response.context["facets"]["category"][0]
+        self.assertTrue(selected["selected"])
+        self.assertEqual(selected["query_string"], "usr_query=classical")
+
+        response = self.client.get(reverse("search-material"),
+                                   {"usr_query": "classical", "category": physics.pk, "access": "p"})
+        self.assertEqual([material.title for material in response.context["edumaterial_list"]], ["Opticks"])
+        response = self.client.get(reverse("search-material"), {"usr_query": "classical", "author": 999999})
+        self.assertEqual(list(response.context["edumaterial_list"]), [])
+
+    def test_facets_of_long_results_are_counted_in_batches(self):
+        self.addCleanup(setattr, facets, "ID_BATCH_SIZE", facets.ID_BATCH_SIZE)
+        facets.ID_BATCH_SIZE = 1
+        physics = models.Category.objects.create(name="Physics", info="physics")
+        for material in models.EduMaterial.objects.all():
+            material.category.add(physics)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("search-material"), {"usr_query": "classical", "access": "e"})
+        self.assertGreater(len(queries), 4)
+        self.assertEqual([(value["label"], value["count"]) for value in response.context["facets"]["category"]],
+                         [("Physics", 2)])
+        self.assertEqual([material.title for material in response.context["edumaterial_list"]],
+                         ["Classical mechanics", "Calculus"])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.assertEqual(self.search("verilog"), ["Verilog basics"])
+
+        material = models.EduMaterial.objects.get(title="Verilog basics")
+        material.title = "VHDL basics"
+        with self.captureOnCommitCallbacks(execute=True):
+            material.save()
+            self.assertEqual(search.inverted_index.ranked_ids("vhdl"), [])
+        self.assertEqual(self.search("verilog"), [])
+        self.assertEqual(self.search("vhdl"), ["VHDL basics"])
+
+        author = models.Author.objects.get(last_name="Newton")
+        author.last_name = "Leibniz"
+        with self.captureOnCommitCallbacks(execute=True):
+            author.save()
+        self.assertEqual(self.search("newton"), [])
+        self.assertEqual(len(self.search("leibniz")), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            material.delete()
+        self.assertEqual(self.search("vhdl"), [])
+
+
+class FragmentCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = models.Category.objects.create(name="cached", info="cached")
+        cls.author = models.Author.objects.create(first_name="Cached", last_name="Author", info="info")
+        cls.material = models.EduMaterial.objects.create(title="Cached material", summary="summary",
+                                                         author=cls.author, pdf_file="pdfmaterials/curse.pdf")
+        cls.material.category.add(cls.category)
+        User.objects.create_user(username="reader", password="passwodr")
+
+    def setUp(self) -> None:
+        super().setUp()
+        cache.clear()
+
+    def test_cached_page_runs_fewer_queries(self):
+        url = self.category.get_absolute_url()
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as second:
+            response = self.client.get(url)
+        self.assertContains(response, "Cached material")
+        self.assertLess(len(second), len(first))
+
+    def test_other_query_parameters_share_the_fragment(self):
+        url = self.category.get_absolute_url()
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as second:
+            response = self.client.get(url, {"utm_source": "mail"})
+        self.assertContains(response, "Cached material")
+        self.assertLess(len(second), len(first))
+
+    def test_changes_invalidate_the_fragments(self):
+        self.client.get(self.category.get_absolute_url())
+        self.client.get(self.material.get_absolute_url())
+
+        self.material.title = "Renamed material"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.material.save()
+            # the fragments cached before the commit are made stale by it
+            self.client.get(self.material.get_absolute_url())
+        self.assertContains(self.client.get(self.category.get_absolute_url()), "Renamed material")
+        self.assertContains(self.client.get(self.material.get_absolute_url()), "Renamed material")
+
+        self.author.last_name = "Renamed"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author.save()
+        self.assertContains(self.client.get(self.material.get_absolute_url()), "Cached Renamed")
+
+        other = models.EduMaterial.objects.create(title="Other material", summary="summary",
+                                                  pdf_file="pdfmaterials/curse.pdf")
+        self.client.get(self.category.get_absolute_url())
+        with self.captureOnCommitCallbacks(execute=True):
+            other.category.add(self.category)
+        self.assertContains(self.client.get(self.category.get_absolute_url()), "Other material")
+
+    def test_user_parts_are_not_cached(self):
+        url = self.category.get_absolute_url()
+        self.assertContains(self.client.get(url), "Login")
+        self.client.login(username="reader", password="passwodr")
+        response = self.client.get(url)
+        self.assertContains(response, "Log out")
+        self.assertContains(response, "Subscribe to be notified")
+        self.assertNotContains(response, "Login")
+
+
+class TwoTierCacheTest(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        cache.clear()
+        params = {"OPTIONS": {"L2": "shared", "L1_MAX_ENTRIES": 2, "GENERATION_CHECK_INTERVAL": 0}}
+        # two worker processes: their own local tiers, one shared tier
+        self.worker_a = catalog_cache.TwoTierCache("test", params)
+        self.worker_b = catalog_cache.TwoTierCache("test", params)
+        self.worker_b.tier = catalog_cache.LocalTier(2)
+
+    def test_invalidation_reaches_other_workers(self):
+        self.worker_a.set("counter", 1)
+        self.assertEqual(self.worker_b.get("counter"), 1)
+
+        self.worker_a.incr("counter")
+        self.assertEqual(self.worker_b.get("counter"), 2)
+        self.worker_a.delete("counter")
+        self.assertIsNone(self.worker_b.get("counter"))
+
+    def test_local_tier_is_bounded_and_copies_values(self):
+        self.worker_a.set_many({"a": [1], "b": [2], "c": [3]})
+        self.assertEqual(list(self.worker_a.tier.entries), [":1:b", ":1:c"])
+        self.assertEqual(self.worker_a.get_many(["a", "b", "c"]), {"a": [1], "b": [2], "c": [3]})
+
+        self.worker_a.get("c").append(4)
+        self.assertEqual(self.worker_a.get("c"), [3])
+
+
+class AutocompleteTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = models.Category.objects.create(name="Mechanics", info="info")
+        cls.author = models.Author.objects.create(first_name="Isaac", last_name="Newton", info="info")
+        cls.material = models.EduMaterial.objects.create(title="Classical mechanics", summary="summary",
+                                                         author=cls.author, pdf_file="pdfmaterials/curse.pdf")
+
+    def setUp(self) -> None:
+        super().setUp()
+        autocomplete.prefix_index.reset()
+        cache.clear()
+
+    def suggest(self, prefix):
+        response = self.client.get(reverse("autocomplete"), {"q": prefix})
+        return [(suggestion["kind"], suggestion["label"]) for suggestion in response.json()["suggestions"]]
+
+    def test_prefix_of_any_word(self):
+        self.assertEqual(self.suggest("MECH"), [("category", "Mechanics"), ("material", "Classical mechanics")])
+        self.assertEqual(self.suggest("new"), [("author", "Isaac Newton")])
+        self.assertEqual(self.suggest("classical  me"), [("material", "Classical mechanics")])
+        self.assertEqual(self.suggest(" "), [])
+
+    def test_served_from_memory_and_follows_writes(self):
+        self.suggest("mech")
+        with self.assertNumQueries(0):
+            self.suggest("mecha")
+
+        self.material.title = "Quantum mechanics"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.material.save()
+            self.category.delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest("mech"), [("material", "Quantum mechanics")])
+
+        # the index of another process publishes its changes, they are replayed without a rebuild
+        autocomplete.PrefixIndex().update(("author", self.author.pk), "Isaac Leibniz")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest("leib"), [("author", "Isaac Leibniz")])
+            self.assertEqual(self.suggest("newt"), [])
+
+    def test_rebuilt_when_changes_are_lost(self):
+        self.suggest("mech")
+        models.Author.objects.filter(pk=self.author.pk).update(last_name="Leibniz")
+        autocomplete.changes.publish([(("category", self.category.pk), None)])
+        cache.delete(autocomplete.changes.change_key(autocomplete.changes.current()))
+        self.assertEqual(self.suggest("leib"), [("author", "Isaac Leibniz")])
+
+
+class TextExtractionTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.material = models.EduMaterial.objects.create(title="Principia", summary="summary",
+                                                         pdf_file="pdfmaterials/curse.pdf")
+
+    def setUp(self) -> None:
+        super().setUp()
+        search.inverted_index.reset()
+        cache.clear()
+
+    def test_unchanged_file_is_not_extracted_again(self):
+        with files.pdf_cache.local_copy(self.material.pdf_file.name, self.material.pdf_file.storage) as path:
+            content_hash = pdftext.file_sha256(path)
+        models.MaterialText.objects.create(material=self.material, content_hash=content_hash,
+                                           page_count=3, terms="fluxion gravitation")
+
+        extraction.extract_material_text(self.material.pk)
+        self.assertEqual(models.MaterialText.objects.get(material=self.material).page_count, 3)
+
+    def test_file_terms_are_searched(self):
+        self.assertEqual(search.inverted_index.ranked_ids("fluxi"), [])
+        # extracted and indexed by the worker process, this process loads the material again from the log
+        models.MaterialText.objects.create(material=self.material, content_hash="0" * 64, terms="fluxion gravitation")
+        search.InvertedIndexBackend().index_materials([self.material.pk])
+        with self.assertNumQueries(1):
+            self.assertEqual(search.inverted_index.ranked_ids("fluxi"), [(search.CONTENT_WEIGHT, self.material.pk)])
+        response = self.client.get(reverse("search-material"), {"usr_query": "fluxi"})
+        self.assertEqual([material.title for material in response.context["edumaterial_list"]], ["Principia"])
+
+    def test_extraction_is_queued_once_per_file(self):
+        extraction.schedule_extraction(self.material)
+        extraction.schedule_extraction(self.material)
+        self.assertEqual(models.Job.objects.filter(task="extract_material_text").count(), 1)
+
+    @unittest.skipUnless(importlib.util.find_spec("pypdf"), "pypdf is not installed")
+    def test_extract_terms(self):
+        version = fragments.get_version((models.EduMaterial,))
+        # the fragments are invalidated on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            extraction.extract_material_text(self.material.pk)
+        self.assertNotEqual(fragments.get_version((models.EduMaterial,)), version)
+        text = models.MaterialText.objects.get(material=self.material)
+        with files.pdf_cache.local_copy(self.material.pdf_file.name, self.material.pdf_file.storage) as path:
+            self.assertEqual(text.content_hash, pdftext.file_sha256(path))
+        self.assertGreaterEqual(text.page_count, 1)
+        self.assertEqual(text.terms.split(), sorted(set(text.terms.split())))
+
+
+class ImportMaterialsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.physics = models.Category.objects.create(name="Physics", info="physics")
+        cls.optics = models.Category.objects.create(name="Optics", info="optics", parent_category=cls.physics)
+        cls.author = models.Author.objects.create(first_name="Isaac", last_name="Newton", info="info")
+        subscriber = User.objects.create_user(username="subscriber", password="passwodr",
+                                              email="subscriber@example.com")
+        cls.physics.users_subscribed.add(subscriber)
+
+    def setUp(self) -> None:
+        super().setUp()
+        search.inverted_index.reset()
+        cache.clear()
+
+    def write_files(self, directory, names):
+        with open("pdfmaterials/curse.pdf", "rb") as pdf:
+            content = pdf.read()
+        for name in names:
+            with open(os.path.join(directory, name), "wb") as fh:
+                fh.write(content)
+
+    def test_csv_import(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_files(directory, ["opticks.pdf", "principia.pdf"])
+            manifest = os.path.join(directory, "manifest.csv")
+            with open(manifest, "w", encoding="utf-8") as fh:
+                fh.write("title,summary,access_type,author,categories,file\n"
+                         "Opticks,Light and colours,e,%d,%d,opticks.pdf\n"
+                         "Principia,Laws of motion,p,%d,%d,principia.pdf\n"
+                         "Missing,No file,e,,,missing.pdf\n" % (self.author.pk, self.optics.pk,
+                                                               self.author.pk, self.physics.pk))
+            stdout, stderr = StringIO(), StringIO()
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command("import_materials", manifest, batch_size=1, stdout=stdout, stderr=stderr)
+
+        self.assertIn("Imported 2 materials, skipped 1 rows", stdout.getvalue())
+        self.assertIn("no file", stderr.getvalue())
+        opticks = models.EduMaterial.objects.get(title="Opticks")
+        self.assertEqual(list(opticks.category.all()), [self.optics])
+        self.assertEqual(opticks.author, self.author)
+        self.assertTrue(opticks.pdf_file.storage.exists(opticks.pdf_file.name))
+        self.assertEqual(models.EduMaterial.objects.get(title="Principia").access_type, "p")
+        self.physics.refresh_from_db()
+        self.author.refresh_from_db()
+        self.assertEqual((self.physics.material_count, self.physics.subtree_material_count), (1, 2))
+        self.assertEqual(self.author.material_count, 2)
+
+        response = self.client.get(reverse("search-material"), {"usr_query": "light"})
+        self.assertEqual([material.title for material in response.context["edumaterial_list"]], ["Opticks"])
+
+        # one notification for the whole import, the subscriber of the parent category gets one email
+        self.assertEqual(models.Job.objects.filter(task="notify_category_update").count(), 1)
+        self.assertEqual(models.Job.objects.filter(task="extract_material_text").count(), 2)
+        models.Job.objects.filter(task="extract_material_text").delete()
+        jobs.run_pending()
+        self.assertEqual([message.to for message in mail.outbox], [["subscriber@example.com"]])
+
+    def test_jsonl_import(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_files(directory, ["a.pdf"])
+            manifest = os.path.join(directory, "manifest.jsonl")
+            with open(manifest, "w", encoding="utf-8") as fh:
+                fh.write(json.dumps({"title": "A", "summary": "a", "categories": [self.physics.pk, self.optics.pk],
+                                     "file": "a.pdf"}) + "\n")
+            call_command("import_materials", manifest, "--no-notify", stdout=StringIO())
+
+        material = models.EduMaterial.objects.get(title="A")
+        self.assertEqual(set(material.category.all()), {self.physics, self.optics})
+        self.assertFalse(models.Job.objects.filter(task="notify_category_update").exists())
+
+    def test_invalid_rows_are_skipped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_files(directory, ["a.pdf"])
+            manifest = os.path.join(directory, "manifest.jsonl")
+            rows = [
+                {"title": "No access type", "access_type": None, "file": "a.pdf"},
+                {"title": "Empty access type", "access_type": "", "author": self.author.pk, "file": "a.pdf"},
+                {"title": "Bad author", "author": "newton", "file": "a.pdf"},
+                {"title": "Bad access type", "access_type": 1, "file": "a.pdf"},
+                {"title": "x" * 201, "file": "a.pdf"},
+            ]
+            with open(manifest, "w", encoding="utf-8") as fh:
+                fh.writelines(json.dumps(row) + "\n" for row in rows)
+                fh.write('{"title": "Truncated\n[{"title": "In a list", "file": "a.pdf"}]\n')
+            stdout, stderr = StringIO(), StringIO()
+            call_command("import_materials", manifest, "--no-notify", batch_size=2, stdout=stdout, stderr=stderr)
+
+        self.assertIn("Imported 2 materials, skipped 5 rows", stdout.getvalue())
+        self.assertEqual(sorted(models.EduMaterial.objects.values_list("title", "access_type")),
+                         [("Empty access type", "e"), ("No access type", "e")])
+        for problem in ("invalid ids", "invalid access type 1", "title longer than 200 characters",
+                        "line 6: invalid JSON", "line 7: not a JSON object"):
+            self.assertIn(problem, stderr.getvalue())
+
+
+class CatalogExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.physics = models.Category.objects.create(name="Physics", info="physics")
+        cls.optics = models.Category.objects.create(name="Optics", info="optics", parent_category=cls.physics)
+        cls.author = models.Author.objects.create(first_name="Isaac", last_name="Newton", info="info")
+        cls.opticks = models.EduMaterial.objects.create(title="Opticks", summary="Light, colours",
+                                                        author=cls.author, pdf_file="pdfmaterials/opticks.pdf")
+        cls.opticks.category.add(cls.optics, cls.physics)
+        cls.anonymous = models.EduMaterial.objects.create(title="Anonymous", summary="No author",
+                                                          pdf_file="pdfmaterials/anonymous.pdf")
+        cls.staff = User.objects.create_user(username="staff", password="passwodr", is_staff=True)
+        User.objects.create_user(username="user", password="passwodr")
+
+    def test_jsonl_in_chunks(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = b"".join(export.export_catalog("jsonl", chunk_size=1))
+        rows = [json.loads(line) for line in data.decode().splitlines()]
+
+        self.assertEqual(rows[0], {
+            "id": self.opticks.pk, "title": "Opticks", "summary": "Light, colours", "access_type": "e",
+            "author": self.author.pk, "author_name": "Isaac Newton",
+            "categories": sorted([self.physics.pk, self.optics.pk]),
+            "category_paths": [path for _, path in sorted([(self.physics.pk, "Physics"),
+                                                          (self.optics.pk, "Physics / Optics")])],
+            "file": "pdfmaterials/opticks.pdf",
+        })
+        self.assertEqual(rows[1]["author"], None)
+        self.assertEqual(rows[1]["categories"], [])
+        # two queries per chunk, one for the category paths and the last empty chunk
+        self.assertEqual(len(queries), 2 * 2 + 1 + 1)
+
+    def test_csv_gzip_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "catalog.csv.gz")
+            call_command("export_catalog", "--format", "csv", "--gzip", "-o", path, stderr=StringIO())
+            with gzip.open(path, "rt", encoding="utf-8", newline="") as fh:
+                rows = list(csv.DictReader(fh))
+
+        self.assertEqual([row["title"] for row in rows], ["Opticks", "Anonymous"])
+        self.assertEqual(rows[0]["summary"], "Light, colours")
+        self.assertEqual(set(rows[0]["categories"].split(";")), {str(self.physics.pk), str(self.optics.pk)})
+        self.assertEqual(rows[1]["author"], "")
+
+    def test_view_is_staff_only(self):
+        self.assertEqual(self.client.get(reverse("catalog-export")).status_code, 302)
+        self.client.login(username="user", password="passwodr")
+        self.assertEqual(self.client.get(reverse("catalog-export")).status_code, 403)
+
+        self.client.login(username="staff", password="passwodr")
+        response = self.client.get(reverse("catalog-export"), {"gzip": "1"})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="catalog.jsonl.gz"')
+        lines = gzip.decompress(b"".join(response.streaming_content)).decode().splitlines()
+        self.assertEqual([json.loads(line)["title"] for line in lines], ["Opticks", "Anonymous"])
+        self.assertEqual(self.client.get(reverse("catalog-export"), {"format": "xml"}).status_code, 400)
+
+    def test_view_under_asgi(self):
+        self.client.login(username="staff", password="passwodr")
+        cookie = settings.SESSION_COOKIE_NAME + "=" + self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        scope = {"type": "http", "method": "GET", "path": reverse("catalog-export"), "query_string": b"format=csv",
+                 "headers": [(b"host", b"testserver"), (b"cookie", cookie.encode())]}
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            messages.append(message)
+
+        # the rows are read while streaming, which must not happen in the event loop
+        async_to_sync(handlers.ASGIHandler())(scope, receive, send)
+        self.assertEqual(messages[0]["status"], 200)
+        rows = list(csv.DictReader(b"".join(message.get("body", b"") for message in messages[1:])
+                                   .decode().splitlines()))
+        self.assertEqual([row["title"] for row in rows], ["Opticks", "Anonymous"])
+
+
+class KeysetPaginationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = models.Author.objects.create(first_name="Many", last_name="Materials", info="Prolific")
+        category = models.Category.objects.create(name="physics", info="physics", parent_category=None)
+        for i in range(25):
+            material = models.EduMaterial.objects.create(title="Physics part %02d" % i,
+                                                         summary="physics",
+                                                         author=author,
+                                                         pdf_file="pdfmaterials/curse.pdf")
+            material.category.add(category)
+
+    def setUp(self) -> None:
+        super().setUp()
+        search.inverted_index.reset()
+        cache.clear()
+
+    def walk_pages(self, url, context_name, params=None):
+        params = dict(params or {})
+        pages = []
+        while True:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(any("COUNT(" in query["sql"] and '"catalog_edumaterial"' in query["sql"]
+                                 for query in queries.captured_queries))
+            page = response.context[context_name]
+            pages.append([material.title for material in page])
+            if not page.has_next():
+                return pages
+            params["after"] = page.next_cursor
+
+    def test_search_pages(self):
+        pages = self.walk_pages(reverse("search-material"), "page_obj", {"usr_query": "physics"})
+        self.assertEqual([len(page) for page in pages], [20, 5])
+        self.assertEqual(len(set(sum(pages, []))), 25)
+
+    def test_category_and_author_pages(self):
+        category = models.Category.objects.get(name="physics")
+        author = models.Author.objects.get(last_name="Materials")
+        expected = ["Physics part %02d" % i for i in range(25)]
+
+        for url in (category.get_absolute_url(), author.get_absolute_url()):
+            pages = self.walk_pages(url, "material_page")
+            self.assertEqual(sum(pages, []), expected)
+
+    def test_invalid_cursor(self):
+        category = models.Category.objects.get(name="physics")
+        for cursor in ("garbage", pagination.encode_cursor(("a", "b", "c")), pagination.encode_cursor(("a", "b")),
+                       pagination.encode_cursor(("a", True)), pagination.encode_cursor(("a", 10 ** 30)),
+                       pagination.encode_cursor(("a", float("inf")))):
+            response = self.client.get(category.get_absolute_url(), {"after": cursor})
+            self.assertEqual(response.status_code, 404)
+        for cursor in (pagination.encode_cursor(("x", 1)), pagination.encode_cursor((1.0, "1"))):
+            response = self.client.get(reverse("search-material"), {"usr_query": "physics", "after": cursor})
+            self.assertEqual(response.status_code, 404)
+
+
+class QueryBudgetTest(TestCase):
+    # the number of queries every page may run, whatever the number of rows
+    budgets = {
+        "category-detail": 4,
+        "author-detail": 2,
+        "edumaterial-detail": 1,
+        # the page of materials and the two facet queries
+        "search-material": 3,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.parent = models.Category.objects.create(name="parent", info="parent")
+        cls.leaf = models.Category.objects.create(name="leaf", info="leaf", parent_category=cls.parent)
+        cls.author = models.Author.objects.create(first_name="Budget", last_name="Author", info="info")
+        for i in range(15):
+            models.Category.objects.create(name="sub %d" % i, info="sub", parent_category=cls.parent)
+            author = models.Author.objects.create(first_name="First %d" % i, last_name="Last %d" % i, info="info")
+            material = models.EduMaterial.objects.create(title="Budget material %d" % i,
+                                                         summary="budget",
+                                                         author=author if i % 2 else cls.author,
+                                                         pdf_file="pdfmaterials/curse.pdf")
+            material.category.add(cls.leaf)
+        cls.material = material
+
+    def setUp(self) -> None:
+        super().setUp()
+        search.inverted_index.reset()
+        cache.clear()
+        search.inverted_index.ranked_ids("warm up")
+
+    def assertWithinBudget(self, name, url, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(queries), self.budgets[name])
+
+    def test_category_pages(self):
+        self.assertWithinBudget("category-detail", self.parent.get_absolute_url())
+        self.assertWithinBudget("category-detail", self.leaf.get_absolute_url())
+
+    def test_author_page(self):
+        self.assertWithinBudget("author-detail", self.author.get_absolute_url())
+
+    def test_material_page(self):
+        self.assertWithinBudget("edumaterial-detail", self.material.get_absolute_url())
+
+    def test_search_page(self):
+        self.assertWithinBudget("search-material", reverse("search-material"), {"usr_query": "budget"})
+
+
+class ReplicaRoutingTest(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        replicas._lags.clear()
+        self.addCleanup(replicas._lags.clear)
+
+    def test_lag_aware_choice(self):
+        now = time.monotonic()
+        with self.settings(DATABASE_REPLICAS=["replica0", "replica1"]):
+            replicas._lags.update(replica0=(now, 0.5), replica1=(now, 60.0))
+            self.assertEqual(replicas.choose_replica(), "replica0")
+            replicas._lags.update(replica0=(now, float("inf")))
+            self.assertEqual(replicas.choose_replica(), "default")
+
+    def test_router(self):
+        router = replicas.ReplicaRouter()
+        self.assertIsNone(router.db_for_read(models.EduMaterial))
+        state = replicas.RequestState()
+        state.read_alias = "replica0"
+        token = replicas._request_state.set(state)
+        try:
+            self.assertEqual(router.db_for_read(models.EduMaterial), "replica0")
+            self.assertIsNone(router.db_for_read(User))
+            self.assertEqual(router.db_for_write(User), "default")
+            self.assertFalse(state.wrote)
+            # the request reads its own writes
+            self.assertEqual(router.db_for_write(models.Category.users_subscribed.through), "default")
+            self.assertTrue(state.wrote)
+            self.assertIsNone(router.db_for_read(models.EduMaterial))
+        finally:
+            replicas._request_state.reset(token)
+        self.assertFalse(router.allow_migrate("replica0", "catalog"))
+
+    def test_middleware_stickiness(self):
+        seen = []
+        router = replicas.ReplicaRouter()
+
+        def get_response(request):
+            request.resolver_match = resolve(request.path)
+            middleware.process_view(request, None, (), {})
+            # the replica is chosen once, the reads do not look at the lags
+            replicas._lags.clear()
+            seen.append(router.db_for_read(models.EduMaterial))
+            if request.resolver_match.url_name == "category-subscribe":
+                models.Category.objects.filter(pk=1).update(subscriber_count=0)
+            return HttpResponse()
+
+        with self.settings(DATABASE_REPLICAS=["replica0"]):
+            middleware = replicas.ReplicaMiddleware(get_response)
+            factory = RequestFactory()
+            replicas._lags["replica0"] = (time.monotonic(), 0.0)
+            response = middleware(factory.get(reverse("category-detail", args=[1])))
+            self.assertNotIn(replicas.STICKY_COOKIE, response.cookies)
+            self.assertFalse(replicas.replica_reads_enabled())
+
+            # subscribing writes on GET
+            response = middleware(factory.get(reverse("category-subscribe", args=[1])))
+            sticky_until = response.cookies[replicas.STICKY_COOKIE].value
+            response = middleware(factory.post(reverse("edumaterial-create")))
+            self.assertNotIn(replicas.STICKY_COOKIE, response.cookies)
+
+            replicas._lags["replica0"] = (time.monotonic(), 0.0)
+            request = factory.get(reverse("category-detail", args=[1]))
+            request.COOKIES[replicas.STICKY_COOKIE] = sticky_until
+            middleware(request)
+
+        self.assertEqual(seen, ["replica0", None, None, None])
+
+    def test_async_middleware(self):
+        seen = []
+
+        async def get_response(request):
+            request.resolver_match = resolve(request.path)
+            # the handler awaits process_view in the task of the request, and runs the view in a copy of its context
+            await middleware.process_view(request, None, (), {})
+            seen.append(await sync_to_async(replicas.replica_reads_enabled)())
+            if request.method == "POST":
+                await sync_to_async(models.Category.objects.filter(pk=1).update)(subscriber_count=0)
+            return HttpResponse()
+
+        with self.settings(DATABASE_REPLICAS=["default"]):
+            middleware = replicas.ReplicaMiddleware(get_response)
+            self.assertTrue(asyncio.iscoroutinefunction(middleware))
+            self.assertTrue(asyncio.iscoroutinefunction(middleware.process_view))
+            factory = RequestFactory()
+            async_to_sync(middleware)(factory.get(reverse("category-detail", args=[1])))
+            response = async_to_sync(middleware)(factory.post(reverse("edumaterial-create")))
+
+        self.assertEqual(seen, [True, False])
+        self.assertIn(replicas.STICKY_COOKIE, response.cookies)
+        self.assertFalse(replicas.replica_reads_enabled())
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    class FakeConnection:
+        closed = 0
+        autocommit = True
+        status = psycopg2_extensions.TRANSACTION_STATUS_IDLE
+
+        def get_transaction_status(self):
+            return self.status
+
+        def rollback(self):
+            self.status = psycopg2_extensions.TRANSACTION_STATUS_IDLE
+
+        def close(self):
+            self.closed = 1
+
+    def test_reuse_limit_and_discard(self):
+        pool = pooled_postgresql.ConnectionPool("test", max_size=2, timeout=0.05, health_check_interval=30)
+        first = pool.get(self.FakeConnection)
+        second = pool.get(self.FakeConnection)
+        with self.assertRaises(pooled_postgresql.PoolTimeout):
+            pool.get(self.FakeConnection)
+
+        pool.put(first)
+        self.assertIs(pool.get(self.FakeConnection), first)
+
+        # a connection left in a transaction is rolled back, a closed one is replaced
+        first.status = psycopg2_extensions.TRANSACTION_STATUS_INTRANS
+        pool.put(first)
+        self.assertEqual(first.status, psycopg2_extensions.TRANSACTION_STATUS_IDLE)
+        second.close()
+        pool.put(second)
+        self.assertEqual(pool.in_use, 0)
+        self.assertIs(pool.get(self.FakeConnection), first)
+        self.assertIsNot(pool.get(self.FakeConnection), second)
+        self.assertIn('db_pool_connections{alias="test",state="in_use"} 2.0', metrics.registry.generate_latest())
+
 
 class GetPremiumViewTest(TestCase):
     @classmethod
@@ -4,7 +4,10 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.urls import include, path
 
-from . import views
+from . import async_views, views
+
+# under ASGI the file is streamed by the event loop, the other views are sync either way
+material_file = async_views.material_file if settings.ASYNC_VIEWS else views.MaterialFileView.as_view()
 
 urlpatterns = [
     path("", views.IndexView.as_view(), name="index"),
@@ -15,10 +18,13 @@ urlpatterns = [
     path("material/<int:pk>/edit", views.EduMaterialEditView.as_view(), name='edumaterial-edit'),
     path("material/<int:pk>/delete", views.EduMaterialDeleteView.as_view(), name='edumaterial-delete'),
     path("material/<int:pk>", views.EduMaterialDetailView.as_view(), name="edumaterial-detail"),
-    path("material/<int:pk>/file", views.MaterialFileView.as_view(), name="edumaterial-file"),
+    path("material/<int:pk>/file", material_file, name="edumaterial-file"),
+    path("files/<path:name>", views.SignedFileView.as_view(), name="signed-file"),
     path("authors", views.AuthorListView.as_view(), name='author-list'),
     path("author/<int:pk>", views.AuthorDetailView.as_view(), name='author-detail'),
     path("search-material", views.SearchView.as_view(), name='search-material'),
+    path("export", views.CatalogExportView.as_view(), name="catalog-export"),
+    path("autocomplete", views.AutocompleteView.as_view(), name='autocomplete'),
     path('signup', views.SignUpView.as_view(), name='signup'),
     path('accounts/', include('django.contrib.auth.urls')),
     path('get-premium', views.GetPremiumView.as_view(), name='get-premium'),
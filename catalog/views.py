@@ -1,21 +1,22 @@
 """Views for the app."""
 
 import logging
-import threading
 
 from django import forms
+from django.conf import settings
 from django.contrib.auth.mixins import (LoginRequiredMixin,
-                                        PermissionRequiredMixin)
+                                        PermissionRequiredMixin,
+                                        UserPassesTestMixin)
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.messages.views import SuccessMessageMixin
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, SuspiciousFileOperation
 from django.core.files.storage import default_storage as storage
-from django.core.mail import send_mass_mail
 from django.db.models.query import QuerySet
 from django.forms import Form
-from django.http import (FileResponse, Http404, HttpRequest, HttpResponse,
-                         HttpResponseRedirect)
+from django.http import (Http404, HttpRequest, HttpResponse,
+                         HttpResponseRedirect, JsonResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
 from django.urls import reverse_lazy
 from django.views import View
@@ -23,37 +24,16 @@ from django.views.generic import (DeleteView, DetailView, ListView,
                                   TemplateView, UpdateView)
 from django.views.generic.edit import CreateView, FormView
 
+from . import (autocomplete, export, extraction, facets, files, metrics,
+               notifications, replicas, search)
 from .forms import GetUserCardDataForm, UserRegisterForm
+from .fragments import FragmentCacheMixin
 from .models import Author, Category, EduMaterial
+from .pagination import KeysetPaginationMixin, QuerySetSource
 
-logging.basicConfig(filename="logs.txt", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def send_notify_about_category(category_id: int):
-    """Send an email to all users subscribed to the category."""
-    try:
-        category = Category.objects.get(id=category_id)
-    except Exception as e:
-        logger.warning("cannot send notify about category")
-        logger.warning(str(e))
-        return
-
-    logger.info("Send notifications about the update of " + category.name + " category")
-
-    users = [user.email for user in category.users_subscribed.all()]
-
-    if len(users) == 0:
-        logger.warning("No users to send notifications about the update of " + category.name + " category")
-        return
-
-    subject = "Category '" + category.name + "' was updated"
-    msg = "The category was updated! Don't forget to check it out!"
-    message = (subject, msg, 'educatalogteam@example.com', users)
-    send_mass_mail((message,), fail_silently=False)
-    logger.warning("Notifications sent successfully")
-
-
 class SignUpView(SuccessMessageMixin, CreateView):
     """The view to sign up a user."""
 
@@ -63,32 +43,67 @@ class SignUpView(SuccessMessageMixin, CreateView):
     success_message = "Your account was created successfully!"
 
 
+def check_file_access(user, material: EduMaterial):
+    """Raise PermissionDenied if the user cannot download the file of the material."""
+    if material.access_type == "s":
+        if not user.is_authenticated:
+            logger.error("user is not authenticated and the material access type is signed up only!")
+            raise PermissionDenied
+    elif material.access_type == "p":
+        if not user.has_perm("catalog.can_view_premium"):
+            logger.error("user cannot view premium materials but requests a premium material download!")
+            raise PermissionDenied
+
+
+def signed_file_redirect(material: EduMaterial) -> HttpResponse:
+    """Redirect to a signed url of the material file."""
+    response = HttpResponseRedirect(storage.signed_url(material.pdf_file.name, settings.PDF_SIGNED_URL_TTL))
+    response["Cache-Control"] = "private, no-store"
+    return response
+
+
 class MaterialFileView(View):
     """The view to access the actual pdf file."""
 
-    def get(self, request: HttpRequest, pk: int) -> FileResponse:
+    def get(self, request: HttpRequest, pk: int) -> HttpResponse:
         """Check if the user has permissions to access the file."""
         logger.info("request for file: " + str(pk))
         logger.info("getting the material")
         material = get_object_or_404(EduMaterial, pk=pk)
+        check_file_access(request.user, material)
 
-        if material.access_type == "s":
-            if not request.user.is_authenticated:
-                logger.error("user is not authenticated and the material access type is signed up only!")
-                raise PermissionDenied
-        elif material.access_type == "p":
-            if not request.user.has_perm("catalog.can_view_premium"):
-                logger.error("user cannot view premium materials but requests a premium material download!")
-                raise PermissionDenied
-
-        fh = storage.open(material.pdf_file.name, "rb")
+        if settings.PDF_DELIVERY == "signed" and hasattr(storage, "signed_url"):
+            return signed_file_redirect(material)
 
         try:
-            return FileResponse(fh, content_type="application/pdf")
+            fh = files.pdf_cache.open(material.pdf_file.name, storage)
         except FileNotFoundError:
             logger.error("there is no such file on the server")
             raise Http404()
 
+        return files.serve_file(request, fh, material.pdf_file.name, "application/pdf", storage)
+
+
+class SignedFileView(View):
+    """The view to download a file by a signed url of the SignedFileSystemStorage."""
+
+    def get(self, request: HttpRequest, name: str) -> HttpResponse:
+        """Check the signature and send the file."""
+        if not hasattr(storage, "verify"):
+            raise Http404()
+        if not storage.verify(name, request.GET.get("expires"), request.GET.get("signature")):
+            logger.error("invalid or expired signed url for file: " + name)
+            raise PermissionDenied
+
+        try:
+            fh = open(storage.path(name), "rb")
+        except SuspiciousFileOperation:
+            raise PermissionDenied
+        except (FileNotFoundError, IsADirectoryError):
+            raise Http404()
+
+        return files.serve_file(request, fh, name, "application/pdf", storage)
+
 
 class IndexView(TemplateView):
     """Main page."""
@@ -101,11 +116,26 @@ class CategoriesView(ListView):
 
     model = Category
 
+    def get_queryset(self) -> QuerySet:
+        """Get the root categories, their counters are stored with them."""
+        return Category.objects.roots()
+
 
-class CategoryDetailView(DetailView):
+class CategoryDetailView(FragmentCacheMixin, KeysetPaginationMixin, DetailView):
     """View that shows the category and all nested categories."""
 
     model = Category
+    paginate_by = 20
+    fragment_models = (Category, EduMaterial, Author)
+
+    def get_context_data(self, **kwargs) -> dict:
+        """Add the path to the category, its subcategories and a page of its materials."""
+        context = super().get_context_data(**kwargs)
+        context["ancestors"] = self.object.ancestors()
+        context["subcategories"] = self.object.category_set.all()
+        materials = QuerySetSource(self.object.edumaterial_set.select_related("author"), ("title", "pk"))
+        context["material_page"] = self.keyset_page(materials, self.paginate_by)
+        return context
 
 
 class SubscribeCategoryView(LoginRequiredMixin, TemplateView):
@@ -119,16 +149,16 @@ class SubscribeCategoryView(LoginRequiredMixin, TemplateView):
         pk = kwargs['pk']
         category = get_object_or_404(Category, pk=pk)
         category.users_subscribed.add(request.user)
-        category.save()
         logger.info("subscribe to category with index: " + str(pk))
 
         return super(SubscribeCategoryView, self).get(request, *args, **kwargs)
 
 
-class EduMaterialDetailView(DetailView):
+class EduMaterialDetailView(FragmentCacheMixin, DetailView):
     """Information about a educational material."""
 
-    model = EduMaterial
+    queryset = EduMaterial.objects.select_related("author")
+    fragment_models = (EduMaterial, Author)
 
 
 class EduMaterialEditView(UpdateView):
@@ -137,6 +167,13 @@ class EduMaterialEditView(UpdateView):
     model = EduMaterial
     fields = ["title", "summary", "access_type", "pdf_file", "category"]
 
+    def form_valid(self, form: forms.Form) -> HttpResponse:
+        """Queue the text extraction if the file was replaced."""
+        response = super().form_valid(form)
+        if "pdf_file" in form.changed_data:
+            extraction.schedule_extraction(self.object)
+        return response
+
 
 class EduMaterialDeleteView(DeleteView):
     """View to delete a material."""
@@ -164,56 +201,105 @@ class EduMaterialCreateView(PermissionRequiredMixin, CreateView):
         return form
 
     def form_valid(self, form: forms.Form) -> HttpResponse:
-        """Start threads that notify users."""
+        """Queue the notifications of the users subscribed to the material categories and the text extraction."""
         responce = super().form_valid(form)
-        categories_to_update = []
-
-        for category in form.cleaned_data['category']:
-            while category is not None:
-                if category not in categories_to_update:
-                    categories_to_update.append(category)
-
-                category = category.parent_category
-
-        logger.info("starting threads that send messages about the category update")
-        for category in categories_to_update:
-            print(category)
-            print(category.users_subscribed.all())
-
-            # send_notify_about_category(category_id=category.id)
-            thread = threading.Thread(target=send_notify_about_category, args=(category.id,))
-            thread.start()
+        logger.info("queueing messages about the category update")
+        category_ids = [category.id for category in form.cleaned_data['category']]
+        notifications.schedule_category_update(self.object.id, category_ids)
+        extraction.schedule_extraction(self.object)
 
         return responce
 
 
-class AuthorListView(ListView):
+class AuthorListView(KeysetPaginationMixin, ListView):
     """List of authors."""
 
     model = Author
+    paginate_by = 50
+    keyset_ordering = ("-last_name", "-pk")
 
 
-class AuthorDetailView(DetailView):
+class AuthorDetailView(FragmentCacheMixin, KeysetPaginationMixin, DetailView):
     """Author page."""
 
     model = Author
+    paginate_by = 20
+    fragment_models = (Author, EduMaterial)
+
+    def get_context_data(self, **kwargs) -> dict:
+        """Add a page of the author materials."""
+        context = super().get_context_data(**kwargs)
+        materials = QuerySetSource(self.object.edumaterial_set.all(), ("title", "pk"))
+        context["material_page"] = self.keyset_page(materials, self.paginate_by)
+        return context
 
 
-class SearchView(ListView):
+class SearchView(KeysetPaginationMixin, ListView):
     """View for searching for a particular material."""
 
     model = EduMaterial
     template_name = "catalog/search.html"
+    context_object_name = "edumaterial_list"
+    paginate_by = 20
 
-    def get_queryset(self) -> QuerySet:
-        """Get the materials that contain the query."""
+    def get_queryset(self):
+        """Get the materials that match the query and the facet filters, best matches first."""
         usr_query = self.request.GET['usr_query']
         logger.info("user searched: " + usr_query)
-        filtered_objects = EduMaterial.objects.filter(title__icontains=usr_query) | \
-                           EduMaterial.objects.filter(summary__icontains=usr_query) | \
-                           EduMaterial.objects.filter(author__first_name__icontains=usr_query) | \
-                           EduMaterial.objects.filter(author__last_name__icontains=usr_query)
-        return filtered_objects
+        source, self.facets = facets.facet_search(search.search_materials(usr_query), self.request.GET)
+        return source
+
+    def get(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        """Search and load the page of results, timing both."""
+        with metrics.SEARCH_LATENCY.time(backend=search.get_backend().name):
+            return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs) -> dict:
+        """Load the page of results and add the facet counts."""
+        context = super().get_context_data(**kwargs)
+        context["facets"] = self.facets
+        # the rows of the page are fetched lazily, count them in the search time
+        len(context["page_obj"])
+        return context
+
+
+class AutocompleteView(View):
+    """Suggestions of material titles, author and category names for the search box."""
+
+    def get(self, request: HttpRequest) -> JsonResponse:
+        """Get the suggestions for the prefix in the q parameter."""
+        suggestions = autocomplete.prefix_index.suggest(request.GET.get("q", ""), settings.AUTOCOMPLETE_LIMIT)
+        return JsonResponse({"suggestions": suggestions})
+
+
+class CatalogExportView(UserPassesTestMixin, View):
+    """Download of the whole catalog for the staff, as JSON lines or CSV."""
+
+    login_url = reverse_lazy("login")
+
+    def test_func(self) -> bool:
+        """Only the staff can export the catalog."""
+        return self.request.user.is_staff
+
+    def get(self, request: HttpRequest) -> HttpResponse:
+        """Stream the catalog in the format of the format parameter, compressed if gzip is set."""
+        fmt = request.GET.get("format", "jsonl")
+        if fmt not in export.FORMATS:
+            return HttpResponse("Unknown format", status=400)
+        compress = bool(request.GET.get("gzip"))
+        logger.info("catalog export by " + str(request.user) + " as " + fmt)
+
+        # the rows are read while the response is streamed, after the request is done with the database routing
+        chunks = export.export_catalog(fmt, compress, using=replicas.choose_replica())
+        filename = "catalog." + fmt
+        if compress:
+            response = StreamingHttpResponse(chunks, content_type="application/gzip")
+            filename += ".gz"
+        else:
+            response = StreamingHttpResponse(chunks, content_type=export.FORMATS[fmt] + "; charset=utf-8")
+        response["Content-Disposition"] = 'attachment; filename="' + filename + '"'
+        response["Cache-Control"] = "private, no-store"
+        return response
 
 
 class GetPremiumView(FormView):
@@ -9,8 +9,12 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+
+from edu_catalog.handlers import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'edu_catalog.settings')
 
-application = get_asgi_application()
+# like django.core.asgi.get_asgi_application, with the handler streaming from the request thread
+django.setup(set_prefix=False)
+application = ASGIHandler()
@@ -0,0 +1,48 @@
+"""ASGI handler that streams the responses without blocking the event loop."""
+
+from asgiref.sync import sync_to_async
+from django.core.handlers import asgi
+from django.http.response import HttpResponseBase
+
+# returned by next when the streamed content is exhausted
+_END = object()
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    """Django's ASGI handler, except that the streamed content is produced in the thread of the request.
+
+    Django 4.0 iterates the streaming responses in the event loop, where the
+    catalog export cannot query the database and every read of a file blocks
+    the other requests. Here every part is pulled by the thread the view ran
+    in, which also closes its database connections when the response is closed.
+    """
+
+    async def send_response(self, response: HttpResponseBase, send):
+        """Send the response, streaming its content part by part from the thread of the request."""
+        if not response.streaming:
+            await super().send_response(response, send)
+            return
+
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode("ascii")
+            if isinstance(value, str):
+                value = value.encode("latin1")
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b"Set-Cookie", cookie.output(header="").encode("ascii").strip()))
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+
+        parts = iter(response)
+        next_part = sync_to_async(next, thread_sensitive=True)
+        try:
+            while True:
+                part = await next_part(parts, _END)
+                if part is _END:
+                    break
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body"})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
@@ -0,0 +1,44 @@
+"""Middleware of the project that is not specific to an app."""
+
+import asyncio
+import types
+
+from asgiref.sync import sync_to_async
+from django.http import HttpRequest, HttpResponse
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoise, working in both sync and async handler chains.
+
+    WhiteNoise 6.2 is sync only, so under ASGI every request would hop to a
+    thread and back to pass it. Here only the requests of static files do, to
+    open the file.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response: types.FunctionType = None, *args, **kwargs):
+        """Find the static files and init self.get_response with a function to get the response."""
+        super().__init__(get_response, *args, **kwargs)
+        if asyncio.iscoroutinefunction(self.get_response):
+            # mark the instance as a coroutine function, like django.utils.deprecation.MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        """Serve the static file of the path, or get the response of the other middleware."""
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        """Serve the static file of the path from a thread, or await the response of the other middleware."""
+        if self.autorefresh:
+            # looks the files up on the disk, only in development
+            static_file = await sync_to_async(self.find_file, thread_sensitive=False)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is None:
+            return await self.get_response(request)
+        return await sync_to_async(self.serve, thread_sensitive=False)(static_file, request)
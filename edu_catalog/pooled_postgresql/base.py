@@ -0,0 +1,147 @@
+"""PostgreSQL backend that keeps the connections of the process in a pool.
+
+Django opens a connection per thread and, with CONN_MAX_AGE=0, closes it at
+the end of every request. With this backend closing gives the connection back
+to the pool of its database and opening takes an idle one, checking first
+that it is still alive if it has been idle for a while. The pool is set with
+the POOL entry of the database settings: MAX_SIZE, TIMEOUT (seconds to wait
+for a free connection) and HEALTH_CHECK_INTERVAL.
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+import psycopg2
+from django.db.backends.postgresql import base
+from psycopg2 import extensions
+
+from logmiddleware import metrics
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """No connection of the pool became free in time."""
+
+
+class ConnectionPool:
+    """Connections to one database, at most max_size of them open at a time."""
+
+    def __init__(self, alias: str, max_size: int, timeout: float, health_check_interval: float):
+        """Start with no connections."""
+        self.alias = alias
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.in_use = 0
+        self._idle: List[Tuple[object, float]] = []
+        self._condition = threading.Condition()
+
+    def get(self, connect: Callable[[], object]):
+        """Take an idle connection that is alive, or open a new one with connect if the pool is not full."""
+        while True:
+            connection, idle_since = self._checkout()
+            if connection is None:
+                try:
+                    return connect()
+                except BaseException:
+                    self._release()
+                    raise
+            if self._healthy(connection, idle_since):
+                return connection
+            self._discard(connection)
+
+    def put(self, connection):
+        """Give the connection back, closing it if it is broken or in a failed transaction."""
+        try:
+            if not connection.closed and connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+            reusable = not connection.closed and \
+                connection.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+        except psycopg2.Error:
+            reusable = False
+
+        if not reusable:
+            self._discard(connection)
+            return
+        with self._condition:
+            self.in_use -= 1
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+        self._update_metrics()
+
+    def _checkout(self) -> Tuple[object, float]:
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while not self._idle and self.in_use >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout("no free connection to " + self.alias + " after " + str(self.timeout) + " s")
+                self._condition.wait(remaining)
+            self.in_use += 1
+            # the most recently used connection is the most likely to be alive
+            connection, idle_since = self._idle.pop() if self._idle else (None, 0.0)
+        self._update_metrics()
+        return connection, idle_since
+
+    def _healthy(self, connection, idle_since: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            if not connection.autocommit:
+                connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, connection):
+        metrics.DB_POOL_DISCARDED.inc(alias=self.alias)
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        self._release()
+
+    def _release(self):
+        with self._condition:
+            self.in_use -= 1
+            self._condition.notify()
+        self._update_metrics()
+
+    def _update_metrics(self):
+        metrics.DB_POOL_CONNECTIONS.set(self.in_use, alias=self.alias, state="in_use")
+        metrics.DB_POOL_CONNECTIONS.set(len(self._idle), alias=self.alias, state="idle")
+
+
+# pools of this process by database alias, a forked process starts with none
+_pools: Dict[Tuple[int, str], ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias: str, settings_dict: dict) -> ConnectionPool:
+    """Get the pool of the database for this process."""
+    key = (os.getpid(), alias)
+    with _pools_lock:
+        if key not in _pools:
+            options = settings_dict.get("POOL", {})
+            _pools[key] = ConnectionPool(alias, options.get("MAX_SIZE", 10), options.get("TIMEOUT", 10),
+                                         options.get("HEALTH_CHECK_INTERVAL", 30))
+        return _pools[key]
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """The PostgreSQL backend, taking its connections from the pool and giving them back on close."""
+
+    def get_new_connection(self, conn_params: dict):
+        """Get a connection of the pool."""
+        return get_pool(self.alias, self.settings_dict).get(lambda: super(DatabaseWrapper, self)
+                                                            .get_new_connection(conn_params))
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                get_pool(self.alias, self.settings_dict).put(self.connection)
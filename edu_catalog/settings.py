@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 import os
+import sys
+import tempfile
 from pathlib import Path
 
 import dj_database_url
@@ -46,6 +48,7 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
 
     'catalog.apps.CatalogConfig',
+    'logmiddleware.apps.LogmiddlewareConfig',
     'django_nose',
 
     'cloudinary_storage',
@@ -54,7 +57,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'edu_catalog.middleware.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -63,6 +66,8 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
     'logmiddleware.request_log.RequestLogMiddleware',
+    'logmiddleware.profiling.ProfilingMiddleware',
+    'catalog.replicas.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'edu_catalog.urls'
@@ -143,7 +148,59 @@ CLOUDINARY_STORAGE = {
 
 MEDIA_URL = '/public/'
 
-DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
+DEFAULT_FILE_STORAGE = os.environ.get('DEFAULT_FILE_STORAGE', 'catalog.storage.SignedMediaCloudinaryStorage')
+
+# 'cache' serves the files through the local cache below, 'signed' redirects to a signed url of the storage
+PDF_DELIVERY = os.environ.get('PDF_DELIVERY', 'cache')
+
+PDF_SIGNED_URL_TTL = 300
+
+# Local copies of the material files, served instead of streaming them from the storage on every download
+PDF_CACHE_DIR = os.environ.get('PDF_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'edu_catalog_pdf_cache'))
+
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_BYTES', 1024 ** 3))
+
+# When set, the files are sent by the front server (nginx internal location serving PDF_CACHE_DIR)
+PDF_ACCEL_REDIRECT_PREFIX = os.environ.get('PDF_ACCEL_REDIRECT_PREFIX', '')
+
+# A small in-process cache in front of the cache shared by all workers: Redis when REDIS_URL is set,
+# otherwise a directory on this machine (enough for the gunicorn workers of one dyno and for tests)
+CACHES = {
+    'default': {
+        'BACKEND': 'catalog.cache.TwoTierCache',
+        'OPTIONS': {
+            'L2': 'shared',
+            'L1_MAX_ENTRIES': 1000,
+            'L1_TIMEOUT': 5,
+            'GENERATION_CHECK_INTERVAL': 0.5,
+        },
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_URL'],
+    } if os.environ.get('REDIS_URL') else {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'edu_catalog_cache')),
+    },
+}
+
+# Seconds the rendered category, material and author pages are cached, they are invalidated by model changes anyway
+FRAGMENT_CACHE_TIMEOUT = 600
+
+# Only the best matches of a search are paginated, and cached for this many seconds
+SEARCH_MAX_RESULTS = 1000
+
+SEARCH_CACHE_TIMEOUT = 600
+
+AUTOCOMPLETE_LIMIT = 10
+
+# Processes parsing the material PDF files for the search, and the most terms kept of a file
+TEXT_EXTRACTION_PROCESSES = 2
+
+TEXT_MAX_TERMS = 20000
+
+# Materials read per query by the catalog export
+EXPORT_CHUNK_SIZE = 1000
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
@@ -156,15 +213,117 @@ LOGOUT_REDIRECT_URL = '/'
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+NOTIFY_EMAIL_FROM = 'educatalogteam@example.com'
+
+NOTIFY_EMAIL_CHUNK_SIZE = 100
+
+# 'instant' sends an email for every new material, 'digest' leaves it to `manage.py send_digests`
+NOTIFY_MODE = os.environ.get('NOTIFY_MODE', 'instant')
+
+NOTIFY_DIGEST_WINDOW_HOURS = 24
+
+# `manage.py test` logs into a temporary file instead of the log of the working tree
+TESTING = sys.argv[1:2] == ['test']
+
+LOG_FILE = os.environ.get('LOG_FILE') or \
+    (os.path.join(tempfile.gettempdir(), 'edu_catalog_test_logs.txt') if TESTING else 'logs.txt')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'json_file': {
+            'class': 'logmiddleware.handlers.BatchedJsonLinesHandler',
+            'filename': LOG_FILE,
+        },
+    },
+    'root': {
+        'handlers': ['json_file'],
+        'level': 'INFO',
+    },
+}
+
+# Background jobs, run by `manage.py run_worker`
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+
+JOB_POLL_INTERVAL = 1.0
+
+JOB_LOCK_TIMEOUT = 600
+
+JOB_RETRY_BACKOFF = 10
+
+JOB_RETRY_BACKOFF_MAX = 3600
+
+# Seconds the done and failed jobs are kept before the worker deletes them
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 7 * 24 * 3600))
+
+# Shared directory of the per-process metric files, empty to keep the metrics of each process in memory.
+# Must be emptied before the server starts, e.g. a fresh tmpfs directory per deploy.
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+
+# Profiling of requests: the sampled fraction of all requests and the run time in seconds from which
+# a request is always profiled. The middleware is off when neither is set.
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+
+PROFILE_SLOW_THRESHOLD = float(os.environ['PROFILE_SLOW_THRESHOLD']) if os.environ.get('PROFILE_SLOW_THRESHOLD') \
+    else None
+
+# Seconds between two stack samples of a profiled request
+PROFILE_INTERVAL = 0.005
+
+# Only the slowest profiles are kept
+PROFILE_KEEP = 50
+
+PROFILE_MAX_QUERIES = 500
+
+# /metrics is only shown to the staff, and to scrapers sending an "Authorization: Bearer <token>" header when set
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 
 NOSE_ARGS = [
     '--cover-package=catalog',
 ]
 
+# 'asgi' when the site is served by edu_catalog.asgi, e.g. with uvicorn workers: the file view is then async
+SERVER_INTERFACE = os.environ.get('SERVER_INTERFACE', 'wsgi')
+
+ASYNC_VIEWS = SERVER_INTERFACE == 'asgi'
+
 # Heroku: Update database configuration from $DATABASE_URL.
-db_from_env = dj_database_url.config(conn_max_age=500)
+# Under ASGI every request runs its sync code in a new thread, so persistent connections would never be reused.
+# With the pool the connections are given back to it at the end of every request instead.
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 0))
+
+CONN_MAX_AGE = 0 if ASYNC_VIEWS or DATABASE_POOL_SIZE else 500
+
+db_from_env = dj_database_url.config(conn_max_age=CONN_MAX_AGE)
 DATABASES['default'].update(db_from_env)
 
+# Read replicas of the primary, comma separated database urls. The catalog read views read from them.
+DATABASE_REPLICAS = []
+for number, url in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(','))):
+    DATABASES['replica%d' % number] = dict(dj_database_url.parse(url, conn_max_age=CONN_MAX_AGE),
+                                           TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append('replica%d' % number)
+
+if DATABASE_POOL_SIZE:
+    # the pool wraps the PostgreSQL backend only, e.g. a local SQLite database keeps its engine
+    for database in DATABASES.values():
+        if database['ENGINE'] not in ('django.db.backends.postgresql', 'django.db.backends.postgresql_psycopg2'):
+            continue
+        database.update(ENGINE='edu_catalog.pooled_postgresql',
+                        POOL={'MAX_SIZE': DATABASE_POOL_SIZE, 'TIMEOUT': 10, 'HEALTH_CHECK_INTERVAL': 30})
+
+DATABASE_ROUTERS = ['catalog.replicas.ReplicaRouter']
+
+# Replicas further behind than this many seconds are not read from, their lag is checked at most once per interval
+REPLICA_MAX_LAG = 5
+
+REPLICA_LAG_CHECK_INTERVAL = 5
+
+# Seconds a user reads from the primary after a write
+REPLICA_STICKY_SECONDS = 10
+
 # Simplified static file serving.
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
@@ -20,8 +20,11 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
 from django.views.generic import RedirectView
+from logmiddleware.views import prometheus_metrics, request_stats
 
 urlpatterns = [
+    path('metrics', prometheus_metrics, name='metrics'),
+    path('admin/request-stats/', request_stats, name='request-stats'),
     path('admin/', admin.site.urls),
     path('catalog/', include('catalog.urls')),
     path('', RedirectView.as_view(url='catalog/', permanent=True)),
@@ -0,0 +1,59 @@
+from django.contrib import admin
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html, format_html_join
+
+from .models import RequestProfile
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('path', 'url_name', 'status_code', 'run_time_ms', 'query_count', 'trigger', 'created_at')
+    list_filter = ('trigger', 'url_name')
+    search_fields = ('path',)
+    fields = ('method', 'path', 'url_name', 'status_code', 'run_time_ms', 'trigger', 'created_at',
+              'stacks_download', 'top_stacks', 'query_list')
+    readonly_fields = fields
+
+    def has_add_permission(self, request) -> bool:
+        return False
+
+    def has_change_permission(self, request, obj=None) -> bool:
+        return False
+
+    def get_urls(self):
+        urls = [
+            path('<int:pk>/stacks.txt', self.admin_site.admin_view(self.stacks_view),
+                 name='logmiddleware_requestprofile_stacks'),
+        ]
+        return urls + super().get_urls()
+
+    def stacks_view(self, request, pk: int) -> HttpResponse:
+        """Download the collapsed stacks, for flamegraph.pl or speedscope."""
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        return HttpResponse(profile.collapsed_stacks, content_type='text/plain; charset=utf-8')
+
+    @admin.display(description='run time, ms', ordering='run_time')
+    def run_time_ms(self, obj: RequestProfile) -> int:
+        return round(obj.run_time * 1000)
+
+    @admin.display(description='queries')
+    def query_count(self, obj: RequestProfile) -> int:
+        return len(obj.queries)
+
+    @admin.display(description='collapsed stacks')
+    def stacks_download(self, obj: RequestProfile) -> str:
+        url = reverse('admin:logmiddleware_requestprofile_stacks', args=[obj.pk])
+        return format_html('<a href="{}">stacks.txt</a> (sampled every {} ms)', url, obj.sample_interval * 1000)
+
+    @admin.display(description='top stacks')
+    def top_stacks(self, obj: RequestProfile) -> str:
+        lines = obj.collapsed_stacks.splitlines()[:20]
+        return format_html('<pre style="white-space: pre-wrap">{}</pre>', '\n'.join(lines))
+
+    @admin.display(description='queries, ms')
+    def query_list(self, obj: RequestProfile) -> str:
+        rows = format_html_join('\n', '{}  {}', ((round(query['time'] * 1000, 1), query['sql'])
+                                                 for query in obj.queries))
+        return format_html('<pre style="white-space: pre-wrap">{}</pre>', rows)
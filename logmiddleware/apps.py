@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class LogmiddlewareConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'logmiddleware'
+    verbose_name = 'Request profiling'
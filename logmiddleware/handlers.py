@@ -0,0 +1,104 @@
+"""
+Logging handler that writes JSON lines from a background thread.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+STOP = object()
+
+
+class BatchedJsonLinesHandler(logging.Handler):
+    """Queue the records and write them to the file in batches, one JSON object per line.
+
+    The logging thread only puts the record into a queue; formatting and the file
+    writes happen on a daemon thread. Dict messages are merged into the JSON object.
+    """
+
+    def __init__(self, filename: str, batch_size: int = 256, flush_interval: float = 0.5):
+        """Remember the file, the writer thread is started by the first record."""
+        super().__init__()
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.SimpleQueue()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_writer(self):
+        # a forked worker process does not inherit the thread, start a new one there
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self.queue = queue.SimpleQueue()
+                self._thread = threading.Thread(target=self._write_loop, name="log-writer", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def emit(self, record: logging.LogRecord):
+        """Queue the record."""
+        self._ensure_writer()
+        self.queue.put_nowait(record)
+
+    def to_json(self, record: logging.LogRecord) -> str:
+        """Convert the record to a JSON line."""
+        data = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        if isinstance(record.msg, dict):
+            data.update(record.msg)
+        else:
+            data["message"] = record.getMessage()
+        if record.exc_info:
+            data["exception"] = logging.Formatter().formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if record is STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.to_json(record) + "\n")
+            except Exception:
+                self.handleError(record)
+        try:
+            with open(self.filename, "a", encoding="utf-8") as fh:
+                fh.writelines(lines)
+        except OSError:
+            self.handleError(batch[0])
+
+    def flush(self):
+        """Wait until the queued records are written."""
+        if self._thread is not None and self._pid == os.getpid():
+            self.queue.put_nowait(STOP)
+            self._thread.join()
+            self._pid = None
+
+    def close(self):
+        """Write the queued records and stop the writer thread."""
+        self.flush()
+        super().close()
@@ -0,0 +1,423 @@
+"""
+Prometheus metrics in the text exposition format.
+
+Every process keeps its values in a memory-mapped file of its own inside
+METRICS_DIR, so an update is a lock held by this process only. The /metrics
+view of any worker sums the files of all workers. Without METRICS_DIR the
+values are kept in memory and only the serving process is reported.
+"""
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import weakref
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+INITIAL_FILE_SIZE = 64 * 1024
+
+HEADER = struct.Struct("i4x")
+KEY_LENGTH = struct.Struct("i")
+VALUE = struct.Struct("d")
+
+
+class MmapedValues:
+    """Float values by key in a memory-mapped file written by a single process."""
+
+    def __init__(self, path: str):
+        """Open or create the file and index the values already in it."""
+        self._file = open(path, "a+b")
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(INITIAL_FILE_SIZE)
+        self._capacity = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+        self._positions = {}
+
+        self._used = HEADER.unpack_from(self._map, 0)[0]
+        if self._used == 0:
+            self._used = HEADER.size
+            HEADER.pack_into(self._map, 0, self._used)
+        for key, _, position in self._entries(self._map, self._used):
+            self._positions[key] = position
+
+    @staticmethod
+    def _entries(data, used: int) -> Iterator[Tuple[str, float, int]]:
+        position = HEADER.size
+        while position < used:
+            length = KEY_LENGTH.unpack_from(data, position)[0]
+            key = bytes(data[position + KEY_LENGTH.size:position + KEY_LENGTH.size + length]).decode()
+            # the key is padded so that the value is aligned to 8 bytes
+            position += KEY_LENGTH.size + length + (-(KEY_LENGTH.size + length) % 8)
+            yield key, VALUE.unpack_from(data, position)[0], position
+            position += VALUE.size
+
+    @classmethod
+    def read_file(cls, path: str) -> Iterator[Tuple[str, float]]:
+        """Read all values of a file, possibly written by another process."""
+        with open(path, "rb") as fh:
+            data = fh.read()
+        if len(data) < HEADER.size:
+            return
+        for key, value, _ in cls._entries(data, HEADER.unpack_from(data, 0)[0]):
+            yield key, value
+
+    def _add_key(self, key: str) -> int:
+        encoded = key.encode()
+        padding = -(KEY_LENGTH.size + len(encoded)) % 8
+        entry = KEY_LENGTH.pack(len(encoded)) + encoded + b" " * padding + VALUE.pack(0.0)
+
+        while self._used + len(entry) > self._capacity:
+            self._capacity *= 2
+            self._file.truncate(self._capacity)
+            self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), self._capacity)
+
+        self._map[self._used:self._used + len(entry)] = entry
+        position = self._used + len(entry) - VALUE.size
+        self._used += len(entry)
+        # the header is written last, so readers never see a partial entry
+        HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def add(self, key: str, amount: float):
+        """Add the amount to the value."""
+        position = self._positions.get(key)
+        if position is None:
+            position = self._add_key(key)
+        VALUE.pack_into(self._map, position, VALUE.unpack_from(self._map, position)[0] + amount)
+
+    def set(self, key: str, value: float):
+        """Replace the value."""
+        position = self._positions.get(key)
+        if position is None:
+            position = self._add_key(key)
+        VALUE.pack_into(self._map, position, value)
+
+    def items(self) -> Iterable[Tuple[str, float]]:
+        """Get all values of this process."""
+        return [(key, VALUE.unpack_from(self._map, position)[0]) for key, position in self._positions.items()]
+
+
+class MemoryValues:
+    """Float values by key kept in memory."""
+
+    def __init__(self):
+        """Start with no values."""
+        self._values = defaultdict(float)
+
+    def add(self, key: str, amount: float):
+        """Add the amount to the value."""
+        self._values[key] += amount
+
+    def set(self, key: str, value: float):
+        """Replace the value."""
+        self._values[key] = value
+
+    def items(self) -> Iterable[Tuple[str, float]]:
+        """Get all values."""
+        return list(self._values.items())
+
+
+class Registry:
+    """The metrics of the app and the values of this process."""
+
+    def __init__(self):
+        """Start with no metrics."""
+        self.metrics: Dict[str, "Metric"] = {}
+        self.collectors: List[Callable[[], Iterable[Tuple[str, dict, float]]]] = []
+        self._lock = threading.Lock()
+        self._values = None
+        self._pid = None
+
+    def register(self, metric: "Metric") -> "Metric":
+        """Add the metric to the exposition."""
+        self.metrics[metric.name] = metric
+        return metric
+
+    def collector(self, func: Callable) -> Callable:
+        """Register a function returning (metric name, labels, value) samples computed at scrape time."""
+        self.collectors.append(func)
+        return func
+
+    def _store(self):
+        # a forked worker must not write into the file of its parent
+        if self._pid != os.getpid():
+            directory = settings.METRICS_DIR
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                self._values = MmapedValues(os.path.join(directory, "%d.db" % os.getpid()))
+                # the file may be left by a dead process with the same pid, its gauges are not ours
+                for key, _ in self._values.items():
+                    metric = self.metrics.get(json.loads(key)[0])
+                    if metric is not None and metric.type == "gauge":
+                        self._values.set(key, 0.0)
+            else:
+                self._values = MemoryValues()
+            self._pid = os.getpid()
+        return self._values
+
+    def add(self, key: str, amount: float):
+        """Add the amount to the value of this process."""
+        with self._lock:
+            self._store().add(key, amount)
+
+    def set(self, key: str, value: float):
+        """Replace the value of this process."""
+        with self._lock:
+            self._store().set(key, value)
+
+    def _process_values(self) -> Iterator[Tuple[str, float, bool]]:
+        """Get (key, value, process alive) of all processes."""
+        directory = settings.METRICS_DIR
+        if not directory:
+            with self._lock:
+                items = self._store().items()
+            for key, value in items:
+                yield key, value, True
+            return
+
+        with self._lock:
+            self._store()
+        for path in glob.glob(os.path.join(directory, "*.db")):
+            alive = _process_alive(int(os.path.splitext(os.path.basename(path))[0]))
+            for key, value in MmapedValues.read_file(path):
+                yield key, value, alive
+
+    def generate_latest(self) -> str:
+        """Render all metrics in the text exposition format."""
+        samples = defaultdict(float)
+        for key, value, alive in self._process_values():
+            name, sample, labels = json.loads(key)
+            metric = self.metrics.get(name)
+            if metric is None or (metric.type == "gauge" and not alive):
+                continue
+            samples[(name, sample, tuple(tuple(label) for label in labels))] += value
+
+        by_metric = defaultdict(list)
+        for (name, sample, labels), value in samples.items():
+            by_metric[name].append((sample, labels, value))
+        for func in self.collectors:
+            for name, labels, value in func():
+                by_metric[name].append((name, tuple(sorted(labels.items())), value))
+
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append("# HELP %s %s" % (name, metric.documentation))
+            lines.append("# TYPE %s %s" % (name, metric.type))
+            for sample, labels, value in metric.expose(by_metric.get(name, [])):
+                lines.append(sample + _format_labels(labels) + " " + _format_value(value))
+        return "\n".join(lines) + "\n"
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    labels = list(labels)
+    if not labels:
+        return ""
+    escaped = ('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+               for name, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+registry = Registry()
+
+
+class Metric:
+    """A named metric with optional labels."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 registry: Registry = registry):
+        """Define the metric and register it."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        registry.register(self)
+
+    def _key(self, sample: str, labels: Tuple[Tuple[str, str], ...]) -> str:
+        return json.dumps([self.name, sample, [list(label) for label in labels]])
+
+    def _labels(self, values: dict) -> Tuple[Tuple[str, str], ...]:
+        if set(values) != set(self.labelnames):
+            raise ValueError("%s expects the labels %s" % (self.name, ", ".join(self.labelnames)))
+        return tuple((name, str(values[name])) for name in self.labelnames)
+
+    def expose(self, samples: List[Tuple[str, tuple, float]]) -> List[Tuple[str, tuple, float]]:
+        """Get the samples to render, sorted."""
+        return sorted(((sample, tuple(tuple(label) for label in labels), value)
+                       for sample, labels, value in samples), key=lambda s: (s[1], s[0]))
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        """Increase the counter."""
+        self.registry.add(self._key(self.name + "_total", self._labels(labels)), amount)
+
+    def expose(self, samples):
+        """Get the samples to render, the collectors may report the counter under its bare name."""
+        return super().expose([(self.name + "_total" if sample == self.name else sample, labels, value)
+                               for sample, labels, value in samples])
+
+
+class Gauge(Metric):
+    """A value that goes up and down. Values of dead processes are not reported."""
+
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        """Increase the gauge."""
+        self.registry.add(self._key(self.name, self._labels(labels)), amount)
+
+    def dec(self, amount: float = 1, **labels):
+        """Decrease the gauge."""
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        """Set the gauge."""
+        self.registry.set(self._key(self.name, self._labels(labels)), value)
+
+
+class Histogram(Metric):
+    """Observations counted in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS, registry: Registry = registry):
+        """Define the histogram and its bucket bounds."""
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        """Add an observation."""
+        labels = self._labels(labels)
+        for bound in self.buckets:
+            if value <= bound:
+                # only the first matching bucket is stored, the exposition makes them cumulative
+                self.registry.add(self._key(self.name + "_bucket", labels + (("le", _format_value(bound)),)), 1)
+                break
+        self.registry.add(self._key(self.name + "_sum", labels), value)
+        self.registry.add(self._key(self.name + "_count", labels), 1)
+
+    def time(self, **labels) -> "Timer":
+        """Get a context manager observing the time spent inside it."""
+        return Timer(self, labels)
+
+    def expose(self, samples):
+        """Get the samples to render with cumulative buckets."""
+        buckets = defaultdict(dict)
+        others = []
+        for sample, labels, value in samples:
+            labels = tuple(tuple(label) for label in labels)
+            if sample == self.name + "_bucket":
+                buckets[labels[:-1]][labels[-1][1]] = value
+            else:
+                others.append((sample, labels, value))
+
+        exposed = []
+        for labels, counts in buckets.items():
+            cumulative = 0.0
+            for bound in self.buckets:
+                cumulative += counts.get(_format_value(bound), 0.0)
+                exposed.append((self.name + "_bucket", labels + (("le", _format_value(bound)),), cumulative))
+        return exposed + super().expose(others)
+
+
+class Timer:
+    """Context manager observing the time spent inside it in a histogram."""
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        """Remember the histogram and the labels."""
+        self.histogram = histogram
+        self.labels = labels
+        self.start: Optional[float] = None
+
+    def __enter__(self):
+        """Start timing."""
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Observe the time."""
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Time to serve a request, by url name.",
+                            labelnames=("url_name",))
+
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being served right now.")
+
+DB_CONNECTIONS_OPENED = Counter("db_connections_opened", "Database connections opened, by alias.",
+                                labelnames=("alias",))
+
+DB_CONNECTIONS_OPEN = Gauge("db_connections_open", "Open database connections, by alias.",
+                            labelnames=("alias",))
+
+DB_POOL_CONNECTIONS = Gauge("db_pool_connections", "Connections of the database connection pools, by alias and state.",
+                            labelnames=("alias", "state"))
+
+DB_POOL_DISCARDED = Counter("db_pool_discarded_connections",
+                            "Pooled connections closed because they were broken or failed the health check, by alias.",
+                            labelnames=("alias",))
+
+DB_REPLICA_SKIPPED = Counter("db_replica_skipped",
+                             "Checks that found a read replica lagging too far behind or down, by alias.",
+                             labelnames=("alias",))
+
+# connection wrappers of all threads of this process
+_connections = weakref.WeakSet()
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    _connections.add(connection)
+    DB_CONNECTIONS_OPENED.inc(alias=connection.alias)
+    update_connection_gauge()
+
+
+connection_created.connect(_on_connection_created)
+
+
+def update_connection_gauge():
+    """Set the open connections gauge to the connections of this process that are still open.
+
+    Called when a connection is opened and when the metrics are scraped, not on every request.
+    """
+    # connections of this thread opened before the module was imported
+    _connections.update(connections.all())
+    open_by_alias = defaultdict(int)
+    for connection in list(_connections):
+        open_by_alias[connection.alias] += connection.connection is not None
+    for alias, count in open_by_alias.items():
+        DB_CONNECTIONS_OPEN.set(count, alias=alias)
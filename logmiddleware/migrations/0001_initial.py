@@ -0,0 +1,33 @@
+# Generated by Django 4.0.5 on 2026-10-18 13:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.TextField()),
+                ('url_name', models.CharField(max_length=200)),
+                ('status_code', models.PositiveSmallIntegerField()),
+                ('run_time', models.FloatField(db_index=True)),
+                ('trigger', models.CharField(choices=[('sampled', 'Sampled'), ('slow', 'Slow')], max_length=10)),
+                ('sample_interval', models.FloatField()),
+                ('queries', models.JSONField(default=list)),
+                ('collapsed_stacks', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ['-run_time'],
+            },
+        ),
+    ]
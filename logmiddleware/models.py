@@ -0,0 +1,31 @@
+from django.db import models
+
+
+class RequestProfile(models.Model):
+    """Stack samples and queries of a sampled or slow request. Only the slowest PROFILE_KEEP are kept."""
+
+    TRIGGERS = (
+        ('sampled', 'Sampled'),
+        ('slow', 'Slow'),
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    method = models.CharField(max_length=10)
+    path = models.TextField()
+    url_name = models.CharField(max_length=200)
+    status_code = models.PositiveSmallIntegerField()
+    run_time = models.FloatField(db_index=True)
+    trigger = models.CharField(max_length=10, choices=TRIGGERS)
+    sample_interval = models.FloatField()
+    # [{"sql": ..., "time": ...}, ...] in execution order
+    queries = models.JSONField(default=list)
+    # one "frame;frame;frame count" line per distinct stack, the input format of flamegraph.pl and speedscope
+    collapsed_stacks = models.TextField(blank=True)
+
+    class Meta:
+        """Meta info."""
+
+        ordering = ['-run_time']
+
+    def __str__(self) -> str:
+        """Convert profile to string."""
+        return self.method + " " + self.path + " (" + str(round(self.run_time * 1000)) + " ms)"
@@ -0,0 +1,228 @@
+"""
+Middleware profiling a sample of the requests and the slow ones.
+
+A single background thread takes the stack of every thread serving a profiled
+request each PROFILE_INTERVAL seconds. The request threads only register and
+unregister themselves, and the threads of the requests that are only profiled
+if they are slow are sampled once they pass PROFILE_SLOW_THRESHOLD, so a fast
+request costs two dict operations. The profiles are saved when the response is
+closed, after it was sent to the client.
+"""
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from contextvars import ContextVar
+from functools import partial
+from typing import List, Optional
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http.request import HttpRequest
+from django.http.response import HttpResponse
+
+from .models import RequestProfile
+
+current_queries: ContextVar = ContextVar("profiled_queries", default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper adding the query to the list of the profiled request."""
+    queries = current_queries.get()
+    if queries is None or len(queries) >= settings.PROFILE_MAX_QUERIES:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries.append({"sql": sql, "time": time.perf_counter() - start})
+
+
+def install_query_recorder(connection):
+    """Add the execute wrapper to the connection once."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    install_query_recorder(connection)
+
+
+connection_created.connect(_on_connection_created)
+
+
+def collapse(frame: types.FrameType) -> str:
+    """Format the stack of the frame as a collapsed stack, outermost frame first."""
+    names = []
+    while frame is not None:
+        names.append(frame.f_globals.get("__name__", "?") + ":" + frame.f_code.co_name)
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """Background thread counting the stacks of the registered threads."""
+
+    def __init__(self, interval: float):
+        """Remember the interval, the thread is started by the first registered thread."""
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._threads = {}
+        self._pid = None
+
+    def _ensure_thread(self):
+        # a forked worker process does not inherit the thread, start a new one there
+        if self._pid != os.getpid():
+            self._threads = {}
+            threading.Thread(target=self._sample_loop, name="stack-sampler", daemon=True).start()
+            self._pid = os.getpid()
+
+    def start(self, thread_id: int, delay: float = 0.0) -> Counter:
+        """Start counting the stacks of the thread in delay seconds."""
+        stacks = Counter()
+        with self._lock:
+            self._ensure_thread()
+            self._threads[thread_id] = (time.perf_counter() + delay, stacks)
+            self._wake.set()
+        return stacks
+
+    def stop(self, thread_id: int) -> Counter:
+        """Stop counting the stacks of the thread and get them."""
+        with self._lock:
+            _, stacks = self._threads.pop(thread_id)
+            if not self._threads:
+                self._wake.clear()
+        return stacks
+
+    def _sample_loop(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self._lock:
+                due = {thread_id: stacks for thread_id, (start_at, stacks) in self._threads.items() if start_at <= now}
+            if not due:
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stacks in due.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None and thread_id in self._threads:
+                        stacks[collapse(frame)] += 1
+            del frames
+
+
+sampler = StackSampler(0.005)
+
+
+def keep_profile(run_time: float) -> bool:
+    """Check whether the request is slow enough to be among the PROFILE_KEEP slowest."""
+    fastest_kept = RequestProfile.objects.values_list("run_time", flat=True)[settings.PROFILE_KEEP - 1:].first()
+    return fastest_kept is None or run_time > fastest_kept
+
+
+def save_profile(**fields) -> Optional[RequestProfile]:
+    """Store the profile if it is among the slowest and drop the ones that are not any more."""
+    if not keep_profile(fields["run_time"]):
+        return None
+    profile = RequestProfile.objects.create(**fields)
+    stale = RequestProfile.objects.values_list("pk", flat=True)[settings.PROFILE_KEEP:]
+    RequestProfile.objects.filter(pk__in=list(stale)).delete()
+    return profile
+
+
+def format_stacks(stacks: Counter) -> str:
+    """Format the stack counts in the collapsed format, most frequent first."""
+    return "".join(stack + " " + str(count) + "\n" for stack, count in stacks.most_common())
+
+
+class ProfilingMiddleware:
+    """Profiles PROFILE_SAMPLE_RATE of the requests and the requests slower than PROFILE_SLOW_THRESHOLD.
+
+    Disabled when neither is set. Works in both sync and async handler chains;
+    the requests of the async chain share their threads, so only their queries
+    and run time are recorded, not their stacks.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response: types.FunctionType):
+        """Init self.get_response with a function to get the response."""
+        if not settings.PROFILE_SAMPLE_RATE and settings.PROFILE_SLOW_THRESHOLD is None:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        sampler.interval = settings.PROFILE_INTERVAL
+        if asyncio.iscoroutinefunction(self.get_response):
+            # mark the instance as a coroutine function, like django.utils.deprecation.MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        """Profile the request if it is sampled or may turn out slow."""
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        sampled = random.random() < settings.PROFILE_SAMPLE_RATE
+        if not sampled and settings.PROFILE_SLOW_THRESHOLD is None:
+            return self.get_response(request)
+
+        for connection in connections.all():
+            install_query_recorder(connection)
+        queries: List[dict] = []
+        token = current_queries.set(queries)
+        thread_id = threading.get_ident()
+        # the stacks of a request profiled for being slow are only needed once it is
+        sampler.start(thread_id, 0.0 if sampled else settings.PROFILE_SLOW_THRESHOLD)
+        start_time = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            stacks = sampler.stop(thread_id)
+            current_queries.reset(token)
+        self.save_later(request, response, time.perf_counter() - start_time, sampled, queries, stacks)
+        return response
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        """Profile the request of the async handler chain if it is sampled or may turn out slow."""
+        sampled = random.random() < settings.PROFILE_SAMPLE_RATE
+        if not sampled and settings.PROFILE_SLOW_THRESHOLD is None:
+            return await self.get_response(request)
+
+        # the views run in threads of their own, which get a copy of the context and so the same list
+        queries: List[dict] = []
+        token = current_queries.set(queries)
+        start_time = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_queries.reset(token)
+        self.save_later(request, response, time.perf_counter() - start_time, sampled, queries, Counter())
+        return response
+
+    @staticmethod
+    def save_later(request: HttpRequest, response: HttpResponse, run_time: float, sampled: bool,
+                   queries: List[dict], stacks: Counter):
+        """Save the profile of the slow or sampled request when the response is closed."""
+        threshold = settings.PROFILE_SLOW_THRESHOLD
+        if threshold is not None and run_time >= threshold:
+            trigger = "slow"
+        elif sampled:
+            trigger = "sampled"
+        else:
+            return
+
+        match = request.resolver_match
+        response._resource_closers.append(partial(
+            save_profile, method=request.method, path=request.get_full_path(),
+            url_name=match.url_name if match is not None and match.url_name else "<unmatched>",
+            status_code=response.status_code, run_time=run_time, trigger=trigger,
+            sample_interval=sampler.interval, queries=queries, collapsed_stacks=format_stacks(stacks),
+        ))
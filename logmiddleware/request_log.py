@@ -1,6 +1,7 @@
 """
 Middleware to log requests and responses.
 """
+import asyncio
 import logging
 import socket
 import time
@@ -8,36 +9,108 @@ import types
 
 from django.http.request import HttpRequest
 from django.http.response import HttpResponse
+from django.template.response import SimpleTemplateResponse
+
+from . import metrics, stats
 
-logging.basicConfig(filename="logs.txt", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+HOSTNAME = socket.gethostname()
+
 
 class RequestLogMiddleware:
-    """Request logging middleware."""
+    """Request logging middleware. Works in both sync and async handler chains.
+
+    Besides the run time it records the number and total time of the SQL queries,
+    the template render time, the response size and the matched url name, and
+    adds them to the per-view histograms of logmiddleware.stats and to the
+    Prometheus metrics of logmiddleware.metrics.
+    """
+
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response: types.FunctionType):
         """Init self.get_response with a function to get the response"""
         self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # mark the instance as a coroutine function, like django.utils.deprecation.MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
 
     def __call__(self, request: HttpRequest) -> HttpResponse:
         """Log requests and responses."""
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        stats.install_query_counters()
+        request_stats = stats.RequestStats()
+        token = stats.current_stats.set(request_stats)
+        start_time = time.perf_counter()
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.REQUESTS_IN_FLIGHT.dec()
+            stats.current_stats.reset(token)
+        self.log(request, response, start_time, request_stats)
+
+        return response
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        """Log requests and responses of the async handler chain."""
+        request_stats = stats.RequestStats()
+        token = stats.current_stats.set(request_stats)
+        start_time = time.perf_counter()
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.REQUESTS_IN_FLIGHT.dec()
+            stats.current_stats.reset(token)
+        self.log(request, response, start_time, request_stats)
+
+        return response
+
+    def process_template_response(self, request: HttpRequest, response: SimpleTemplateResponse):
+        """Time the rendering of the template response."""
+        request_stats = stats.current_stats.get()
+        if request_stats is not None:
+            request_stats.template_start = time.perf_counter()
+            response.add_post_render_callback(lambda rendered: self._rendered(request_stats))
+        return response
+
+    @staticmethod
+    def _rendered(request_stats: stats.RequestStats):
+        request_stats.template_time += time.perf_counter() - request_stats.template_start
+
+    def log(self, request: HttpRequest, response: HttpResponse, start_time: float,
+            request_stats: stats.RequestStats):
+        """Queue the log record of the request, the handler writes it off the request thread."""
+        run_time = time.perf_counter() - start_time
+        match = request.resolver_match
+        url_name = match.url_name if match is not None and match.url_name else "<unmatched>"
+        if response.streaming:
+            response_size = int(response["Content-Length"]) if response.has_header("Content-Length") else None
+        else:
+            response_size = len(response.content)
 
-        start_time = time.time()
         log_data = {
-            "remote_address": request.META["REMOTE_ADDR"],
-            "server_hostname": socket.gethostname(),
+            "remote_address": request.META.get("REMOTE_ADDR"),
+            "server_hostname": HOSTNAME,
             "request_method": request.method,
             "request_path": request.get_full_path(),
+            "url_name": url_name,
+            "status_code": response.status_code,
+            "run_time": run_time,
+            "queries": request_stats.queries,
+            "db_time": request_stats.db_time,
+            "template_time": request_stats.template_time,
+            "response_size": response_size,
         }
-
-        response = self.get_response(request)
-        log_data["run_time"] = time.time() - start_time
-
+        stats.view_stats.observe(url_name, log_data)
+        metrics.REQUEST_LATENCY.observe(run_time, url_name=url_name)
         logger.info(msg=log_data)
 
-        return response
-
     def process_exception(self, request: HttpRequest, exception: Exception):
         """Process unhandled exceptions."""
 
@@ -0,0 +1,144 @@
+"""
+Per-request performance counters and their per-view aggregates.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from typing import Dict, Optional
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+# upper bounds of the histogram buckets: from 0.1 ms growing by a quarter of an octave, about 100 s at the top
+BUCKET_BOUNDS = tuple(0.0001 * 2 ** (i / 4) for i in range(80))
+
+COUNT_BUCKET_BOUNDS = tuple(range(1, 10)) + tuple(range(10, 100, 5)) + tuple(range(100, 1001, 50))
+
+PERCENTILES = (50, 95, 99)
+
+
+class RequestStats:
+    """Counters of a single request."""
+
+    __slots__ = ("queries", "db_time", "template_time", "template_start")
+
+    def __init__(self):
+        """Start with zero counters."""
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_start = None
+
+
+current_stats: contextvars.ContextVar = contextvars.ContextVar("request_stats", default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    """Database execute wrapper adding the query to the counters of the current request."""
+    stats = current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - start
+
+
+def install_query_counter(connection):
+    """Add the execute wrapper to the connection once."""
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+def install_query_counters():
+    """Add the execute wrapper to the connections of the current thread."""
+    for connection in connections.all():
+        install_query_counter(connection)
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    install_query_counter(connection)
+
+
+# connections of other threads, e.g. the one running sync views under ASGI
+connection_created.connect(_on_connection_created)
+
+
+class Histogram:
+    """Counts of observations in fixed buckets. Percentiles are the upper bounds of the buckets."""
+
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        """Create an empty histogram."""
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Add an observation."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """Get the value below which the given percent of the observations lie."""
+        if not self.count:
+            return None
+        rank = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else float("inf")
+        return float("inf")
+
+    def summary(self) -> dict:
+        """Get the count, the mean and the percentiles."""
+        data = {"count": self.count, "mean": self.sum / self.count if self.count else None}
+        for percent in PERCENTILES:
+            data["p" + str(percent)] = self.percentile(percent)
+        return data
+
+
+class ViewStats:
+    """Histograms of the request metrics of every view, in this process."""
+
+    METRICS = {
+        "run_time": BUCKET_BOUNDS,
+        "db_time": BUCKET_BOUNDS,
+        "template_time": BUCKET_BOUNDS,
+        "queries": COUNT_BUCKET_BOUNDS,
+    }
+
+    def __init__(self):
+        """Create empty aggregates."""
+        self._lock = threading.Lock()
+        self._views: Dict[str, Dict[str, Histogram]] = {}
+
+    def observe(self, url_name: str, values: dict):
+        """Add the metrics of one request of the view."""
+        with self._lock:
+            histograms = self._views.get(url_name)
+            if histograms is None:
+                histograms = {name: Histogram(bounds) for name, bounds in self.METRICS.items()}
+                self._views[url_name] = histograms
+            for name, histogram in histograms.items():
+                histogram.observe(values[name])
+
+    def snapshot(self) -> dict:
+        """Get the summaries of all metrics of all views."""
+        with self._lock:
+            return {url_name: {name: histogram.summary() for name, histogram in histograms.items()}
+                    for url_name, histograms in self._views.items()}
+
+    def reset(self):
+        """Forget all observations."""
+        with self._lock:
+            self._views.clear()
+
+
+view_stats = ViewStats()
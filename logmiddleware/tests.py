@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from catalog import jobs, models
+from catalog.tests import TEST_CACHES
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.shortcuts import reverse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import resolve
+
+from . import metrics, profiling, stats
+from .handlers import BatchedJsonLinesHandler
+from .models import RequestProfile
+from .request_log import RequestLogMiddleware
+
+# the pages of the catalog cache their fragments, the tests must never use the shared cache of the deployment
+test_caches = override_settings(CACHES=TEST_CACHES)
+
+
+def setUpModule():
+    test_caches.enable()
+
+
+def tearDownModule():
+    test_caches.disable()
+
+
+class RequestLogTest(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "logs.txt")
+
+    def read_lines(self, handler):
+        handler.flush()
+        with open(self.filename) as fh:
+            return [json.loads(line) for line in fh]
+
+    def test_handler_writes_json_lines(self):
+        handler = BatchedJsonLinesHandler(self.filename, batch_size=2)
+        log = logging.getLogger("logmiddleware.tests.request_log")
+        log.addHandler(handler)
+        self.addCleanup(log.removeHandler, handler)
+
+        log.warning(msg={"request_path": "/catalog/"})
+        log.warning("plain %s", "text")
+        log.warning("third")
+
+        lines = self.read_lines(handler)
+        self.assertEqual(lines[0]["request_path"], "/catalog/")
+        self.assertEqual(lines[1]["message"], "plain text")
+        self.assertEqual([line["level"] for line in lines], ["WARNING"] * 3)
+
+    def test_async_middleware(self):
+        async def get_response(request):
+            return HttpResponse("async")
+
+        middleware = RequestLogMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        handler = BatchedJsonLinesHandler(self.filename)
+        log = logging.getLogger("logmiddleware.request_log")
+        log.addHandler(handler)
+        self.addCleanup(log.removeHandler, handler)
+
+        response = asyncio.run(middleware(RequestFactory().get("/catalog/?usr_query=x")))
+        self.assertEqual(response.content, b"async")
+
+        line = self.read_lines(handler)[0]
+        self.assertEqual(line["request_path"], "/catalog/?usr_query=x")
+        self.assertEqual(line["status_code"], 200)
+        self.assertGreaterEqual(line["run_time"], 0)
+
+
+class RequestStatsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = models.Category.objects.create(name="stats", info="stats")
+        User.objects.create_superuser("admin", password="passwodr")
+
+    def setUp(self) -> None:
+        super().setUp()
+        stats.view_stats.reset()
+
+    def test_views_are_measured(self):
+        for _ in range(3):
+            self.client.get(self.category.get_absolute_url())
+        self.client.get("/catalog/no-such-page")
+
+        snapshot = stats.view_stats.snapshot()
+        self.assertEqual(snapshot["category-detail"]["run_time"]["count"], 3)
+        # the later hits render the page from the fragment cache
+        self.assertGreaterEqual(snapshot["category-detail"]["queries"]["p50"], 1)
+        self.assertGreater(snapshot["category-detail"]["template_time"]["p99"], 0)
+        self.assertEqual(snapshot["<unmatched>"]["run_time"]["count"], 1)
+
+        self.assertEqual(self.client.get(reverse("request-stats")).status_code, 302)
+        self.client.login(username="admin", password="passwodr")
+        self.assertIn("category-detail", self.client.get(reverse("request-stats")).json())
+
+    def test_histogram_percentiles(self):
+        histogram = stats.Histogram()
+        for value in range(1, 101):
+            histogram.observe(value / 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 0.05, delta=0.01)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta=0.015)
+
+
+class PrometheusMetricsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = models.Category.objects.create(name="metrics", info="metrics")
+
+    def test_endpoint(self):
+        self.client.get(self.category.get_absolute_url())
+        jobs.enqueue("notify_category_update", {"category_ids": [self.category.pk]})
+
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+        User.objects.create_user(username="staff", password="passwodr", is_staff=True)
+        self.client.login(username="staff", password="passwodr")
+        response = self.client.get(reverse("metrics"))
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        text = response.content.decode()
+        self.assertIn("# TYPE http_request_duration_seconds histogram", text)
+        self.assertIn('http_request_duration_seconds_bucket{url_name="category-detail",le="+Inf"}', text)
+        self.assertIn('catalog_jobs{status="queued"} 1.0', text)
+        self.assertIn("http_requests_in_flight 1.0", text)
+
+        self.client.logout()
+        with self.settings(METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 401)
+            self.assertEqual(self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret").status_code,
+                             200)
+
+    def test_values_of_worker_processes_are_summed(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter("test_total_things", "Things.", labelnames=("kind",), registry=registry)
+        gauge = metrics.Gauge("test_busy", "Busy.", registry=registry)
+        histogram = metrics.Histogram("test_seconds", "Seconds.", buckets=(0.1, 1.0), registry=registry)
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(METRICS_DIR=directory):
+            pid = os.fork()
+            if pid == 0:
+                counter.inc(2, kind="a")
+                gauge.inc()
+                histogram.observe(0.5)
+                os._exit(0)
+            os.waitpid(pid, 0)
+
+            counter.inc(kind="a")
+            gauge.inc(3)
+            histogram.observe(0.05)
+            text = registry.generate_latest()
+
+        self.assertIn('test_total_things_total{kind="a"} 3.0', text)
+        # the gauge of the exited process is dropped
+        self.assertIn("test_busy 3.0", text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1.0', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2.0', text)
+        self.assertIn("test_seconds_count 2.0", text)
+
+
+class ProfilingTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = models.Category.objects.create(name="profiled", info="profiled")
+        User.objects.create_superuser("admin", password="passwodr")
+
+    def test_slowest_requests_are_kept(self):
+        with self.settings(PROFILE_SLOW_THRESHOLD=0.0, PROFILE_KEEP=2):
+            for _ in range(3):
+                self.client.get(self.category.get_absolute_url())
+
+        self.assertEqual(RequestProfile.objects.count(), 2)
+        profile = RequestProfile.objects.first()
+        self.assertEqual((profile.url_name, profile.trigger), ("category-detail", "slow"))
+        self.assertTrue(any("catalog_category" in query["sql"] for query in profile.queries))
+
+        self.client.login(username="admin", password="passwodr")
+        self.assertEqual(self.client.get(reverse("admin:logmiddleware_requestprofile_change",
+                                                 args=[profile.pk])).status_code, 200)
+        response = self.client.get(reverse("admin:logmiddleware_requestprofile_stacks", args=[profile.pk]))
+        self.assertEqual(response.content.decode(), profile.collapsed_stacks)
+
+    def test_disabled_by_default(self):
+        self.client.get(self.category.get_absolute_url())
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_stack_sampler(self):
+        thread_id = threading.get_ident()
+        profiling.sampler.start(thread_id)
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        stacks = profiling.sampler.stop(thread_id)
+
+        self.assertTrue(stacks)
+        self.assertTrue(all(stack.endswith("logmiddleware.tests:test_stack_sampler") for stack in stacks))
+        self.assertIn(" " + str(sum(stacks.values())) + "\n", profiling.format_stacks(stacks))
+
+        # a request profiled for being slow is not sampled before it is
+        profiling.sampler.start(thread_id, delay=10)
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        self.assertEqual(profiling.sampler.stop(thread_id), {})
+
+    def test_async_requests(self):
+        async def get_response(request):
+            categories = await sync_to_async(list)(models.Category.objects.all())
+            return HttpResponse(str(len(categories)))
+
+        with self.settings(PROFILE_SLOW_THRESHOLD=0.0):
+            middleware = profiling.ProfilingMiddleware(get_response)
+            self.assertTrue(asyncio.iscoroutinefunction(middleware))
+            request = RequestFactory().get(self.category.get_absolute_url())
+            request.resolver_match = resolve(self.category.get_absolute_url())
+            response = async_to_sync(middleware)(request)
+            # saved once the response is sent
+            self.assertFalse(RequestProfile.objects.exists())
+            response.close()
+
+        profile = RequestProfile.objects.get()
+        self.assertEqual((profile.url_name, profile.trigger, profile.collapsed_stacks), ("category-detail", "slow", ""))
+        self.assertTrue(any("catalog_category" in query["sql"] for query in profile.queries))
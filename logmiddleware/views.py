@@ -0,0 +1,28 @@
+"""
+Views exposing the collected request statistics and metrics.
+"""
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http.request import HttpRequest
+from django.http.response import HttpResponse, JsonResponse
+from django.utils.crypto import constant_time_compare
+
+from . import metrics, stats
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@staff_member_required
+def request_stats(request: HttpRequest) -> JsonResponse:
+    """Show the latency, query and template percentiles of every view served by this process."""
+    return JsonResponse(stats.view_stats.snapshot())
+
+
+def prometheus_metrics(request: HttpRequest) -> HttpResponse:
+    """Expose the metrics of all worker processes in the Prometheus text format to the scraper and the staff."""
+    token = settings.METRICS_TOKEN
+    scraper = bool(token) and constant_time_compare(request.headers.get("Authorization", ""), "Bearer " + token)
+    if not scraper and not request.user.is_staff:
+        return HttpResponse(status=401 if token else 403)
+    metrics.update_connection_gauge()
+    return HttpResponse(metrics.registry.generate_latest(), content_type=CONTENT_TYPE)